@@ -0,0 +1,86 @@
+"""
+Compares write latency of audit modes on a wide table.
+
+    POLAR_SITE_BE_TEST_POSTGRES_DSN=postgres://... \
+        PYTHONPATH=. venv/bin/python benchmarks/bench_audit.py
+"""
+import asyncio
+import os
+import time
+
+import asyncpg
+
+from groza.storage.asyncpg.audit import AsyncpgAuditWriter
+from groza.storage.asyncpg.triggers import audit_func_sql, AUDIT_MODES
+
+ROWS = 10000
+COLUMNS = 30
+
+
+async def bench_mode(conn, dsn, audit):
+    table = 'bench_audit_' + audit.replace('-', '_')
+    func = f'{table}_func'
+
+    columns = ', '.join(f'c{i} text' for i in range(COLUMNS))
+    await conn.execute(f'DROP TABLE IF EXISTS {table}')
+    await conn.execute(f'CREATE TABLE {table} (id bigserial PRIMARY KEY, '
+                       f'last_updated_by int8 NOT NULL, {columns})')
+    await conn.execute(f'INSERT INTO {table} (last_updated_by) '
+                       f'SELECT 1 FROM generate_series(1, {ROWS})')
+
+    await conn.execute(audit_func_sql(
+        func=func, table=table, primary_key='id', audit_table='groza_audit',
+        audit_table_seq='groza_audit_id_seq',
+        last_updated_by_field='last_updated_by', audit=audit))
+    await conn.execute(f'CREATE TRIGGER {table}_trigger '
+                       f'AFTER INSERT OR UPDATE OR DELETE ON {table} '
+                       f'FOR EACH ROW EXECUTE PROCEDURE {func}()')
+
+    writer = None
+    if audit == 'async':
+        writer = AsyncpgAuditWriter(dsn, interval=3600)
+        await writer.connect()
+
+    start = time.perf_counter()
+    await conn.execute(f"UPDATE {table} SET c0 = 'changed', c1 = id::text")
+    if writer is not None:
+        writer.add([(1, 'U', table, key, {}, {'c0': 'changed', 'c1': key})
+                    for key in range(1, ROWS + 1)])
+        await writer.flush()
+    elapsed = time.perf_counter() - start
+
+    if writer is not None:
+        await writer.close()
+
+    await conn.execute(f'DROP TABLE {table}')
+    return elapsed
+
+
+async def main():
+    dsn = os.getenv('POLAR_SITE_BE_TEST_POSTGRES_DSN')
+    conn = await asyncpg.connect(dsn)
+    await conn.execute('CREATE SEQUENCE IF NOT EXISTS "groza_audit_id_seq"')
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS "groza_audit" (
+           "audit_id" int8 PRIMARY KEY,
+           "updatedBy" int8 NOT NULL,
+           "int_key" int8,
+           "time" timestamp NOT NULL,
+           "operation" bpchar NOT NULL,
+           "table" varchar NOT NULL,
+           "var_key" varchar,
+           "o" hstore,
+           "n" hstore
+        );
+    """)
+
+    for audit in AUDIT_MODES:
+        elapsed = await bench_mode(conn, dsn, audit)
+        print(f'{audit:12} {ROWS} rows x {COLUMNS} columns update: '
+              f'{elapsed * 1000:.1f} ms')
+
+    await conn.close()
+
+
+if __name__ == '__main__':
+    asyncio.get_event_loop().run_until_complete(main())
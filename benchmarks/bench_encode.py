@@ -0,0 +1,41 @@
+"""
+Event loop lag while a large response is encoded at once and in slices.
+
+    PYTHONPATH=. venv/bin/python benchmarks/bench_encode.py
+"""
+import asyncio
+
+from groza.server.encode import GrozaEncoder, LoopLagMonitor
+
+ROWS = 200000
+
+
+def make_payload():
+    return {'type': 'data', 'data': {'accounts': {
+        i: {'id': i, 'name': f'account {i}', 'balance': i * 1.5,
+            'isActive': i % 2 == 0, 'lastUpdatedBy': 1}
+        for i in range(ROWS)
+    }}}
+
+
+async def bench(name, encoder, payload):
+    monitor = LoopLagMonitor(interval=0.005, warn_lag=10)
+    monitor.start()
+    await asyncio.sleep(0.05)
+
+    js = await encoder.encode(payload)
+
+    await asyncio.sleep(0.05)
+    monitor.stop()
+    print(f'{name:8} {len(js)} chars, max loop lag '
+          f'{monitor.max_lag * 1000:.1f} ms')
+
+
+async def main():
+    payload = make_payload()
+    await bench('inline', GrozaEncoder(chunk_values=10 ** 9), payload)
+    await bench('chunked', GrozaEncoder(chunk_values=20000), payload)
+
+
+if __name__ == '__main__':
+    asyncio.get_event_loop().run_until_complete(main())
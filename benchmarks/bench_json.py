@@ -0,0 +1,59 @@
+"""
+Compares response encoding and request decoding of JSON codecs.
+
+    PYTHONPATH=. venv/bin/python benchmarks/bench_json.py
+"""
+import time
+from datetime import datetime, date
+from uuid import uuid4
+
+from groza.utils import JsonCodec, OrjsonCodec, orjson
+
+ROWS = 20000
+REPEAT = 5
+
+
+def make_payload():
+    now = datetime(2020, 1, 2, 3, 4, 5)
+    rows = {
+        i: {
+            'id': i,
+            'uuid': uuid4(),
+            'name': f'account {i}',
+            'balance': i * 1.5,
+            'createdAt': now,
+            'birthday': date(1990, 1, 1),
+            'isActive': i % 2 == 0,
+            'lastUpdatedBy': 1,
+        }
+        for i in range(ROWS)
+    }
+    return {'type': 'data', 'data': {'accounts': rows},
+            'sub': {'allAccounts': {'status': 'ok', 'dataField': 'accounts',
+                                    'ids': list(rows)}}}
+
+
+def bench(codec, payload):
+    start = time.perf_counter()
+    for _ in range(REPEAT):
+        js = codec.dumps(payload)
+    dumps = (time.perf_counter() - start) / REPEAT
+
+    start = time.perf_counter()
+    for _ in range(REPEAT):
+        codec.loads(js)
+    loads = (time.perf_counter() - start) / REPEAT
+
+    print(f'{codec.name:8} dumps {dumps * 1000:8.1f} ms   '
+          f'loads {loads * 1000:8.1f} ms   {len(js)} chars')
+
+
+def main():
+    payload = make_payload()
+    bench(JsonCodec(), payload)
+    if orjson is not None:
+        bench(OrjsonCodec(), payload)
+
+
+if __name__ == '__main__':
+    main()
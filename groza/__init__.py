@@ -1,3 +1,5 @@
+from typing import NamedTuple, Optional
+
 
 class GrozaUser:
     def __init__(self, auth_token=None, user_id=None):
@@ -18,3 +20,25 @@ class GrozaResponse:
     @property
     def data(self):
         return self._data
+
+
+class GrozaChange(NamedTuple):
+    """
+    Change notification item. Storages which know more than a key fill
+    `op` ('I', 'U', 'D') and the new `row` or only its `changed` fields,
+    both with client field names.
+    """
+    pid: int
+    channel: str
+    obj_id: str
+    op: Optional[str] = None
+    row: Optional[dict] = None
+    changed: Optional[dict] = None
+
+    @property
+    def is_inline(self):
+        """
+        Change can be applied without querying the storage.
+        """
+        return self.op == 'D' or self.row is not None \
+            or self.changed is not None
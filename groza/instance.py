@@ -1,10 +1,15 @@
-import asyncio
 from typing import Dict
 
+from groza import GrozaChange
 from groza.client import GrozaClient
 from groza.queue import BaseQueue
 from groza.queue.asyncio_queue import AsyncioQueue
 from groza.server import GrozaServer
+from groza.utils import build_logger
+
+
+# Queued by `Groza.stop` to wake up and finish the dispatch loop
+_STOP = object()
 
 
 class Groza:
@@ -20,6 +25,8 @@ class Groza:
         self._notifications: BaseQueue = (notifications_instance
             if notifications_instance else AsyncioQueue())
 
+        self._log = build_logger('Groza')
+
     async def add_clients(self, *clients):
         self._clients.update({c.name: await c.install(self._notifications)
                               for c in clients})
@@ -29,14 +36,61 @@ class Groza:
                               for s in servers})
 
     async def loop(self):
+        """
+        Waits for notifications and dispatches them to servers. Everything
+        already queued at wake up is dispatched as one batch.
+        """
         while True:
+            batch = [await self._notifications.get()]
             while not self._notifications.empty():
-                pid, channel, obj_id = await self._notifications.get()
+                batch.append(self._notifications.get_nowait())
+
+            await self._dispatch(batch)
+
+            if _STOP in batch:
+                break
+
+    def stop(self):
+        """
+        Finishes `loop` after notifications queued before the call.
+        """
+        self._notifications.put_nowait(_STOP)
+
+    async def close(self):
+        """
+        Releases what servers hold running, after `loop` finished.
+        """
+        for server in self._servers.values():
+            await server.close()
+
+    async def _dispatch(self, batch):
+        seen = set()
+        changes = []
+        for item in batch:
+            if item is _STOP:
+                continue
+
+            change = GrozaChange(*item)
 
-                # TODO: Don't send full sub on same pids
-                # TODO: Route different servers sub. Now send all
+            # Same object changed several times in a row: one is enough,
+            # unless changes carry their data. Key-only change after an
+            # inline one is needed again to undo it
+            key = (change.channel, change.obj_id)
+            if change.is_inline:
+                seen.discard(key)
+            elif key in seen:
+                continue
+            else:
+                seen.add(key)
+            changes.append(change)
 
-                for server in self._servers.values():
-                    await server.notify_change(pid, channel, obj_id)
+        if not changes:
+            return
 
-            await asyncio.sleep(0.3)
+        # TODO: Route different servers sub. Now send all
+        for server in self._servers.values():
+            try:
+                await server.notify_changes(changes)
+            except Exception:
+                self._log.exception('Error notifying server %s of %d changes'
+                                    % (server.name, len(changes)))
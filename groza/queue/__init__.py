@@ -17,6 +17,10 @@ class BaseQueue(ABC):
     async def get(self):
         pass
 
+    @abstractmethod
+    def get_nowait(self):
+        pass
+
     @abstractmethod
     def empty(self):
         pass
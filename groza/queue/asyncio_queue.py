@@ -16,5 +16,8 @@ class AsyncioQueue(BaseQueue):
     async def get(self):
         return await self._q.get()
 
+    def get_nowait(self):
+        return self._q.get_nowait()
+
     def empty(self):
         return self._q.empty()
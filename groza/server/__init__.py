@@ -1,35 +1,49 @@
-import json
 from abc import abstractmethod, ABC
-from collections import OrderedDict
 from typing import List, Optional
 
-from groza import GrozaUser, GrozaRequest, GrozaResponse
+from groza import GrozaUser, GrozaRequest, GrozaChange
 from groza.queue import BaseQueue
-from groza.state import GrozaHandler
+from groza.server.encode import GrozaEncoder, LoopLagMonitor
+from groza.server.group import GrozaSubGroup, GrozaSubGroups
+from groza.server.index import GrozaSubIndex
+from groza.server.predicates import GrozaPredicateIndex
+from groza.server.scheduler import GrozaRequestScheduler
+from groza.state import GrozaHandler, DATA_FORMATS
 from groza.transport import GrozaServerTransport
-from groza.utils import build_logger, json_serial
+from groza.utils import build_logger, json_codec
 
 
 class GrozaServerConnection:
-    def __init__(self, handler, response):
+    def __init__(self, handler, response, max_concurrent=4):
         self.handler: GrozaHandler = handler
         self.user = GrozaUser(auth_token='', user_id=1)
         self.ws = response
         self.log = build_logger('WS')
         self.auth_token = None
         self.all_sub = {}
-        self.last_sub = {}
+        self.data_format = 'object'
         self.global_params = {}
+        self.group: Optional[GrozaSubGroup] = None
+        self.groups = GrozaSubGroups()
+        self.encoder = GrozaEncoder()
+        self.scheduler = GrozaRequestScheduler(self.handle_message,
+                                               limit=max_concurrent)
+
+    @property
+    def last_sub(self):
+        return self.group.last_sub if self.group is not None else {}
 
     async def handle_request(self, request):
         resp = {
             'responseQueryId': request['queryId'],
         }
 
-        if request.get('type') not in ('login', 'sub', 'auth', 'register',
-                                       'update', 'insert', 'delete'):
-            return {'status': 'error', 'message': 'Invalid type: %s' %
-                                                  request.get('type')}
+        if request.get('type') not in ('login', 'sub', 'more', 'auth',
+                                       'register', 'update', 'insert',
+                                       'delete'):
+            resp.update({'status': 'error',
+                         'message': 'Invalid type: %s' % request.get('type')})
+            return resp
 
         push_request = GrozaRequest(request)
 
@@ -44,15 +58,51 @@ class GrozaServerConnection:
             token = request['token']
             handle_resp = await self.handler.auth(push_request)
             if handle_resp.data.get('status') == 'ok':
-                self.user.auth_token = token
-                self.user.user_id = handle_resp.data['userId']
+                user_id = self.user.user_id
+                self.user = GrozaUser(auth_token=token,
+                                      user_id=handle_resp.data['userId'])
+                if self.group is not None:
+                    last_sub = self.group.last_sub
+                    if self.user.user_id != user_id:
+                        # Rows of the old user are not those of the new one
+                        sub_resp = await self.handler.fetch_sub(
+                            self.user, self.all_sub,
+                            data_format=self.data_format)
+                        last_sub = sub_resp.data['sub']
+                        await self.send(sub_resp.data)
+                    self.groups.join(self, last_sub)
         elif req_type == 'sub':
             if 'sub' not in request or not isinstance(request['sub'], dict):
-                return GrozaResponse({'status': 'error',
-                                      'message': 'Invalid not dict sub'})
+                resp.update({'status': 'error',
+                             'message': 'Invalid not dict sub'})
+                return resp
+            data_format = request.get('format', 'object')
+            if data_format not in DATA_FORMATS:
+                resp.update({'status': 'error',
+                             'message': 'Invalid format: %s' % data_format})
+                return resp
+            if request.get('stream'):
+                handle_resp = await self._stream_sub(request, data_format)
+                if handle_resp.data.get('type') != 'data':
+                    resp.update(handle_resp.data)
+                    return resp
+            else:
+                handle_resp = await self.handler.fetch_sub(
+                    self.user, request['sub'], data_format=data_format)
             self.all_sub = request['sub']
-            handle_resp = await self.handler.fetch_sub(self.user, self.all_sub)
-            self.last_sub = handle_resp.data['sub']
+            self.data_format = data_format
+            self.groups.join(self, handle_resp.data['sub'])
+        elif req_type == 'more':
+            sub = request.get('sub')
+            if self.group is None or sub not in self.all_sub:
+                resp.update({'status': 'error',
+                             'message': 'Invalid sub: %s' % sub})
+                return resp
+            handle_resp = await self.handler.fetch_more(
+                self.user, self.all_sub, sub, self.last_sub,
+                data_format=self.data_format)
+            if handle_resp.data.get('type') == 'more':
+                self._add_page(sub, handle_resp.data['sub'][sub])
         elif req_type == 'update':
             update = request['update']
             handle_resp = await self.handler.query_update(self.user, update)
@@ -71,43 +121,72 @@ class GrozaServerConnection:
 
         return resp
 
+    async def _stream_sub(self, request, data_format):
+        """
+        Sends subscription rows in `data-chunk` frames before the response.
+        Each frame is written before the next chunk is read, so a slow
+        socket holds the reading back.
+        """
+        async def send_chunk(frame):
+            await self.send({'responseQueryId': request['queryId'], **frame})
+
+        return await self.handler.stream_sub(
+            self.user, request['sub'], send_chunk,
+            chunk_rows=request.get('chunkRows', 1000),
+            data_format=data_format)
+
+    def _add_page(self, sub, page):
+        """
+        Counts one more loaded page of `sub`: the connection moves to the
+        group of subscriptions with that many pages.
+        """
+        sub_desc = self.all_sub[sub]
+        pages = sub_desc.get('pages', 1) + 1
+        self.all_sub = {**self.all_sub, sub: {**sub_desc, 'pages': pages}}
+
+        last_sub = dict(self.last_sub)
+        last_sub[sub] = {**last_sub[sub],
+                         'ids': last_sub[sub]['ids'] + page['addIds'],
+                         'cursor': page['cursor'],
+                         'hasMore': page['hasMore']}
+        self.groups.join(self, last_sub)
+
     async def handle(self):
+        """
+        Reads requests and runs them with `scheduler`: responses are sent
+        as requests complete.
+        """
         async for message in await self.ws.get_messages():
             try:
                 self.log.debug(f'Req : {message}')
-                request = json.loads(message.data,
-                                     object_pairs_hook=OrderedDict)
-
-                handler_resp = await self.handle_request(request)
-
-                await self.send(handler_resp)
+                request = json_codec.loads(message.data)
             except:
-                self.log.exception('Exception handling message: %s' %
+                self.log.exception('Exception decoding message: %s' %
                                    message.data)
+                continue
 
-    async def send(self, resp):
-        js = json.dumps(resp, default=json_serial)
-        self.log.debug('.. Resp: %s' % js)
-        await self.ws.send(js)
+            await self.scheduler.submit(request)
 
-    async def send_sub(self):
-        resp = await self.handler.fetch_sub(self.user, self.all_sub)
-        self.last_sub = resp.data['sub']
-        await self.send(resp.data)
+        await self.scheduler.drain()
 
-    async def notify_change(self, table, obj_id):
-        for key, data in self.last_sub.items():
-            data_table = data['dataField']
-            # TODO: check links
-            if table != data_table:
-                continue
+    async def handle_message(self, request):
+        try:
+            handler_resp = await self.handle_request(request)
 
-            if obj_id not in data.get('ids', []):
-                continue
+            await self.send(handler_resp)
+        except:
+            self.log.exception('Exception handling request: %s' % request)
 
-            await self.send_sub()
+    async def send(self, resp):
+        js = await self.encoder.encode(resp)
+        self.log.debug('.. Resp: %s' % js)
+        await self.ws.send(js)
 
-            break
+    async def send_encoded(self, js):
+        try:
+            await self.ws.send(js)
+        except:
+            self.log.exception('Exception sending: %s' % js)
 
 
 class GrozaServer(ABC):
@@ -123,6 +202,9 @@ class GrozaServer(ABC):
         self._notifications = notifications
         return self
 
+    async def close(self):
+        pass
+
     @abstractmethod
     async def notify_connection_start(self, conn: GrozaServerConnection):
         pass
@@ -132,15 +214,38 @@ class GrozaServer(ABC):
         pass
 
     @abstractmethod
-    async def notify_change(self, pid, channel, obj_id):
+    async def notify_change(self, pid, channel, obj_id,
+                            op=None, row=None, changed=None):
         pass
 
+    async def notify_changes(self, changes: List[GrozaChange]):
+        """
+        Notifies of a batch of changes. Servers override it to handle the
+        batch at once.
+        """
+        for change in changes:
+            await self.notify_change(*change)
+
 
 class SimpleGrozaServer(GrozaServer):
-    def __init__(self, name, transport: GrozaServerTransport):
+    def __init__(self, name, transport: GrozaServerTransport,
+                 coalesce_delay=0.05, coalesce_batch=1000,
+                 chunk_values=20000, monitor_lag=False):
         self._name = name
         self._log = build_logger('Server')
         self._conns: List[GrozaServerConnection] = []
+        self._index = GrozaSubIndex()
+        self._predicates = GrozaPredicateIndex()
+        self._encoder = GrozaEncoder(chunk_values=chunk_values)
+        self._groups = GrozaSubGroups(self._index,
+                                      coalesce_delay=coalesce_delay,
+                                      coalesce_batch=coalesce_batch,
+                                      encoder=self._encoder,
+                                      predicates=self._predicates)
+        self._handler: Optional[GrozaHandler] = None
+        # Measuring wakes the loop every interval: only when asked for
+        self.loop_lag: Optional[LoopLagMonitor] = \
+            LoopLagMonitor() if monitor_lag else None
 
         self._notifications: Optional[BaseQueue] = None
 
@@ -149,14 +254,86 @@ class SimpleGrozaServer(GrozaServer):
     async def install(self, notifications: BaseQueue) -> 'SimpleGrozaServer':
         self._notifications = notifications
         await self._transport.install(self)
+        if self.loop_lag is not None:
+            self.loop_lag.start()
         return self
 
+    async def close(self):
+        if self.loop_lag is not None:
+            self.loop_lag.stop()
+
     async def notify_connection_start(self, conn: GrozaServerConnection):
         self._conns.append(conn)
+        conn.groups = self._groups
+        conn.encoder = self._encoder
 
     async def notify_connection_close(self, conn: GrozaServerConnection):
         self._conns.remove(conn)
-
-    async def notify_change(self, pid, channel, obj_id):
-        for conn in self._conns:
-            await conn.notify_change(channel, obj_id)
+        self._groups.leave(conn)
+
+    async def notify_change(self, pid, channel, obj_id,
+                            op=None, row=None, changed=None):
+        await self.notify_changes(
+            [GrozaChange(pid, channel, obj_id, op, row, changed)])
+
+    async def notify_changes(self, changes: List[GrozaChange]):
+        """
+        Routes changes to subscriptions holding the rows, then to ones the
+        rows may join. Rows not carried by notifications are looked up
+        once per table for the batch.
+        """
+        matching = []
+        for change in changes:
+            # Copy: refreshing groups update the index while we iterate
+            watchers = list(self._index.lookup(change.channel,
+                                               change.obj_id).items())
+            for group, subs in watchers:
+                await group.notify_change(change.channel, change.obj_id, subs,
+                                          change)
+
+            if change.op != 'D' and self._predicates.watches(change.channel):
+                matching.append((change, dict(watchers)))
+
+        if not matching:
+            return
+
+        if self._handler is None:
+            self._handler = GrozaHandler()
+        rows = await self._fetch_rows([change for change, _ in matching
+                                       if change.row is None])
+        for change, routed in matching:
+            row = (change.row if change.row is not None
+                   else rows.get((change.channel, change.obj_id)))
+            if row is not None:
+                await self._notify_matching(change, row, routed)
+
+    async def _fetch_rows(self, changes: List[GrozaChange]):
+        """
+        Rows of `changes` by (channel, key), one query per channel.
+        """
+        keys = {}
+        for change in changes:
+            keys.setdefault(change.channel, {})[change.obj_id] = None
+
+        rows = {}
+        for channel, channel_keys in keys.items():
+            fetched = await self._handler.fetch_rows(channel,
+                                                     list(channel_keys))
+            rows.update(((channel, str(key)), row)
+                        for key, row in fetched.items())
+        return rows
+
+    async def _notify_matching(self, change: GrozaChange, row, routed):
+        """
+        Pushes `row` to subscriptions it matches and doesn't belong to
+        yet, like an inserted one.
+        """
+        key = self._handler.row_key(change.channel, row)
+        inline = change if change.row is not None else None
+
+        for group, subs in self._predicates.match(change.channel,
+                                                  row).items():
+            subs = subs - routed.get(group, set())
+            if subs:
+                await group.notify_match(change.channel, change.obj_id, subs,
+                                         row, inline, key=key)
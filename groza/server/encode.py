@@ -0,0 +1,148 @@
+import asyncio
+import time
+from itertools import islice
+from typing import Iterable, List, Optional
+
+from groza.utils import build_logger, json_codec, JsonCodec
+
+
+def estimate_values(resp) -> int:
+    """
+    Rough number of values in response table data, without walking rows.
+    """
+    data = resp.get('data') if isinstance(resp, dict) else None
+    if not isinstance(data, dict):
+        return 0
+
+    count = 0
+    for table in data.values():
+        if not table:
+            continue
+
+        if 'columns' in table and ('rows' in table or 'values' in table):
+            rows = table.get('rows')
+            if rows is None:
+                values = table['values']
+                rows = values[0] if values else []
+            count += len(rows) * len(table['columns'])
+        else:
+            count += len(table) * len(next(iter(table.values())))
+
+    return count
+
+
+def _slices(items: Iterable, size):
+    items = iter(items)
+    while True:
+        chunk = list(islice(items, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class GrozaEncoder:
+    """
+    Encodes responses with `codec`. Table data of responses estimated to
+    have more than `chunk_values` values is encoded in slices of about
+    that many values, giving the event loop a turn between slices.
+    """
+
+    def __init__(self, codec: Optional[JsonCodec] = None,
+                 chunk_values=20000):
+        self.codec: JsonCodec = codec if codec is not None else json_codec
+        self.chunk_values = chunk_values
+
+        self.inline_count = 0
+        self.chunked_count = 0
+
+    async def encode(self, resp) -> str:
+        if estimate_values(resp) <= self.chunk_values:
+            self.inline_count += 1
+            return self.codec.dumps(resp)
+
+        self.chunked_count += 1
+
+        # Pieces are joined once: copies of a large message are not free
+        dumps = self.codec.dumps
+        parts = ['{"data":{']
+        for cnt, (table, rows) in enumerate(resp['data'].items()):
+            parts.append(f'{"," if cnt else ""}{dumps(table)}:')
+            await self._encode_table(rows, parts)
+        parts.append('}')
+
+        rest = dumps({key: value for key, value in resp.items()
+                      if key != 'data'})
+        parts.append('}' if rest == '{}' else ',' + rest[1:])
+        return ''.join(parts)
+
+    async def _encode_table(self, table, parts: List[str]):
+        dumps = self.codec.dumps
+        if not table:
+            parts.append(dumps(table))
+            return
+
+        if 'columns' in table and ('rows' in table or 'values' in table):
+            # Column-major values are sliced by column
+            field = 'rows' if 'rows' in table else 'values'
+            size = (max(1, self.chunk_values // max(1, len(table['columns'])))
+                    if field == 'rows' else 1)
+            parts.append(f'{{"columns":{dumps(table["columns"])},'
+                         f'"{field}":[')
+            for cnt, chunk in enumerate(_slices(table[field], size)):
+                parts.append((',' if cnt else '') + dumps(chunk)[1:-1])
+                await asyncio.sleep(0)
+            parts.append(']}')
+            return
+
+        size = max(1, self.chunk_values
+                   // max(1, len(next(iter(table.values())))))
+        parts.append('{')
+        for cnt, chunk in enumerate(_slices(table.items(), size)):
+            parts.append((',' if cnt else '') + dumps(dict(chunk))[1:-1])
+            await asyncio.sleep(0)
+        parts.append('}')
+
+
+class LoopLagMonitor:
+    """
+    Measures how late the event loop wakes up from `interval` sleeps.
+    Lags over `warn_lag` seconds are logged.
+    """
+
+    def __init__(self, interval=0.1, warn_lag=0.1):
+        self.interval = interval
+        self.warn_lag = warn_lag
+        self.log = build_logger('Lag')
+
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self.warn_count = 0
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def stats(self):
+        return {
+            'lastLag': self.last_lag,
+            'maxLag': self.max_lag,
+            'warnCount': self.warn_count,
+        }
+
+    async def _run(self):
+        while True:
+            start = time.monotonic()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, time.monotonic() - start - self.interval)
+
+            self.last_lag = lag
+            self.max_lag = max(self.max_lag, lag)
+            if lag > self.warn_lag:
+                self.warn_count += 1
+                self.log.warning('Event loop lagged %.3f s' % lag)
@@ -0,0 +1,60 @@
+from typing import Dict, Iterable, List, Set
+
+
+class GrozaSubGraph:
+    """
+    Dependency graph of subscriptions by `fromSub` links. A change to rows
+    of a subscription can change rows of subscriptions linked to it, and
+    of those linked to them, but nothing up the links or aside.
+    """
+
+    def __init__(self, all_sub):
+        self.children: Dict[str, List[str]] = {}
+        for sub, sub_desc in all_sub.items():
+            link = sub_desc.get('fromSub')
+            if link is not None:
+                self.children.setdefault(link, []).append(sub)
+
+        # Link sources come before subscriptions linked to them
+        depth = {sub: self._depth(all_sub, sub) for sub in all_sub}
+        self.order: List[str] = sorted(all_sub, key=lambda sub: depth[sub])
+        self._recursive: Set[str] = {
+            sub for sub, sub_desc in all_sub.items()
+            if sub_desc.get('recursive')}
+        self._linked: Set[str] = {
+            sub for sub, sub_desc in all_sub.items()
+            if sub_desc.get('fromSub') is not None}
+
+    @staticmethod
+    def _depth(all_sub, sub):
+        depth = 0
+        seen = {sub}
+        link = all_sub[sub].get('fromSub')
+        while link is not None and link in all_sub and link not in seen:
+            seen.add(link)
+            depth += 1
+            link = all_sub[link].get('fromSub')
+        return depth
+
+    def is_simple(self, sub) -> bool:
+        """
+        Subscription is neither linked, nor a link source, nor recursive:
+        its changed rows are patched one by one.
+        """
+        return (sub not in self._linked and sub not in self.children
+                and sub not in self._recursive)
+
+    def downstream(self, subs: Iterable[str]) -> List[str]:
+        """
+        `subs` with everything linked to them, link sources first.
+        """
+        affected = set()
+        stack = list(subs)
+        while stack:
+            sub = stack.pop()
+            if sub in affected:
+                continue
+            affected.add(sub)
+            stack.extend(self.children.get(sub, ()))
+
+        return [sub for sub in self.order if sub in affected]
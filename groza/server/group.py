@@ -0,0 +1,363 @@
+import asyncio
+import hashlib
+import json
+from typing import Any, Dict, List, Optional, Set
+from uuid import UUID
+
+from groza import GrozaUser, GrozaChange
+from groza.server.encode import GrozaEncoder
+from groza.server.graph import GrozaSubGraph
+from groza.server.index import GrozaSubIndex
+from groza.server.predicates import GrozaPredicateIndex
+from groza.state import GrozaHandler, CHAIN_FIELDS
+from groza.utils import build_logger
+
+
+def _merge_change(old: Optional[GrozaChange],
+                  new: Optional[GrozaChange]) -> Optional[GrozaChange]:
+    """
+    Folds two changes of one key, None when the key has to be queried.
+    """
+    if new is None or new.changed is None:
+        return new
+
+    if old is None or old.op == 'D':
+        return None
+
+    if old.row is not None:
+        return new._replace(row={**old.row, **new.changed}, changed=None)
+
+    return new._replace(changed={**old.changed, **new.changed})
+
+
+class GrozaSubGroup:
+    """
+    Connections with equal subscription and user context. Changes are
+    fetched and encoded once per group and the same message is written to
+    every member.
+    """
+
+    def __init__(self, key, handler: GrozaHandler, user: GrozaUser, all_sub,
+                 index: Optional[GrozaSubIndex] = None,
+                 coalesce_delay=0.05, coalesce_batch=1000,
+                 data_format='object',
+                 encoder: Optional[GrozaEncoder] = None,
+                 predicates: Optional[GrozaPredicateIndex] = None):
+        self.key = key
+        self.handler: GrozaHandler = handler
+        self.user: GrozaUser = user
+        self.all_sub = all_sub
+        self.graph = GrozaSubGraph(all_sub)
+        self.data_format = data_format
+        self.last_sub = {}
+        self.members: List = []
+        self.index: Optional[GrozaSubIndex] = index
+        self.predicates: Optional[GrozaPredicateIndex] = predicates
+        self.log = build_logger('Group')
+        self.encoder = encoder if encoder is not None else GrozaEncoder()
+
+        # Changes arriving within `coalesce_delay` seconds are pushed at
+        # once, earlier if `coalesce_batch` notifications are pending
+        self.coalesce_delay = coalesce_delay
+        self.coalesce_batch = coalesce_batch
+        # Subscription -> key -> change with data, None to query the key
+        self._pending: Dict[str, Dict[Any, Optional[GrozaChange]]] = {}
+        # Linked subscription -> changed keys, re-queried down the links
+        self._pending_chain: Dict[str, Set] = {}
+        # Members are out of step: everything is fetched and pushed again
+        self._pending_refresh = False
+        # Linked subscription -> client name of its link field
+        self._link_fields: Dict[str, Optional[str]] = {}
+        # Link source -> set of its ids, dropped when the ids change
+        self._link_keys: Dict[str, Set] = {}
+        self._pending_count = 0
+        self._flush_task: Optional[asyncio.Task] = None
+        self._push_lock = asyncio.Lock()
+
+        self.push_count = 0
+        self.absorbed_count = 0
+        self.last_absorbed = 0
+
+    @staticmethod
+    def make_key(user: GrozaUser, all_sub, data_format='object') -> str:
+        js = json.dumps([user.user_id, all_sub, data_format], sort_keys=True,
+                        default=str)
+        return hashlib.sha1(js.encode('utf-8')).hexdigest()
+
+    def set_last_sub(self, last_sub):
+        self.last_sub = last_sub
+        self._link_keys = {}
+        if self.index is not None:
+            self.index.update(self, last_sub)
+        if self.predicates is not None:
+            self.predicates.update(self, [
+                (sub, last_sub[sub]['dataField'], sub_desc.get('where'))
+                for sub, sub_desc in self.all_sub.items()
+                if sub in last_sub and sub_desc.get('limit') is None
+            ])
+
+    async def send(self, resp):
+        js = await self.encoder.encode(resp)
+        self.log.debug('.. Push to %d: %s' % (len(self.members), js))
+        await asyncio.gather(*(member.send_encoded(js)
+                               for member in self.members))
+
+    async def send_sub(self):
+        resp = await self.handler.fetch_sub(self.user, self.all_sub,
+                                            data_format=self.data_format)
+        self.set_last_sub(resp.data['sub'])
+        await self.send(resp.data)
+
+    async def send_patch(self, touched, inline=None):
+        resp = await self.handler.fetch_patch(self.user, self.all_sub, touched,
+                                              inline=inline,
+                                              data_format=self.data_format,
+                                              last_sub=self.last_sub)
+        for sub, sub_patch in resp.data['sub'].items():
+            self._apply_patch(sub, sub_patch)
+        await self.send(resp.data)
+
+    async def send_chain(self, touched):
+        """
+        Re-queries subscriptions with `touched` rows and those linked to
+        them, leaving the rest of the subscription alone.
+        """
+        subs = self.graph.downstream(touched)
+        resp = await self.handler.fetch_chain(self.user, self.all_sub, subs,
+                                              self.last_sub, touched=touched,
+                                              data_format=self.data_format)
+        for sub, sub_patch in resp.data['sub'].items():
+            self._apply_patch(sub, sub_patch)
+        await self.send(resp.data)
+
+    async def notify_change(self, table, obj_id, subs,
+                            change: Optional[GrozaChange] = None, key=None):
+        """
+        Row `obj_id` of `table` watched by subscriptions `subs` has changed,
+        `key` is its typed primary key when known. The push is delayed to
+        merge with other changes of the window.
+        """
+        if key is None:
+            key = (self.index.typed_key(table, obj_id)
+                   if self.index is not None else obj_id)
+        inline = change if change is not None and change.is_inline \
+            else None
+        for sub in subs:
+            if not self._can_patch(sub):
+                self._pending_chain.setdefault(sub, set()).add(key)
+                continue
+
+            keys = self._pending.setdefault(sub, {})
+            keys[key] = (_merge_change(keys[key], inline) if key in keys
+                         else inline)
+
+        self._pending_count += 1
+
+        if self._pending_count >= self.coalesce_batch:
+            await self.flush()
+        elif self._flush_task is None:
+            self._flush_task = asyncio.ensure_future(self._flush_later())
+
+    async def notify_match(self, table, obj_id, subs, row,
+                           change: Optional[GrozaChange] = None, key=None):
+        """
+        Row `obj_id` of `table` not in subscriptions `subs` matches their
+        conditions. Linked subscriptions are re-queried only if the row
+        links to a row of their link source.
+        """
+        subs = {sub for sub in subs if self._may_link(sub, row)}
+        if subs:
+            await self.notify_change(table, obj_id, subs, change, key=key)
+
+    def refresh(self):
+        """
+        Schedules a fresh fetch of the whole subscription pushed to every
+        member, like when a joining member fetched a state the others
+        don't have.
+        """
+        self._pending_refresh = True
+        self._pending_count += 1
+        if self._flush_task is None:
+            self._flush_task = asyncio.ensure_future(self._flush_later())
+
+    async def flush(self):
+        """
+        Pushes pending changes as one refresh or patch.
+        """
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+
+        pending, chain, refresh, count = (
+            self._pending, self._pending_chain, self._pending_refresh,
+            self._pending_count)
+        self._pending, self._pending_chain = {}, {}
+        self._pending_refresh, self._pending_count = False, 0
+
+        if not count:
+            return
+
+        async with self._push_lock:
+            if refresh:
+                # Fresh state covers pending changes
+                pending, chain = {}, {}
+                await self.send_sub()
+
+            touched = {}
+            inline = {}
+            for sub, keys in pending.items():
+                if sub not in self.all_sub:
+                    continue
+
+                for key, change in keys.items():
+                    if change is None:
+                        touched.setdefault(sub, []).append(key)
+                    else:
+                        inline.setdefault(sub, {})[key] = change
+
+            chain = {sub: list(keys) for sub, keys in chain.items()
+                     if sub in self.all_sub}
+            if chain:
+                # One message per window: the chain re-query takes along
+                # rows that would go as a patch
+                for sub in set(touched) | set(inline):
+                    keys = chain.setdefault(sub, [])
+                    keys.extend(touched.get(sub, ()))
+                    keys.extend(inline.get(sub, {}))
+                await self.send_chain(chain)
+            elif touched or inline:
+                await self.send_patch(touched, inline)
+
+        self.push_count += 1
+        self.absorbed_count += count
+        self.last_absorbed = count
+        self.log.debug('Push absorbed %d notifications' % count)
+
+    def close(self):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+
+        if self.index is not None:
+            self.index.remove(self)
+        if self.predicates is not None:
+            self.predicates.remove(self)
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.coalesce_delay)
+        self._flush_task = None
+        try:
+            await self.flush()
+        except:
+            self.log.exception('Exception pushing changes')
+
+    def _can_patch(self, sub):
+        """
+        Patches don't follow links: subscription must be neither linked
+        nor a link source. Others are re-queried with `send_chain`.
+        """
+        return sub in self.all_sub and self.graph.is_simple(sub)
+
+    def _may_link(self, sub, row):
+        """
+        `row` links to a row of the link source of `sub`, if it has one.
+        Ids of recursive link sources leave out nested rows: any row may.
+        """
+        link = self.all_sub.get(sub, {}).get('fromSub')
+        if (link is None or link not in self.last_sub
+                or self.all_sub[link].get('recursive')):
+            return True
+
+        if sub not in self._link_fields:
+            self._link_fields[sub] = self.handler.link_field(self.all_sub,
+                                                             sub)
+        field = self._link_fields[sub]
+        if field is None:
+            return True
+
+        keys = self._link_keys.get(link)
+        if keys is None:
+            keys = self._link_keys[link] = set(self.last_sub[link]['ids'])
+        value = row.get(field)
+        if isinstance(value, UUID):
+            value = str(value)
+        return value in keys
+
+    def _apply_patch(self, sub, sub_patch):
+        last = self.last_sub[sub]
+        self._link_keys.pop(sub, None)
+        table = last['dataField']
+
+        remove_ids = set(sub_patch['removeIds'])
+        if remove_ids:
+            last['ids'] = [i for i in last['ids'] if i not in remove_ids]
+            if self.index is not None:
+                self.index.discard(self, sub, table, remove_ids)
+
+        add_ids = sub_patch['addIds']
+        if add_ids:
+            last['ids'].extend(add_ids)
+            if self.index is not None:
+                self.index.add(self, sub, table, add_ids)
+
+        for field in CHAIN_FIELDS:
+            if field in sub_patch:
+                last[field] = sub_patch[field]
+
+
+class GrozaSubGroups:
+    """
+    Server-wide registry of subscription groups.
+    """
+
+    def __init__(self, index: Optional[GrozaSubIndex] = None,
+                 coalesce_delay=0.05, coalesce_batch=1000,
+                 encoder: Optional[GrozaEncoder] = None,
+                 predicates: Optional[GrozaPredicateIndex] = None):
+        self._groups: Dict[str, GrozaSubGroup] = {}
+        self._index: Optional[GrozaSubIndex] = index
+        self._encoder: Optional[GrozaEncoder] = encoder
+        self._predicates: Optional[GrozaPredicateIndex] = predicates
+        self._coalesce_delay = coalesce_delay
+        self._coalesce_batch = coalesce_batch
+
+    def join(self, conn, last_sub) -> GrozaSubGroup:
+        """
+        Moves `conn` to the group of its current user and subscription.
+        `last_sub` is the freshly fetched state of the subscription.
+        """
+        self.leave(conn)
+
+        key = GrozaSubGroup.make_key(conn.user, conn.all_sub, conn.data_format)
+        group = self._groups.get(key)
+        if group is None:
+            group = GrozaSubGroup(key, conn.handler, conn.user, conn.all_sub,
+                                  index=self._index,
+                                  coalesce_delay=self._coalesce_delay,
+                                  coalesce_batch=self._coalesce_batch,
+                                  data_format=conn.data_format,
+                                  encoder=self._encoder,
+                                  predicates=self._predicates)
+            self._groups[key] = group
+            group.set_last_sub(last_sub)
+        elif group.last_sub != last_sub:
+            # Patches are computed against the state members have
+            group.refresh()
+
+        group.members.append(conn)
+        conn.group = group
+        return group
+
+    def leave(self, conn):
+        group: GrozaSubGroup = conn.group
+        if group is None:
+            return
+
+        conn.group = None
+        group.members.remove(conn)
+        if not group.members:
+            group.close()
+            self._groups.pop(group.key, None)
+
+    def __len__(self):
+        return len(self._groups)
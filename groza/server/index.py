@@ -0,0 +1,73 @@
+from typing import Any, Dict, Set, Tuple
+
+
+class GrozaSubIndex:
+    """
+    Server-wide inverted index: (table, primary key) -> watchers of the row
+    with names of their subscriptions containing it.
+    """
+
+    def __init__(self):
+        self._rows: Dict[Tuple[str, str], Dict[Any, Set[str]]] = {}
+        self._watched: Dict[Any, Set[Tuple[str, str]]] = {}
+        self._typed: Dict[Tuple[str, str], Any] = {}
+
+    @staticmethod
+    def make_key(table, obj_id) -> Tuple[str, str]:
+        # Notifications carry keys as text, subscriptions as typed values
+        return table, str(obj_id)
+
+    def update(self, watcher, sub: dict):
+        """
+        Replaces everything watched by `watcher` with ids of `sub`.
+        """
+        self.remove(watcher)
+
+        for sub_name, sub_data in sub.items():
+            self.add(watcher, sub_name, sub_data['dataField'],
+                     sub_data.get('ids', []))
+
+    def add(self, watcher, sub_name, table, ids):
+        watched = self._watched.setdefault(watcher, set())
+        for obj_id in ids:
+            key = self.make_key(table, obj_id)
+            self._rows.setdefault(key, {}).setdefault(watcher, set()) \
+                .add(sub_name)
+            self._typed[key] = obj_id
+            watched.add(key)
+
+    def discard(self, watcher, sub_name, table, ids):
+        watched = self._watched.get(watcher, set())
+        for obj_id in ids:
+            key = self.make_key(table, obj_id)
+            watchers = self._rows.get(key, {})
+            subs = watchers.get(watcher, set())
+            subs.discard(sub_name)
+            if not subs:
+                watchers.pop(watcher, None)
+                watched.discard(key)
+            if not watchers:
+                self._drop(key)
+
+    def remove(self, watcher):
+        for key in self._watched.pop(watcher, ()):
+            watchers = self._rows[key]
+            watchers.pop(watcher, None)
+            if not watchers:
+                self._drop(key)
+
+    def lookup(self, table, obj_id) -> Dict[Any, Set[str]]:
+        return self._rows.get(self.make_key(table, obj_id), {})
+
+    def typed_key(self, table, obj_id):
+        """
+        Primary key value as it was in subscription ids.
+        """
+        return self._typed.get(self.make_key(table, obj_id), obj_id)
+
+    def _drop(self, key):
+        self._rows.pop(key, None)
+        self._typed.pop(key, None)
+
+    def __len__(self):
+        return len(self._rows)
@@ -0,0 +1,102 @@
+from typing import Any, Dict, List, Set, Tuple
+
+from groza.state import where_matches
+from groza.utils import json_value
+
+
+def _hashable(value):
+    try:
+        hash(value)
+    except TypeError:
+        return False
+    return True
+
+
+class GrozaPredicateIndex:
+    """
+    Server-wide index of subscription conditions: finds subscriptions a
+    changed row matches, even if they don't contain the row yet.
+    Conditions are indexed by table and one equality field, so a row is
+    checked only against subscriptions having its value of that field.
+    Values are indexed as clients get them: typed values of rows find
+    conditions on their JSON values.
+    """
+
+    def __init__(self):
+        # table -> (field, value) or None for unconditioned -> entries
+        self._tables: Dict[str, Dict[Any, List[tuple]]] = {}
+        # table -> field -> number of entries indexed by it
+        self._fields: Dict[str, Dict[str, int]] = {}
+        self._watched: Dict[Any, List[Tuple[str, Any, tuple]]] = {}
+
+    def update(self, watcher, subs):
+        """
+        Replaces conditions of `watcher` with (subscription name, table,
+        where) `subs`.
+        """
+        self.remove(watcher)
+
+        watched = []
+        for sub_name, table, where in subs:
+            where = where or {}
+            bucket = None
+            for field, value in where.items():
+                value = json_value(value)
+                if _hashable(value):
+                    bucket = (field, value)
+                    break
+
+            entry = (watcher, sub_name, where)
+            self._tables.setdefault(table, {}).setdefault(bucket, []) \
+                .append(entry)
+            if bucket is not None:
+                fields = self._fields.setdefault(table, {})
+                fields[bucket[0]] = fields.get(bucket[0], 0) + 1
+            watched.append((table, bucket, entry))
+
+        if watched:
+            self._watched[watcher] = watched
+
+    def remove(self, watcher):
+        for table, bucket, entry in self._watched.pop(watcher, ()):
+            buckets = self._tables[table]
+            buckets[bucket].remove(entry)
+            if not buckets[bucket]:
+                del buckets[bucket]
+            if not buckets:
+                del self._tables[table]
+
+            if bucket is not None:
+                fields = self._fields[table]
+                fields[bucket[0]] -= 1
+                if not fields[bucket[0]]:
+                    del fields[bucket[0]]
+                if not fields:
+                    del self._fields[table]
+
+    def watches(self, table) -> bool:
+        return table in self._tables
+
+    def match(self, table, row) -> Dict[Any, Set[str]]:
+        """
+        Watchers with names of their subscriptions `row` of `table` matches.
+        """
+        buckets = self._tables.get(table)
+        if not buckets:
+            return {}
+
+        candidates = list(buckets.get(None, ()))
+        for field in self._fields.get(table, {}):
+            value = json_value(row.get(field))
+            if field in row and _hashable(value):
+                candidates.extend(buckets.get((field, value), ()))
+
+        matched: Dict[Any, Set[str]] = {}
+        for watcher, sub_name, where in candidates:
+            if where_matches(where, row):
+                matched.setdefault(watcher, set()).add(sub_name)
+        return matched
+
+    def __len__(self):
+        return sum(len(entries) for buckets in self._tables.values()
+                   for entries in buckets.values())
@@ -0,0 +1,71 @@
+import asyncio
+from typing import Awaitable, Callable, Dict, Set
+
+
+class GrozaRequestScheduler:
+    """
+    Runs requests of one connection concurrently, no more than `limit` at
+    a time. Requests of one lane keep their order: subscriptions replace
+    each other and load their pages, writes are applied as submitted.
+    Subscriptions also wait for writes submitted before them, so they read
+    what the client wrote, while writes don't wait for subscriptions.
+    Authentication requests change the user of the connection and run
+    alone, after everything submitted before them.
+    """
+
+    LANES = {
+        'sub': 'sub',
+        'more': 'sub',
+        'insert': 'write',
+        'update': 'write',
+        'delete': 'write',
+    }
+    # Lane -> other lanes whose earlier requests it waits for
+    WAITS = {
+        'sub': ('write',),
+    }
+    BARRIERS = ('login', 'register', 'auth')
+
+    def __init__(self, run: Callable[[dict], Awaitable], limit=4):
+        self._run = run
+        self._slots = asyncio.Semaphore(limit)
+        self._tasks: Set[asyncio.Future] = set()
+        self._lane_tails: Dict[str, asyncio.Future] = {}
+
+    async def submit(self, request):
+        """
+        Schedules `request`. Waits while `limit` requests are in flight,
+        so a flooding client is not read further.
+        """
+        req_type = request.get('type') if isinstance(request, dict) else None
+        if req_type in self.BARRIERS:
+            await self.drain()
+            await self._run(request)
+            return
+
+        await self._slots.acquire()
+
+        lane = self.LANES.get(req_type)
+        previous = [self._lane_tails[waited]
+                    for waited in (lane,) + self.WAITS.get(lane, ())
+                    if waited in self._lane_tails]
+        task = asyncio.ensure_future(self._run_after(previous, request))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        if lane is not None:
+            self._lane_tails[lane] = task
+
+    async def drain(self):
+        while self._tasks:
+            await asyncio.wait(list(self._tasks))
+
+    def __len__(self):
+        return len(self._tasks)
+
+    async def _run_after(self, previous, request):
+        try:
+            if previous:
+                await asyncio.wait(previous)
+            await self._run(request)
+        finally:
+            self._slots.release()
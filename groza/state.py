@@ -1,12 +1,237 @@
+import asyncio
+from datetime import date, datetime
 from uuid import UUID
 
 from groza import GrozaRequest, GrozaResponse
 from groza.auth.debug import DebugAuth
 
-from groza.storage import GrozaStorage, groza_db, groza_visors, GrozaVisor
+from groza.storage import GrozaStorage, groza_db, groza_visors, \
+    GrozaVisor, link_ids_source
+from groza.utils import json_value
+
+
+def _make_key(key):
+    if isinstance(key, UUID):
+        key = str(key)
+    return key
+
+
+def _visor_runs(items, get_visor):
+    """
+    Splits items into runs of consecutive items of the same visor, so
+    they can be written together keeping the order.
+    """
+    runs = []
+    for item in items:
+        visor_name = get_visor(item)
+        if runs and runs[-1][0] == visor_name:
+            runs[-1][1].append(item)
+        else:
+            runs.append((visor_name, [item]))
+    return runs
+
+
+def where_matches(where, row, partial=False):
+    """
+    Checks subscription `where` against `row` with client field names.
+    With `partial` fields missing in `row` are considered matching.
+    Typed values of `row` are compared as clients get them.
+    """
+    for field, value in (where or {}).items():
+        if field not in row:
+            if partial:
+                continue
+            return False
+
+        if json_value(row[field]) != json_value(value):
+            return False
+
+    return True
+
+
+def _check_sub_links(all_sub):
+    """
+    Subscriptions linked with `fromSub` must not make a cycle.
+    """
+    for sub in all_sub:
+        seen = set()
+        link = sub
+        while link is not None:
+            if link in seen:
+                raise RuntimeError(f'Links of "{sub}" make a cycle')
+            seen.add(link)
+            link = all_sub.get(link, {}).get('fromSub')
+
+
+def _link_wait(all_sub, sub, subquery_depth):
+    """
+    Subscription whose results are needed to query `sub`: its link source
+    or, when storage queries links by subqueries, the one whose ids the
+    query uses.
+    """
+    link = all_sub[sub].get('fromSub')
+    if not subquery_depth:
+        return link
+    return link_ids_source(all_sub, link, subquery_depth)
+
+
+def _cursor_fields(sub_desc, key_field):
+    """
+    Fields of the keyset cursor of a paged subscription: order fields and
+    the primary key `key_field`, client names of row fields.
+    """
+    fields = list(sub_desc.get('order') or {})
+    if key_field not in fields:
+        fields.append(key_field)
+    return fields
+
+
+# Cursor values JSON would send lossy, like datetimes as epoch seconds,
+# are sent tagged: {'type': name, 'value': text}
+CURSOR_TYPES = {
+    'datetime': (datetime, datetime.isoformat, datetime.fromisoformat),
+    'date': (date, date.isoformat, date.fromisoformat),
+    'uuid': (UUID, str, UUID),
+}
+
+
+def _encode_cursor(values):
+    encoded = []
+    for value in values:
+        for name, (cls, encode, _) in CURSOR_TYPES.items():
+            # Datetimes are dates too
+            if type(value) is cls:
+                value = {'type': name, 'value': encode(value)}
+                break
+        encoded.append(value)
+    return encoded
+
+
+def _decode_cursor(values):
+    """
+    Cursor values sent by `_encode_cursor` with their types back.
+    """
+    if values is None:
+        return None
+    if not isinstance(values, list):
+        raise RuntimeError(f'Invalid cursor: {values}')
+
+    decoded = []
+    for value in values:
+        if isinstance(value, dict):
+            cursor_type = CURSOR_TYPES.get(value.get('type'))
+            if cursor_type is None:
+                raise RuntimeError(f'Invalid cursor value: {value}')
+            try:
+                value = cursor_type[2](value.get('value'))
+            except (AttributeError, TypeError, ValueError):
+                raise RuntimeError(f'Invalid cursor value: {value}')
+        decoded.append(value)
+    return decoded
+
+
+def _page(add_data, limit, cursor_fields):
+    """
+    Cuts the extra row queried to know if there are more rows, returns
+    paging state of the subscription.
+    """
+    has_more = len(add_data) > limit
+    if has_more:
+        add_data.pop(next(reversed(add_data)))
+
+    cursor = None
+    if add_data:
+        last = add_data[next(reversed(add_data))]
+        cursor = _encode_cursor([last[field] for field in cursor_fields])
+
+    return {'cursor': cursor, 'hasMore': has_more}
+
+
+def _merge_rows(table_data, rows):
+    """
+    Adds `rows` of subscriptions to `table_data` of their table. A row
+    shared by several subscriptions keeps fields each of them added, like
+    injected `recursive` children lists, whichever is merged first.
+    """
+    for key, row in rows.items():
+        known = table_data.get(key)
+        if known is None:
+            table_data[key] = row
+            continue
+
+        merged = {**known, **row}
+        for field, value in row.items():
+            known_value = known.get(field)
+            if (isinstance(value, list) and isinstance(known_value, list)
+                    and value is not known_value):
+                merged[field] = known_value + [item for item in value
+                                               if item not in known_value]
+        table_data[key] = merged
+
+
+# Subscription state replaced as a whole when a chain is re-queried
+CHAIN_FIELDS = ('fromSub', 'cursor', 'hasMore', 'total')
+
+# Layouts of table data in responses: 'object' - key -> row object,
+# 'rows' - column names and row value arrays, 'columns' - column names and
+# value arrays of each column
+DATA_FORMATS = ('object', 'rows', 'columns')
+
+
+def _encode_data(data, data_format):
+    """
+    Lays out `data` (table -> key -> row) in `data_format`. Column names are
+    sent once per table instead of once per row.
+    """
+    if data_format == 'object':
+        return data
+
+    encoded = {}
+    for table, rows in data.items():
+        columns = {}
+        for row in rows.values():
+            if row.keys() != columns.keys():
+                columns.update(dict.fromkeys(row))
+        columns = list(columns)
+
+        values = [[row.get(column) for column in columns]
+                  for row in rows.values()]
+        if data_format == 'columns':
+            encoded[table] = {
+                'columns': columns,
+                'values': ([list(column) for column in zip(*values)]
+                           if values else [[] for _ in columns]),
+            }
+        else:
+            encoded[table] = {'columns': columns, 'rows': values}
+
+    return encoded
+
+
+def _encode_changed(changed, data_format):
+    """
+    Lays out partial rows of `changed` (table -> key -> fields) in
+    `data_format`. Fields left out of a row are not nulls, so each table
+    goes as a list of blocks of rows with the same fields.
+    """
+    if data_format == 'object':
+        return changed
+
+    encoded = {}
+    for table, rows in changed.items():
+        blocks = {}
+        for key, row in rows.items():
+            blocks.setdefault(tuple(row), {})[key] = row
+        encoded[table] = [_encode_data({table: block}, data_format)[table]
+                          for block in blocks.values()]
+
+    return encoded
 
 
 class GrozaHandler:
+    # Subscription queries of one `fetch_sub` running at once
+    SUB_PARALLEL = 4
+
     def __init__(self):
         # self.tables = tables
         self._storage: GrozaStorage = groza_db.get()
@@ -27,90 +252,469 @@ class GrozaHandler:
         # user = self.auth.register(request)
         return GrozaResponse({}, request=request)
 
-    async def fetch_sub(self, user, all_sub):
+    async def fetch_sub(self, user, all_sub, data_format='object'):
+        """
+        Queries subscriptions as a graph of `fromSub` links: each one runs
+        in its own session as soon as results it depends on are fetched,
+        at most `SUB_PARALLEL` at a time.
+        """
         resp = {}
         data = {}
         errors = []
 
         sub_resp = {}
 
-        async with self._storage.session() as session:
-            for sub, sub_desc in all_sub.items():
-                visor_name = sub_desc['visor']
-                # if table not in self.tables:
-                #     errors.append(f'Table '{table}' is not handled')
-                #     continue
-                #
-                # sub_table = self.tables[table]
-
-                visor = self._get_visor(visor_name)
-
-                sub_desc_from = sub_desc.get('fromSub')
-                add_data, link_field = await session.query(
-                    visor=visor,
-                    from_sub=sub_desc_from,
-                    where=sub_desc.get('where'),
-                    order=sub_desc.get('order'),
-                    all_sub=all_sub,
-                    sub_resp=sub_resp,
-                )
-
-                primary_key_field = visor.primary_key
+        _check_sub_links(all_sub)
 
-                def make_key(key):
-                    if isinstance(key, UUID):
-                        key = str(key)
-                    return key
+        sub_data = await self._query_subs(all_sub, all_sub, sub_resp)
+        for sub in all_sub:
+            _merge_rows(data.setdefault(sub_resp[sub]['dataField'], {}),
+                        sub_data[sub])
 
-                table = visor.table
+        resp['type'] = 'data'
+        resp['data'] = _encode_data(data, data_format)
+        resp['sub'] = {sub: sub_resp[sub] for sub in all_sub}
+        if data_format != 'object':
+            resp['format'] = data_format
 
-                data.setdefault(table, {})
-                data[table].update(add_data)
+        if errors:
+            resp['errors'] = errors
 
-                ids = []
-                recursive_field, recursive_inject = sub_desc.get('recursive',
-                                                                 (None, None))
+        return GrozaResponse(resp)
 
-                assert (recursive_field is None and recursive_inject is None
-                     or recursive_field is not None
-                        and recursive_inject is not None)
+    async def fetch_chain(self, user, all_sub, subs, last_sub, touched=None,
+                          data_format='object'):
+        """
+        Re-queries `subs`, a part of `all_sub` closed down the links, as a
+        patch against `last_sub`. Link sources outside `subs` are taken
+        from `last_sub`.
+
+        :param touched: subscription name -> primary keys of changed rows,
+            sent whether or not they joined the subscription
+        :return: `patch` response with rows joining subscriptions, touched
+            ones and new `fromSub` maps
+        """
+        data = {}
+        sub_resp = {sub: last_sub[sub] for sub in all_sub
+                    if sub not in subs and sub in last_sub}
+        sub_data = await self._query_subs(all_sub, subs, sub_resp)
+
+        patch = {}
+        for sub in subs:
+            fresh = sub_resp[sub]
+            known = set(last_sub[sub]['ids'])
+            ids = set(fresh['ids'])
+            add_ids = [key for key in fresh['ids'] if key not in known]
+
+            # Nested rows of recursive subscriptions are not in ids
+            if all_sub[sub].get('recursive'):
+                rows = sub_data[sub]
+            else:
+                keys = set(add_ids)
+                keys.update(_make_key(key)
+                            for key in (touched or {}).get(sub, ()))
+                rows = {key: row for key, row in sub_data[sub].items()
+                        if key in keys}
+            _merge_rows(data.setdefault(fresh['dataField'], {}), rows)
+
+            patch[sub] = {
+                'status': 'ok',
+                'dataField': fresh['dataField'],
+                'addIds': add_ids,
+                'removeIds': [key for key in last_sub[sub]['ids']
+                              if key not in ids],
+                **{field: fresh[field] for field in CHAIN_FIELDS
+                   if field in fresh},
+            }
+
+        resp = {
+            'type': 'patch',
+            'data': _encode_data(data, data_format),
+            'sub': patch,
+        }
+        if data_format != 'object':
+            resp['format'] = data_format
 
-                if recursive_field:
-                    for key in add_data.keys():
-                        add_data[key].setdefault(recursive_inject, [])
+        return GrozaResponse(resp)
 
+    async def _query_subs(self, all_sub, subs, sub_resp):
+        """
+        Queries `subs` of `all_sub` filling `sub_resp`.
+
+        :return: subscription name -> its rows by primary key
+        """
+        sub_data = {}
+        slots = asyncio.Semaphore(self.SUB_PARALLEL)
+        tasks = {}
+
+        async def fetch_node(sub, sub_desc):
+            sub_desc_from = sub_desc.get('fromSub')
+            wait = _link_wait(all_sub, sub,
+                              self._storage.link_subquery_depth)
+            if wait in tasks:
+                await tasks[wait]
+
+            visor_name = sub_desc['visor']
+            visor = self._get_visor(visor_name)
+
+            # Recursive subscriptions are not paged
+            limit = (None if sub_desc.get('recursive')
+                     else sub_desc.get('limit'))
+            total = sub_desc.get('total', 'none')
+
+            async with slots:
+                async with self._storage.session() as session:
+                    add_data, link_field = await session.query(
+                        visor=visor,
+                        from_sub=sub_desc_from,
+                        where=sub_desc.get('where'),
+                        order=sub_desc.get('order'),
+                        all_sub=all_sub,
+                        sub_resp=sub_resp,
+                        recursive=sub_desc.get('recursive'),
+                        recursive_depth=sub_desc.get('recursiveDepth'),
+                        limit=(limit * sub_desc.get('pages', 1) + 1
+                               if limit is not None else None),
+                        after=(_decode_cursor(sub_desc.get('after'))
+                               if limit is not None else None),
+                    )
+
+                    count = None
+                    if total in ('exact', 'estimate'):
+                        count = await session.count(
+                            visor=visor,
+                            from_sub=sub_desc_from,
+                            where=sub_desc.get('where'),
+                            all_sub=all_sub,
+                            sub_resp=sub_resp,
+                            estimate=total == 'estimate',
+                        )
+
+            page = (_page(add_data, limit * sub_desc.get('pages', 1),
+                          _cursor_fields(sub_desc, self._storage.from_db(
+                              visor.primary_key)))
+                    if limit is not None else None)
+
+            primary_key_field = visor.primary_key
+
+            table = visor.table
+            sub_data[sub] = add_data
+
+            ids = []
+            recursive_field, recursive_inject = sub_desc.get('recursive',
+                                                             (None, None))
+
+            assert (recursive_field is None and recursive_inject is None
+                 or recursive_field is not None
+                    and recursive_inject is not None)
+
+            if recursive_field:
+                for key in add_data.keys():
+                    add_data[key].setdefault(recursive_inject, [])
+
+            for key, item in add_data.items():
+                # Rows with parents outside of the results are roots
+                parent = (_make_key(item.get(recursive_field))
+                          if recursive_field else None)
+                if parent is not None and parent in add_data:
+                    inject_to = add_data[parent]
+                    inject_to.setdefault(recursive_inject, [])
+                    inject_to[recursive_inject].append(
+                        item[primary_key_field])
+                    continue
+
+                ids.append(_make_key(item[primary_key_field]))
+
+            from_sub = {}
+            if sub_desc_from is not None:
                 for key, item in add_data.items():
-                    if recursive_field and item.get(recursive_field):
-                        inject_to = data[table][item[recursive_field]]
-                        inject_to.setdefault(recursive_inject, [])
-                        inject_to[recursive_inject].append(
-                            item[primary_key_field])
-                        continue
+                    lf = item[link_field]
+
+                    from_sub.setdefault(lf, [])
+                    from_sub[lf].append(item[primary_key_field])
+
+            sub_resp[sub] = {
+                'status': 'ok',
+                'dataField': table,
+                'ids': ids,
+            }
+
+            sub_resp[sub]['fromSub'] = from_sub
+
+            if page is not None:
+                sub_resp[sub].update(page)
+            if count is not None:
+                sub_resp[sub]['total'] = count
+
+        # All tasks exist before any of them looks up its link source
+        for sub in subs:
+            tasks[sub] = asyncio.ensure_future(fetch_node(sub, all_sub[sub]))
+
+        try:
+            await asyncio.gather(*tasks.values())
+        except:
+            for task in tasks.values():
+                task.cancel()
+            raise
+
+        return sub_data
+
+    async def stream_sub(self, user, all_sub, send, chunk_rows=1000,
+                         data_format='object'):
+        """
+        Fetches subscriptions one by one, sending rows with `send` in
+        numbered `data-chunk` frames of up to `chunk_rows` rows as they are
+        read. Storage reads the next chunk after `send` returns.
+
+        :return: `data` response with subscription states, without rows
+        """
+        _check_sub_links(all_sub)
+
+        for sub, sub_desc in all_sub.items():
+            if sub_desc.get('recursive') or sub_desc.get('limit') is not None:
+                return GrozaResponse({'status': 'error',
+                                      'message': f'Subscription "{sub}" '
+                                                 f'can\'t be streamed'})
 
-                    ids.append(make_key(item[primary_key_field]))
+        sub_resp = {}
+        chunk = 0
 
-                from_sub = {}
-                if sub_desc_from is not None:
-                    for key, item in add_data.items():
-                        lf = item[link_field]
+        async with self._storage.session() as session:
+            for sub, sub_desc in all_sub.items():
+                visor = self._get_visor(sub_desc['visor'])
+                table = visor.table
+                primary_key_field = visor.primary_key
+                sub_desc_from = sub_desc.get('fromSub')
 
-                        from_sub.setdefault(lf, [])
-                        from_sub[lf].append(item[primary_key_field])
+                ids = []
+                from_sub = {}
+                chunks = session.query_chunks(
+                    visor=visor,
+                    from_sub=sub_desc_from,
+                    where=sub_desc.get('where'),
+                    order=sub_desc.get('order'),
+                    all_sub=all_sub,
+                    sub_resp=sub_resp,
+                    chunk_rows=chunk_rows)
+                # A failed send closes the storage cursor right away
+                try:
+                    async for add_data, link_field in chunks:
+                        for key, item in add_data.items():
+                            ids.append(_make_key(item[primary_key_field]))
+                            if sub_desc_from is not None:
+                                from_sub.setdefault(
+                                    item[link_field], []).append(
+                                    item[primary_key_field])
+
+                        frame = {
+                            'type': 'data-chunk',
+                            'chunk': chunk,
+                            'sub': sub,
+                            'data': _encode_data({table: add_data},
+                                                 data_format),
+                        }
+                        if data_format != 'object':
+                            frame['format'] = data_format
+                        await send(frame)
+                        chunk += 1
+                finally:
+                    await chunks.aclose()
 
                 sub_resp[sub] = {
                     'status': 'ok',
                     'dataField': table,
                     'ids': ids,
+                    'fromSub': from_sub,
                 }
 
-                sub_resp[sub]['fromSub'] = from_sub
+        return GrozaResponse({
+            'type': 'data',
+            'data': {},
+            'sub': sub_resp,
+            'chunks': chunk,
+        })
+
+    async def fetch_rows(self, table, keys):
+        """
+        Rows of `table` by primary keys as notifications carry them.
+        """
+        visor = self._storage.channel_visor(table)
+        if visor is None:
+            return {}
 
-        resp['type'] = 'data'
-        resp['data'] = data
-        resp['sub'] = sub_resp
+        async with self._storage.session() as session:
+            return await session.query_keys(visor=visor, keys=keys)
+
+    def link_field(self, all_sub, sub):
+        """
+        Field of `sub` rows, with client name, holding keys of its
+        `fromSub` link source rows.
+        """
+        link = all_sub[sub].get('fromSub')
+        if link is None or link not in all_sub:
+            return None
+
+        visor = self._get_visor(all_sub[sub]['visor'])
+        field = visor.link_field(self._get_visor(all_sub[link]['visor']))
+        return self._storage.from_db(field) if field else None
+
+    def row_key(self, table, row):
+        """
+        Primary key of `row` of `table` with client field names.
+        """
+        visor = self._storage.channel_visor(table)
+        if visor is None:
+            return None
+        return row.get(self._storage.from_db(visor.primary_key))
+
+    async def fetch_more(self, user, all_sub, sub, last_sub,
+                         data_format='object'):
+        """
+        Fetches the next page of paged subscription `sub` after the cursor
+        of its `last_sub` state.
+
+        :return: `more` response with rows and ids added to subscription
+        """
+        sub_desc = all_sub[sub]
+        last = last_sub[sub]
+        visor = self._get_visor(sub_desc['visor'])
+        limit = sub_desc.get('limit')
+        if limit is None or sub_desc.get('recursive'):
+            return GrozaResponse({'status': 'error',
+                                  'message': f'Subscription "{sub}" '
+                                             f'is not paged'})
+
+        add_data = {}
+        if last.get('hasMore') and last.get('cursor') is not None:
+            async with self._storage.session() as session:
+                add_data, _ = await session.query(
+                    visor=visor,
+                    from_sub=sub_desc.get('fromSub'),
+                    where=sub_desc.get('where'),
+                    order=sub_desc.get('order'),
+                    all_sub=all_sub,
+                    sub_resp=last_sub,
+                    limit=limit + 1,
+                    after=_decode_cursor(last['cursor']),
+                )
 
-        if errors:
-            resp['errors'] = errors
+        page = _page(add_data, limit, _cursor_fields(
+            sub_desc, self._storage.from_db(visor.primary_key)))
+        if page['cursor'] is None:
+            page['cursor'] = last.get('cursor')
+
+        resp = {
+            'type': 'more',
+            'data': _encode_data({visor.table: add_data}, data_format),
+            'sub': {sub: {
+                'status': 'ok',
+                'dataField': visor.table,
+                'addIds': [_make_key(item[visor.primary_key])
+                           for item in add_data.values()],
+                **page,
+            }},
+        }
+        if data_format != 'object':
+            resp['format'] = data_format
+
+        return GrozaResponse(resp)
+
+    async def fetch_patch(self, user, all_sub, touched, inline=None,
+                          data_format='object', last_sub=None):
+        """
+        Re-queries only touched rows of subscriptions.
+
+        :param touched: subscription name -> primary keys of changed rows
+        :param inline: subscription name -> primary key -> `GrozaChange`
+            carrying its data, applied without queries
+        :param data_format: layout of `data`, one of `DATA_FORMATS`
+        :param last_sub: current subscription state; with it rows new to
+            subscriptions are added to them and only known ids are removed
+        :return: `patch` response with fresh rows and ids left subscriptions
+        """
+        data = {}
+        changed = {}
+        sub_resp = {}
+        # Subscription -> keys of rows matching it
+        matched = {}
+
+        def sub_patch(sub, table):
+            return sub_resp.setdefault(sub, {
+                'status': 'ok',
+                'dataField': table,
+                'addIds': [],
+                'removeIds': [],
+            })
+
+        if touched:
+            async with self._storage.session() as session:
+                for sub, keys in touched.items():
+                    sub_desc = all_sub[sub]
+                    visor = self._get_visor(sub_desc['visor'])
+
+                    add_data, _ = await session.query(
+                        visor=visor,
+                        from_sub=None,
+                        where=sub_desc.get('where'),
+                        all_sub=all_sub,
+                        sub_resp={},
+                        keys=keys,
+                    )
+
+                    table = visor.table
+                    data.setdefault(table, {})
+                    data[table].update(add_data)
+                    matched.setdefault(sub, []).extend(add_data)
+
+                    sub_patch(sub, table)['removeIds'].extend(
+                        key for key in keys if _make_key(key) not in add_data)
+
+        for sub, changes in (inline or {}).items():
+            sub_desc = all_sub[sub]
+            where = sub_desc.get('where')
+            visor = self._get_visor(sub_desc['visor'])
+            table = visor.table
+            patch = sub_patch(sub, table)
+
+            for key, change in changes.items():
+                if change.op == 'D':
+                    patch['removeIds'].append(key)
+                elif change.row is not None:
+                    if where_matches(where, change.row):
+                        data.setdefault(table, {})[_make_key(key)] = change.row
+                        matched.setdefault(sub, []).append(_make_key(key))
+                    else:
+                        patch['removeIds'].append(key)
+                else:
+                    # Row was matching before, only changed fields can break
+                    if where_matches(where, change.changed, partial=True):
+                        fields = change.changed
+                        if data_format != 'object':
+                            # Rows out of objects are found by key column
+                            fields = {visor.primary_key: key, **fields}
+                        changed.setdefault(table, {})[_make_key(key)] = \
+                            fields
+                    else:
+                        patch['removeIds'].append(key)
+
+        if last_sub is not None:
+            for sub, patch in sub_resp.items():
+                known = set(last_sub[sub]['ids'])
+                patch['removeIds'] = [key for key in patch['removeIds']
+                                      if _make_key(key) in known]
+                patch['addIds'] = [key for key in matched.get(sub, ())
+                                   if key not in known]
+
+        resp = {
+            'type': 'patch',
+            'data': _encode_data(data, data_format),
+            'sub': sub_resp,
+        }
+        if data_format != 'object':
+            resp['format'] = data_format
+
+        if changed:
+            resp['changed'] = _encode_changed(changed, data_format)
 
         return GrozaResponse(resp)
 
@@ -121,6 +725,9 @@ class GrozaHandler:
         #     return GrozaResponse({'errors':
         #     [f'Table '{table}' is not handled']})
 
+        if isinstance(insert, list):
+            return await self._query_insert_many(user, visor, insert)
+
         async with self._storage.session() as session:
             visor_instance = visor()
             result = await visor_instance.insert(
@@ -132,6 +739,20 @@ class GrozaHandler:
         return GrozaResponse({'status': 'ok',
                               visor.primary_key: result[visor.primary_key]})
 
+    async def _query_insert_many(self, user, visor, inserts):
+        async with self._storage.session() as session:
+            async with session.transaction():
+                visor_instance = visor()
+                results = await visor_instance.insert_many(
+                    inserts=inserts, user=user, session=session)
+
+        if len(results) != len(inserts) or not all(results):
+            return GrozaResponse({'status': 'error', 'message': 'No result'})
+
+        return GrozaResponse({'status': 'ok',
+                              visor.primary_key: [result[visor.primary_key]
+                                                  for result in results]})
+
     async def query_update(self, user, update):
         for cnt, (query, upd) in enumerate(update):
             visor_name = query['visor']
@@ -139,13 +760,18 @@ class GrozaHandler:
 
         async with self._storage.session() as session:
             async with session.transaction():
-                for cnt, (query, upd) in enumerate(update):
-                    visor_name = query['visor']
+                for visor_name, updates in _visor_runs(
+                        update, lambda item: item[0]['visor']):
                     visor = self._get_visor(visor_name)
 
                     visor_instance = visor()
-                    result = await visor_instance.update(
-                        update=(query, upd), user=user, session=session)
+                    if len(updates) == 1:
+                        await visor_instance.update(
+                            update=updates[0], user=user, session=session)
+                        continue
+                    await visor_instance.update_many(
+                        updates=[(query, upd) for query, upd in updates],
+                        user=user, session=session)
 
         return GrozaResponse({'status': 'ok'})
 
@@ -156,13 +782,17 @@ class GrozaHandler:
 
         async with self._storage.session() as session:
             async with session.transaction():
-                for cnt, delete_item in enumerate(delete):
-                    visor_name = delete_item['visor']
+                for visor_name, deletes in _visor_runs(
+                        delete, lambda item: item['visor']):
                     visor = self._get_visor(visor_name)
 
                     visor_instance = visor()
-                    result = await visor_instance.delete(
-                        delete=delete_item, user=user, session=session)
+                    if len(deletes) == 1:
+                        await visor_instance.delete(
+                            delete=deletes[0], user=user, session=session)
+                        continue
+                    await visor_instance.delete_many(
+                        deletes=deletes, user=user, session=session)
 
         return GrozaResponse({'status': 'ok'})
 
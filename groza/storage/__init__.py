@@ -1,6 +1,6 @@
 import contextvars
 from abc import abstractmethod, ABC
-from typing import Union
+from typing import List, Optional, Union
 
 from groza import GrozaUser
 
@@ -53,16 +53,93 @@ class GrozaSession(ABC):
                      insert: GrozaInput, user: GrozaUser):
         pass
 
+    async def insert_many(self, *, visor: 'GrozaVisor',
+                          inserts: List[GrozaInput], user: GrozaUser):
+        """
+        Inserts rows returning results in the order of `inserts`.
+        """
+        return [await self.insert(visor=visor, insert=insert, user=user)
+                for insert in inserts]
+
     @abstractmethod
     async def update(self, *, visor: 'GrozaVisor', update, user: GrozaUser):
         pass
 
+    async def update_many(self, *, visor: 'GrozaVisor', updates,
+                          user: GrozaUser):
+        """
+        Applies (query, update) pairs in order.
+        """
+        for update in updates:
+            await self.update(visor=visor, update=update, user=user)
+
     @abstractmethod
     async def delete(self, *, visor: 'GrozaVisor', delete, user: GrozaUser):
         pass
 
+    async def delete_many(self, *, visor: 'GrozaVisor', deletes,
+                          user: GrozaUser):
+        for delete in deletes:
+            await self.delete(visor=visor, delete=delete, user=user)
+
+    async def query_chunks(self, *, chunk_rows=1000, **kwargs):
+        """
+        Subscription rows as `query` results of `chunk_rows` rows. Storages
+        able to read results gradually override it.
+        """
+        add_data, link_field = await self.query(**kwargs)
+        items = list(add_data.items())
+        for start in range(0, len(items), chunk_rows):
+            yield dict(items[start:start + chunk_rows]), link_field
+
+    async def query_keys(self, *, visor: 'GrozaVisor', keys):
+        """
+        Rows by primary keys given as text, as notifications carry them.
+        """
+        raise RuntimeError(f'Querying "{visor.table}" by text keys '
+                           f'is not supported')
+
+    async def count(self, *, visor: 'GrozaVisor', from_sub, all_sub,
+                    sub_resp, where=None, estimate=False) -> int:
+        """
+        Number of rows of a subscription, approximate with `estimate`.
+        """
+        raise RuntimeError(f'Counting rows of "{visor.table}" '
+                           f'is not supported')
+
+
+def link_needs_ids(sub_desc) -> bool:
+    """
+    Subscriptions linked to `sub_desc` are queried by its fetched ids, not
+    by repeating its query: ids of recursive subscriptions leave out
+    nested rows, paged ones have only loaded rows.
+    """
+    return bool(sub_desc.get('recursive')) or sub_desc.get('limit') is not None
+
+
+def link_ids_source(all_sub, link, subquery_depth):
+    """
+    Subscription whose fetched ids are used by a query linked to `link`:
+    the nearest one from `link` up the links with `link_needs_ids` or
+    `subquery_depth` links away. Sources before it are repeated as
+    subqueries, so a query of a deep chain repeats no more than
+    `subquery_depth - 1` queries instead of every one up the links.
+    """
+    distance = 1
+    while link is not None and link in all_sub:
+        if distance >= subquery_depth or link_needs_ids(all_sub[link]):
+            return link
+        link = all_sub[link].get('fromSub')
+        distance += 1
+    return None
+
 
 class GrozaStorage:
+    # Sessions query linked subscriptions repeating queries of link sources
+    # up to this many links away, see `link_ids_source`; 0 - by fetched ids
+    # of the link source
+    link_subquery_depth = 0
+
     @abstractmethod
     def session(self) -> GrozaSession:
         return GrozaSession()
@@ -71,6 +148,18 @@ class GrozaStorage:
     def release(self, session: GrozaSession):
         pass
 
+    def from_db(self, field) -> str:
+        """
+        Client name of table field `field`, as in rows sessions return.
+        """
+        return field
+
+    def channel_visor(self, channel) -> Optional['GrozaVisor']:
+        """
+        Visor of rows notifications of `channel` are about.
+        """
+        return groza_visors.get().table_visor(channel)
+
 
 class GrozaVisors:
     def __init__(self):
@@ -83,11 +172,51 @@ class GrozaVisors:
     def visor_values(self):
         return self._visors_dict.values()
 
+    def table_visor(self, table) -> Optional['GrozaVisor']:
+        for visor in self._visors_dict.values():
+            if getattr(visor, 'table', None) == table:
+                return visor
+        return None
+
 
 class GrozaVisor(metaclass=GrozaCreator):
+    # Change notifications carry: 'key' - primary key only, 'row' - the
+    # whole new row, 'diff' - only fields changed by update
+    notify_payload = 'key'
+
+    # Audit and notification triggers fire for each 'row' or once per
+    # 'statement' (Postgres 10+). The latter always notifies with lists of
+    # keys, `notify_payload` is not used
+    trigger_level = 'row'
+
+    # 'full', 'full-diff' - audit is written by trigger, 'async' - by the
+    # application in batches, 'notify-only' - no audit
+    audit = 'full'
+
+    # Rows are kept in the storage row cache, if it has one, and dropped
+    # by change notifications. For read-heavy tables
+    cache_rows = False
+
+    # Memory storage indexes: fields looked up by equality and fields
+    # results are ordered by
+    indexes = ()
+    sorted_indexes = ()
+
     def __init__(self):
         pass
 
+    @classmethod
+    def link_field(cls, visor) -> Optional[str]:
+        """
+        Field of `GrozaForeignKey` referencing `visor`, if any.
+        """
+        for klass in cls.__mro__:
+            for value in vars(klass).values():
+                if isinstance(value, GrozaForeignKey) \
+                        and value.refers_to(visor):
+                    return value.field
+        return None
+
     async def ensure_permission(self,
                                 user: GrozaUser,
                                 action: GrozaAction,
@@ -100,14 +229,71 @@ class GrozaVisor(metaclass=GrozaCreator):
                      session: GrozaSession):
         return await session.insert(visor=self, insert=insert, user=user)
 
+    async def insert_many(self,
+                          inserts: List[GrozaInput],
+                          user: GrozaUser,
+                          session: GrozaSession):
+        """
+        Inserts rows returning results in the order of `inserts`, one by
+        one through `insert` if a subclass overrides it.
+        """
+        if self._overrides('insert'):
+            return [await self.insert(insert=insert, user=user,
+                                      session=session)
+                    for insert in inserts]
+        return await session.insert_many(visor=self, inserts=inserts,
+                                         user=user)
+
     async def update(self, update, user: GrozaUser, session: GrozaSession):
         return await session.update(visor=self, update=update, user=user)
 
+    async def update_many(self, updates, user: GrozaUser,
+                          session: GrozaSession):
+        """
+        Applies (query, update) pairs in order, one by one through `update`
+        if a subclass overrides it, at once otherwise.
+        """
+        if self._overrides('update'):
+            for update in updates:
+                await self.update(update=update, user=user, session=session)
+            return
+        return await session.update_many(visor=self, updates=updates,
+                                         user=user)
+
     async def delete(self, delete, user: GrozaUser, session: GrozaSession):
         return await session.delete(visor=self, delete=delete, user=user)
 
+    async def delete_many(self, deletes, user: GrozaUser,
+                          session: GrozaSession):
+        """
+        Deletes rows in order, one by one through `delete` if a subclass
+        overrides it, at once otherwise.
+        """
+        if self._overrides('delete'):
+            for delete in deletes:
+                await self.delete(delete=delete, user=user, session=session)
+            return
+        return await session.delete_many(visor=self, deletes=deletes,
+                                         user=user)
+
+    def _overrides(self, hook) -> bool:
+        """
+        Subclass has its own `hook` write method: checks or rewrites of
+        single rows batch writes must not skip.
+        """
+        return getattr(type(self), hook) is not getattr(GrozaVisor, hook)
+
 
 class GrozaForeignKey(GrozaVisor):
     def __init__(self, model: Union[type, str], field: str):
         self._model = model
         self._field = field
+
+    @property
+    def field(self) -> str:
+        return self._field
+
+    def refers_to(self, visor) -> bool:
+        if isinstance(self._model, str):
+            return self._model in (visor.__name__, visor.table)
+        return self._model is visor
@@ -1,127 +1,509 @@
+import asyncio
+import json
+from datetime import datetime, date, time
+from decimal import Decimal
 from typing import Iterable, Optional
 from uuid import UUID
 
-from groza import GrozaUser
+from groza import GrozaUser, GrozaChange
 from groza.queue import BaseQueue
+from groza.storage.asyncpg.audit import AsyncpgAuditWriter
+from groza.storage.asyncpg.cache import AsyncpgRowCache
 from groza.storage.asyncpg.impl import _PostgresBackend, _PostgresConn
-from groza.utils import build_logger, FieldTransformer, \
+from groza.storage.asyncpg.sql import SqlSelect, DEFAULT, insert_values, \
+    key_default, reserve_keys, copy_staging, insert_from
+from groza.storage.asyncpg.statements import AsyncpgStatement, \
+    AsyncpgStatementCache
+from groza.storage.asyncpg.triggers import audit_func_sql, \
+    statement_audit_func_sql, statement_triggers_sql
+from groza.utils import build_logger, FieldCodec, FieldTransformer, \
     CamelCaseFieldTransformer
 
-from groza.storage import GrozaStorage, GrozaSession, groza_visors, GrozaVisor
+from groza.storage import GrozaStorage, GrozaSession, groza_visors, \
+    GrozaVisor, link_ids_source
 from pssq import Q
 
 
-class AsyncpgSession(GrozaSession):
-    def __init__(self, *, conn: '_PostgresPoolProxy', log):
-        self._conn = conn
-        self._log = log
-        self._field_transformer: FieldTransformer = CamelCaseFieldTransformer()
-
-    async def query(self, *, visor, from_sub, all_sub, sub_resp,
-                    where=None, order=None):
-        q = Q.select().from_(visor.table)
+def _json_db_value(obj):
+    if isinstance(obj, (datetime, date, time)):
+        return obj.isoformat()
 
-        # primary_key_field = sub_table[0]
+    if isinstance(obj, (UUID, Decimal)):
+        return str(obj)
 
-        link_field = None
-        sub_desc_from = from_sub
-        if sub_desc_from is not None:
-            if sub_desc_from not in sub_resp:
-                raise RuntimeError(f'Link "{sub_desc_from}" not found '
-                                   f'in results. Check identifiers and order')
+    raise TypeError('Type %s not serializable' % type(obj))
 
-            link_table = all_sub[sub_desc_from]['table']
 
-            link_field = sub_table[1].get(link_table)
-            if not link_field:
-                raise RuntimeError(f'Link "{visor.table}"=>"{link_table}" '
-                                   f'not found')
+def _update_runs(updates, primary_key_field):
+    """
+    Splits (query, update) pairs into runs of consecutive updates of the
+    same fields. Run doesn't update one row twice.
+    """
+    runs = []
+    run_fields = None
+    run_keys = set()
+    for query, upd in updates:
+        fields = tuple(upd.keys())
+        key = query[primary_key_field]
+        if not runs or fields != run_fields or key in run_keys:
+            runs.append([])
+            run_fields = fields
+            run_keys = set()
 
-            link_field = link_field[0]
+        runs[-1].append((query, upd))
+        run_keys.add(key)
+    return runs
 
-            q.where(link_field, Q.Any(sub_resp[sub_desc_from]['ids']))
 
-        if where is not None:
-            for field, value in where.items():
-                q.where(self._to_db(field), value)
+class AsyncpgSession(GrozaSession):
+    # Bulk inserts of this many rows go through COPY
+    COPY_INSERT_ROWS = 1000
+    # Queries of linked subscriptions repeat link sources up to this many
+    # links away, farther ones are read from their fetched ids
+    LINK_SUBQUERY_DEPTH = 2
+
+    def __init__(self, *, conn: '_PostgresPoolProxy', log,
+                 audit: Optional[AsyncpgAuditWriter] = None,
+                 statements: Optional[AsyncpgStatementCache] = None,
+                 codec: Optional[FieldCodec] = None,
+                 rows: Optional[AsyncpgRowCache] = None):
+        self._conn = conn
+        self._log = log
+        self._codec: FieldCodec = codec if codec is not None \
+            else FieldCodec(CamelCaseFieldTransformer())
+        self._statements = statements if statements is not None \
+            else AsyncpgStatementCache()
+        # Rows of visors with `cache_rows`, None if the storage has no cache
+        self._rows = rows
+        # Rows written by the session: (table, key)
+        self._written = []
+
+        # Records of visors with 'async' audit, written on session success
+        self._audit = audit
+        self._audit_records = []
 
+    async def query(self, *, visor, from_sub, all_sub, sub_resp,
+                    where=None, order=None, keys=None, recursive=None,
+                    recursive_depth=None, limit=None, after=None):
+        # Rows of recursive results get their nested rows attached, they
+        # are not shared
+        cache = (self._rows if self._rows is not None and visor.cache_rows
+                 and recursive is None else None)
+
+        cached = {}
+        if cache is not None and keys is not None and from_sub is None \
+                and not where:
+            missing = []
+            for key in keys:
+                row = cache.get_row(visor.table, key)
+                if row is None:
+                    missing.append(key)
+                else:
+                    cached.update(row)
+            if not missing:
+                return cached, None
+            keys = missing
+
+        q, link_field = self._select(visor, from_sub, all_sub, sub_resp,
+                                     where)
+
+        if recursive is not None:
+            # Subscription conditions select roots of the trees
+            q.recursive(self._to_db(recursive[0]), visor.primary_key,
+                        recursive_depth)
+
+        if keys is not None:
+            q.where_any(visor.primary_key, keys)
+
+        order_fields = []
+        if order is not None:
+            for field, order in order.items():
+                order_fields.append(self._to_db(field))
+                q.order(order_fields[-1], order)
+
+        if limit is not None or after is not None:
+            # Primary key makes the order unique for the cursor
+            if visor.primary_key not in order_fields:
+                q.order(visor.primary_key)
+            if after is not None:
+                q.after(after)
+            if limit is not None:
+                q.limit(limit)
+
+        sql, args = q.end()
+        if cache is None:
+            return self._decode(visor, await self._conn.fetch(sql, *args)), \
+                link_field
+
+        if keys is not None:
+            generation = cache.generation((visor.table,))
+            rows = self._decode(visor, await self._conn.fetch(sql, *args))
+            if not where and from_sub is None:
+                cache.put_rows(visor.table, generation, rows)
+            return {**cached, **rows}, link_field
+
+        rows = cache.get(sql, args)
+        if rows is None:
+            tables = q.tables()
+            generation = cache.generation(tables)
+            rows = self._decode(visor, await self._conn.fetch(sql, *args))
+            cache.put(sql, args, tables, generation, rows, keyed=True)
+        return rows, link_field
+
+    async def query_chunks(self, *, visor, from_sub, all_sub, sub_resp,
+                           where=None, order=None, chunk_rows=1000):
+        """
+        Reads subscription rows through a server-side cursor, yields them
+        `chunk_rows` at a time as `query` results. The next chunk is read
+        when the consumer asks for it.
+        """
+        q, link_field = self._select(visor, from_sub, all_sub, sub_resp,
+                                     where)
         if order is not None:
             for field, order in order.items():
                 q.order(self._to_db(field), order)
 
-        items = list(await self._conn.fetch(q))
+        sql, args = q.end()
+        # Cursors live in transactions
+        async with self._conn.transaction():
+            cursor = await self._conn.cursor(sql, *args)
+            while True:
+                items = await cursor.fetch(chunk_rows)
+                if not items:
+                    break
+                yield self._decode(visor, items), link_field
 
-        primary_key_field = visor.primary_key
+    def _decode(self, visor, items):
+        if not items:
+            return {}
+
+        columns = tuple(items[0].keys())
+        decode = self._codec.row_decoder(columns)
+        key_idx = columns.index(visor.primary_key)
 
         def make_key(key):
             if isinstance(key, UUID):
                 key = str(key)
             return key
 
-        def make_item(item: dict):
-            return {self._from_db(k): v for k, v in item.items()}
+        return {make_key(item[key_idx]): decode(item) for item in items}
+
+    async def query_keys(self, *, visor, keys):
+        cache = self._rows if visor.cache_rows else None
+
+        rows = {}
+        if cache is not None:
+            missing = []
+            for key in keys:
+                row = cache.get_row(visor.table, key)
+                if row is None:
+                    missing.append(key)
+                else:
+                    rows.update(row)
+            if not missing:
+                return rows
+            keys = missing
+            generation = cache.generation((visor.table,))
+
+        q = SqlSelect(visor.table).where_text(visor.primary_key, keys)
+        fetched = self._decode(visor, await self._conn.fetch(*q.end()))
+        if cache is not None:
+            cache.put_rows(visor.table, generation, fetched)
+        rows.update(fetched)
+        return rows
+
+    async def count(self, *, visor, from_sub, all_sub, sub_resp, where=None,
+                    estimate=False):
+        """
+        Number of rows of the subscription, planner estimate with
+        `estimate`.
+        """
+        q, _ = self._select(visor, from_sub, all_sub, sub_resp, where)
+
+        if not estimate:
+            return await self._conn.fetchval(*q.count())
+
+        sql, args = q.end()
+        plan = await self._conn.fetchval(f'EXPLAIN (FORMAT JSON) {sql}',
+                                         *args)
+        return int(json.loads(plan)[0]['Plan']['Plan Rows'])
+
+    def _select(self, visor, from_sub, all_sub, sub_resp, where=None):
+        q = SqlSelect(visor.table)
+
+        link_field = None
+        if from_sub is not None:
+            link_field = self._link_field(visor, all_sub, from_sub)
+            ids_source = link_ids_source(all_sub, from_sub,
+                                         self.LINK_SUBQUERY_DEPTH)
+            q.where_in(link_field, self._link_source(all_sub, sub_resp,
+                                                     from_sub, ids_source))
+            link_field = self._from_db(link_field)
 
-        add_data = {make_key(item[primary_key_field]): make_item(item)
-                    for item in items}
+        if where is not None:
+            for field, value in where.items():
+                q.where(self._to_db(field), value)
 
-        return add_data, link_field
+        return q, link_field
+
+    def _link_field(self, visor, all_sub, link_sub):
+        if link_sub not in all_sub:
+            raise RuntimeError(f'Link "{link_sub}" not found in '
+                               f'subscriptions. Check identifiers')
+
+        link_visor = groza_visors.get().require_visor(
+            all_sub[link_sub]['visor'])
+        link_field = visor.link_field(link_visor)
+        if not link_field:
+            raise RuntimeError(f'Link "{visor.table}"=>"{link_visor.table}" '
+                               f'not found')
+        return link_field
+
+    def _link_source(self, all_sub, sub_resp, sub, ids_source):
+        """
+        Keys of subscription `sub` rows: subquery repeating its query up
+        to `ids_source`, whose fetched ids are used.
+        """
+        sub_desc = all_sub[sub]
+        if sub == ids_source:
+            if sub not in sub_resp:
+                raise RuntimeError(f'Link "{sub}" not found in results')
+            return sub_resp[sub]['ids']
+
+        visor = groza_visors.get().require_visor(sub_desc['visor'])
+        q = SqlSelect(visor.table, [visor.primary_key])
+
+        link_sub = sub_desc.get('fromSub')
+        if link_sub is not None:
+            q.where_in(self._link_field(visor, all_sub, link_sub),
+                       self._link_source(all_sub, sub_resp, link_sub,
+                                         ids_source))
+
+        for field, value in (sub_desc.get('where') or {}).items():
+            q.where(self._to_db(field), value)
+
+        return q
 
     async def insert(self, *, visor, insert, user):
-        idx = 1
-        args = ()
-        own_fields = []
-        own_values = []
+        fields = tuple(insert.keys())
+        statement = self._statements.get(
+            self._statements.key('insert', visor, fields),
+            lambda: self._build_insert(visor, fields))
 
-        for key, value in insert.items():
-            own_fields.append(f'"{self._to_db(key)}"')
-            own_values.append(f'${idx}')
-            args += (value,)
-            idx += 1
+        args = tuple(insert[key] for key in fields) + (user.user_id,)
+        result = await self._conn.fetchrow(statement.sql, *args)
+        self._invalidate(visor, [result[visor.primary_key]])
 
-        last_updated_by_field = self._to_db('last_updated_by')
-        own_fields.append(f'"{last_updated_by_field}"')
-        own_values.append(f'${idx}')
-        args += (user.user_id,)
-        idx += 1
+        if visor.audit == 'async':
+            new = dict(zip(statement.db_fields, args))
+            self._audit_records.append(
+                (user.user_id, 'A', visor.table, result[visor.primary_key],
+                 {}, new))
+
+        return result
 
-        own_fields_str = ', '.join(own_fields)
-        own_values_str = ', '.join(own_values)
+    def _build_insert(self, visor, fields) -> AsyncpgStatement:
+        db_fields = tuple(self._to_db(key) for key in fields) + \
+            (self._to_db('last_updated_by'),)
 
-        primary_key = visor.primary_key
+        own_fields_str = ', '.join(f'"{field}"' for field in db_fields)
+        own_values_str = ', '.join(f'${idx}'
+                                   for idx in range(1, len(db_fields) + 1))
 
-        query = f'INSERT INTO {visor.table} ({own_fields_str}) ' \
-            f'VALUES ({own_values_str}) RETURNING "{primary_key}"'
-        result = await self._conn.fetchrow(query, *args)
+        sql = f'INSERT INTO {visor.table} ({own_fields_str}) ' \
+            f'VALUES ({own_values_str}) RETURNING "{visor.primary_key}"'
+        return AsyncpgStatement(sql, fields, db_fields)
 
-        return result
+    async def insert_many(self, *, visor, inserts, user):
+        """
+        Multi-row INSERT for moderate batches, COPY through a staging table
+        for large batches of rows with equal fields.
+
+        Rows without a primary key get one taken from the column default
+        beforehand: RETURNING doesn't keep input order.
+        """
+        if not inserts:
+            return []
+
+        last_updated_by_field = self._to_db('last_updated_by')
+        key_field = self._from_db(visor.primary_key)
+
+        missing = sum(1 for insert in inserts if key_field not in insert)
+        overriding = False
+        if missing:
+            keys, overriding = await self._reserve_keys(visor, missing)
+            keys = iter(keys)
+            inserts = [insert if key_field in insert
+                       else {**insert, key_field: next(keys)}
+                       for insert in inserts]
+
+        fields = []
+        for insert in inserts:
+            for key in insert.keys():
+                if key not in fields:
+                    fields.append(key)
+
+        db_fields = [self._to_db(key) for key in fields] + \
+            [last_updated_by_field]
+
+        same_fields = all(len(insert) == len(fields) for insert in inserts)
+        if same_fields and len(inserts) >= self.COPY_INSERT_ROWS:
+            await self._insert_copy(visor, inserts, fields, db_fields, user,
+                                    overriding)
+        else:
+            await self._insert_values(visor, inserts, fields, db_fields,
+                                      user, overriding)
+
+        results = [{visor.primary_key: insert[key_field]}
+                   for insert in inserts]
+        self._invalidate(visor, [insert[key_field] for insert in inserts])
+
+        if visor.audit == 'async':
+            for insert, result in zip(inserts, results):
+                new = {self._to_db(key): value
+                       for key, value in insert.items()}
+                new[last_updated_by_field] = user.user_id
+                self._audit_records.append(
+                    (user.user_id, 'A', visor.table,
+                     result[visor.primary_key], {}, new))
+
+        return results
+
+    async def _reserve_keys(self, visor, count):
+        """
+        Keys for `count` rows, and whether writing them needs
+        `OVERRIDING SYSTEM VALUE`.
+        """
+        key = self._statements.key('reserve', visor)
+        statement = self._statements.find(key)
+        if statement is None:
+            default, identity = await self._conn.fetchrow(
+                *key_default(visor.table, visor.primary_key))
+            if default is None:
+                raise RuntimeError(f'Primary key of "{visor.table}" has no '
+                                   f'default')
+            statement = self._statements.get(
+                key, lambda: AsyncpgStatement(reserve_keys(default), (), (),
+                                              overriding=identity))
+
+        return ([row[0] for row in
+                 await self._conn.fetch(statement.sql, count)],
+                statement.overriding)
+
+    async def _insert_values(self, visor, inserts, fields, db_fields, user,
+                             overriding):
+        # Postgres takes no more than 32767 arguments in a query
+        page_rows = max(1, 32767 // len(db_fields))
+
+        for page_start in range(0, len(inserts), page_rows):
+            rows = [[insert.get(key, DEFAULT) for key in fields]
+                    + [user.user_id]
+                    for insert in inserts[page_start:page_start + page_rows]]
+            await self._conn.execute(
+                *insert_values(visor.table, db_fields, rows, overriding))
+
+    async def _insert_copy(self, visor, inserts, fields, db_fields, user,
+                           overriding):
+        staging = f'_groza_insert_{visor.table}'
+
+        # Staging table lives until the end of the transaction
+        async with self._conn.transaction():
+            for sql in copy_staging(staging, visor.table, db_fields):
+                await self._conn.execute(sql)
+
+            records = [tuple(insert[key] for key in fields) + (user.user_id,)
+                       for insert in inserts]
+            await self._conn.copy_records_to_table(
+                staging, records=records, columns=db_fields)
+
+            await self._conn.execute(
+                insert_from(visor.table, staging, db_fields, overriding))
 
     async def update(self, *, visor, update, user):
         query, upd = update
 
-        idx = 1
-        args = ()
-        fields = []
-        for key, value in upd.items():
-            fields.append(f'"{self._to_db(key)}" = ${idx}')
-            args += (value,)
-            idx += 1
+        fields = tuple(upd.keys())
+        statement = self._statements.get(
+            self._statements.key('update', visor, fields),
+            lambda: self._build_update(visor, fields))
 
+        values = tuple(upd[key] for key in fields)
+        primary_key_field = visor.primary_key
+        await self._conn.execute(statement.sql, *values, user.user_id,
+                                 query[primary_key_field])
+        self._invalidate(visor, [query[primary_key_field]])
+
+        if visor.audit == 'async':
+            # Old values are not known without reading the row
+            new = dict(zip(statement.db_fields, values))
+            self._audit_records.append(
+                (user.user_id, 'U', visor.table, query[primary_key_field],
+                 {}, new))
+
+    def _build_update(self, visor, fields) -> AsyncpgStatement:
+        db_fields = tuple(self._to_db(key) for key in fields)
         last_updated_by_field = self._to_db('last_updated_by')
-        fields.append(f'"{last_updated_by_field}" = ${idx}')
-        args += (user.user_id,)
-        idx += 1
 
-        value_fields = ', '.join(fields)
+        value_fields = ', '.join(
+            [f'"{field}" = ${idx}' for idx, field in enumerate(db_fields, 1)]
+            + [f'"{last_updated_by_field}" = ${len(db_fields) + 1}'])
+
+        sql = f'UPDATE {visor.table} SET {value_fields} ' \
+            f'WHERE "{visor.primary_key}" = ${len(db_fields) + 2}'
+        return AsyncpgStatement(sql, fields, db_fields)
+
+    async def update_many(self, *, visor, updates, user):
+        """
+        Consecutive updates of the same fields run as one
+        UPDATE ... FROM json_populate_recordset statement.
+        """
+        for run in _update_runs(updates, visor.primary_key):
+            if len(run) == 1:
+                await self.update(visor=visor, update=run[0], user=user)
+                continue
 
+            await self._update_set(visor, run, user)
+
+    async def _update_set(self, visor, updates, user):
+        primary_key_field = visor.primary_key
+
+        fields = tuple(updates[0][1].keys())
+        statement = self._statements.get(
+            self._statements.key('update_set', visor, fields),
+            lambda: self._build_update_set(visor, fields))
+
+        values = []
+        for query, upd in updates:
+            value = dict(zip(statement.db_fields, upd.values()))
+            value[primary_key_field] = query[primary_key_field]
+            values.append(value)
+
+        await self._conn.execute(statement.sql,
+                                 json.dumps(values, default=_json_db_value),
+                                 user.user_id)
+        self._invalidate(visor, [value[primary_key_field]
+                                 for value in values])
+
+        if visor.audit == 'async':
+            for value in values:
+                new = dict(value)
+                key = new.pop(primary_key_field)
+                self._audit_records.append(
+                    (user.user_id, 'U', visor.table, key, {}, new))
+
+    def _build_update_set(self, visor, fields) -> AsyncpgStatement:
         primary_key_field = visor.primary_key
+        db_fields = tuple(self._to_db(key) for key in fields)
+        last_updated_by_field = self._to_db('last_updated_by')
 
-        args += (query[primary_key_field],)
-        primary_key_idx = idx
+        value_fields = ', '.join(
+            [f'"{field}" = v."{field}"' for field in db_fields]
+            + [f'"{last_updated_by_field}" = $2'])
 
-        idx += 1
-        query_str = f'UPDATE {visor.table} SET {value_fields} ' \
-            f'WHERE "{primary_key_field}" = ${primary_key_idx}'
-        await self._conn.execute(query_str, *args)
+        sql = f'UPDATE {visor.table} AS t SET {value_fields} ' \
+            f'FROM json_populate_recordset(NULL::{visor.table}, $1::json) ' \
+            f'AS v WHERE t."{primary_key_field}" = v."{primary_key_field}"'
+        return AsyncpgStatement(sql, fields, db_fields)
 
     async def delete(self, *, visor: 'GrozaVisor', delete, user: GrozaUser):
         q = (
@@ -129,7 +511,67 @@ class AsyncpgSession(GrozaSession):
              .from_(visor.table)
              .where(visor.primary_key, delete[visor.primary_key])
         )
-        await self._conn.execute(q)
+        self._invalidate(visor, [delete[visor.primary_key]])
+
+        if visor.audit != 'async':
+            await self._conn.execute(q)
+            return
+
+        old = await self._conn.fetchrow(q.returning('*'))
+        if old is not None:
+            self._audit_records.append(
+                (user.user_id, 'D', visor.table, delete[visor.primary_key],
+                 dict(old), {}))
+
+    async def delete_many(self, *, visor: 'GrozaVisor', deletes,
+                          user: GrozaUser):
+        if len(deletes) == 1:
+            await self.delete(visor=visor, delete=deletes[0], user=user)
+            return
+
+        q = (
+            Q.delete()
+             .from_(visor.table)
+             .where(visor.primary_key,
+                    Q.any([delete[visor.primary_key] for delete in deletes]))
+        )
+        self._invalidate(visor, [delete[visor.primary_key]
+                                 for delete in deletes])
+
+        if visor.audit != 'async':
+            await self._conn.execute(q)
+            return
+
+        for old in await self._conn.fetch(q.returning('*')):
+            self._audit_records.append(
+                (user.user_id, 'D', visor.table, old[visor.primary_key],
+                 dict(old), {}))
+
+    def _invalidate(self, visor, keys):
+        """
+        Drops cached rows a write changed without waiting for their
+        notifications, so reads right after the write don't get old rows.
+        """
+        if self._rows is None:
+            return
+        for key in keys:
+            self._rows.invalidate(visor.table, key)
+            self._written.append((visor.table, key))
+
+    def invalidate_written(self):
+        """
+        Drops cached rows written by the session again once its writes are
+        committed: reads between a write and its commit could store them
+        as they were.
+        """
+        for table, key in self._written:
+            self._rows.invalidate(table, key)
+        self._written = []
+
+    def submit_audit(self):
+        if self._audit is not None and self._audit_records:
+            self._audit.add(self._audit_records)
+        self._audit_records = []
 
     def transaction(self):
         return self._conn.transaction()
@@ -144,30 +586,64 @@ class AsyncpgSession(GrozaSession):
         return await self._conn.__aexit__(exc_type, exc_val, exc_tb)
 
     def _from_db(self, field):
-        return self._field_transformer.from_db(field)
+        return self._codec.from_db(field)
 
     def _to_db(self, field):
-        return self._field_transformer.to_db(field)
+        return self._codec.to_db(field)
 
 
 class _AsyncpgSessionProxy:
-    def __init__(self, conn, log):
+    def __init__(self, conn, log, audit=None, statements=None, codec=None,
+                 rows=None):
         self._conn = conn
         self._log = log
+        self._audit = audit
+        self._statements = statements
+        self._codec = codec
+        self._rows = rows
+        self._session: Optional[AsyncpgSession] = None
 
     async def __aenter__(self):
-        return AsyncpgSession(conn=await self._conn.__aenter__(), log=self._log)
+        self._session = AsyncpgSession(conn=await self._conn.__aenter__(),
+                                       log=self._log, audit=self._audit,
+                                       statements=self._statements,
+                                       codec=self._codec, rows=self._rows)
+        return self._session
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self._session.submit_audit()
+        self._session.invalidate_written()
         return await self._conn.__aexit__(exc_type, exc_val, exc_tb)
 
 
 class AsyncpgStorage(GrozaStorage):
-    def __init__(self, dsn):
+    link_subquery_depth = AsyncpgSession.LINK_SUBQUERY_DEPTH
+
+    # Seconds between attempts to listen again after losing the connection
+    RELISTEN_DELAY = 1.0
+
+    def __init__(self, dsn, statement_cache_size=1024,
+                 field_transformer: Optional[FieldTransformer] = None,
+                 row_cache_bytes: Optional[int] = None):
         self._log = build_logger('SESSION')
-        self._backend = _PostgresBackend(dsn)
+        # asyncpg keeps statements prepared on each pooled connection by
+        # SQL text, generated writes reuse the text from `_statements`
+        self._backend = _PostgresBackend(
+            dsn, statement_cache_size=statement_cache_size)
+        self._statements = AsyncpgStatementCache(statement_cache_size)
 
         self._notif_conn = None
+        self._channel_visors = {}
+        self._audit: Optional[AsyncpgAuditWriter] = None
+        # Shared by sessions: names and row converters are built once
+        self._codec = FieldCodec(field_transformer
+                                 or CamelCaseFieldTransformer())
+        # Rows of visors with `cache_rows`, kept fresh by notifications
+        self._rows: Optional[AsyncpgRowCache] = (
+            AsyncpgRowCache(row_cache_bytes)
+            if row_cache_bytes is not None else None)
+        self._relisten_task: Optional[asyncio.Task] = None
 
         self._notifications: Optional[BaseQueue] = None
 
@@ -177,17 +653,80 @@ class AsyncpgStorage(GrozaStorage):
     async def connect(self):
         await self._backend.connect()
 
+        await self._listen()
+
+        if any(model.audit == 'async' for model in self._get_visors()):
+            self._audit = AsyncpgAuditWriter(self._backend.dsn)
+            await self._audit.connect()
+
+    async def _listen(self):
         self._notif_conn = await self._backend.pool.acquire()
 
         for model in self._get_visors():
+            self._channel_visors[model.table] = model
             await self._notif_conn.add_listener(model.table, self._notify)
 
+        self._notif_conn.add_termination_listener(self._listen_lost)
+
+    def _listen_lost(self, conn):
+        """
+        Notifications sent while not listening are lost: cached rows are
+        not trusted until listening again.
+        """
+        self._log.warning('Notification connection lost')
+        if self._rows is not None:
+            self._rows.enabled = False
+            self._rows.flush()
+
+        if self._relisten_task is None:
+            self._relisten_task = asyncio.ensure_future(self._relisten())
+
+    async def _relisten(self):
+        try:
+            while True:
+                try:
+                    await self._listen()
+                    break
+                except Exception:
+                    self._log.exception('Failed to listen again')
+                    await asyncio.sleep(self.RELISTEN_DELAY)
+        finally:
+            self._relisten_task = None
+
+        if self._rows is not None:
+            self._rows.flush()
+            self._rows.enabled = True
+
+    async def close(self):
+        if self._relisten_task is not None:
+            self._relisten_task.cancel()
+            self._relisten_task = None
+
+        if self._audit is not None:
+            await self._audit.close()
+            self._audit = None
+
     def session(self):
-        return _AsyncpgSessionProxy(conn=self._backend.acquire(), log=self._log)
+        return _AsyncpgSessionProxy(conn=self._backend.acquire(),
+                                    log=self._log, audit=self._audit,
+                                    statements=self._statements,
+                                    codec=self._codec, rows=self._rows)
+
+    def statement_stats(self):
+        return self._statements.stats()
+
+    def row_cache_stats(self):
+        return self._rows.stats() if self._rows is not None else None
 
     def release(self, session: AsyncpgSession):
         self._backend.release(session)
 
+    def from_db(self, field) -> str:
+        return self._codec.from_db(field)
+
+    def channel_visor(self, channel) -> Optional[GrozaVisor]:
+        return self._channel_visors.get(channel)
+
     async def start_tables(self):
         audit_table = 'groza_audit'
         audit_table_seq = f'{audit_table}_id_seq'
@@ -219,66 +758,92 @@ class AsyncpgStorage(GrozaStorage):
 
                 last_updated_by_field = f'last_updated_by'
 
-                primary_key_field = model.primary_key
-
-                use_int_key = f'OLD."{primary_key_field}"' if False else 'NULL'
-                use_var_key = f'OLD."{primary_key_field}"' if True else 'NULL'
-
-                use_int_key_new = f'NEW."{primary_key_field}"' if False else 'NULL'
-                use_var_key_new = f'NEW."{primary_key_field}"' if True else 'NULL'
-
                 table = model.table
-                data_table = f"{table}"
-
-                await conn.execute(f"""
-                    CREATE OR REPLACE FUNCTION "{audit_table_func}"() RETURNS TRIGGER AS 
-                    $$ 
-                    DECLARE 
-                     r record;
-                     oldh hstore;
-                     o hstore := hstore('');
-                     n hstore := hstore('');
-                    BEGIN 
-                     IF (TG_OP = 'DELETE') THEN
-                       INSERT INTO "{audit_table}" SELECT nextval('{audit_table_seq}'), OLD."{last_updated_by_field}", {use_int_key}, now(), 'D', '{table}', {use_var_key}, hstore(OLD), hstore('');
-                       PERFORM pg_notify('{data_table}', OLD."{primary_key_field}"::text);
-                       RETURN OLD;
-                     ELSIF (TG_OP = 'UPDATE') THEN
-                       oldh = hstore(OLD);
-                       FOR r IN SELECT * FROM EACH(hstore(NEW)) 
-                       LOOP 
-                         IF (oldh->r.key != r.value) THEN 
-                           o = o || ('"' || r.key || '" => "' || (oldh->r.key) || '"')::hstore;
-                           n = n || ('"' || r.key || '" => "' || r.value || '"')::hstore;
-                         END IF;
-                       END LOOP; 
-                       INSERT INTO "{audit_table}" SELECT nextval('{audit_table_seq}'), NEW."{last_updated_by_field}", {use_int_key}, now(), 'U', '{table}', {use_var_key}, o, n;
-                       PERFORM pg_notify('{data_table}', NEW."{primary_key_field}"::text);
-                       RETURN NEW;
-                     ELSIF (TG_OP = 'INSERT') THEN
-                       INSERT INTO "{audit_table}" SELECT nextval('{audit_table_seq}'), NEW."{last_updated_by_field}", {use_int_key_new}, now(), 'A', '{table}', {use_var_key_new}, hstore(''), hstore(NEW);
-                       PERFORM pg_notify('{data_table}', NEW."{primary_key_field}"::text);
-                       RETURN NEW;
-                     END IF;
-                     RETURN NULL;
-                    END; 
-                    $$ language plpgsql; 
-                """)
-
-                await conn.execute(f"""
-                    DROP TRIGGER IF EXISTS "{audit_table_trigger}" ON "{table}"
-                """)
-
-                await conn.execute(f"""
+
+                columns = None
+                if model.notify_payload != 'key' \
+                        and model.trigger_level == 'row':
+                    columns = [tuple(column) for column in await conn.fetch(
+                        'SELECT column_name, data_type '
+                        'FROM information_schema.columns '
+                        'WHERE table_schema = current_schema() '
+                        'AND table_name = $1 ORDER BY ordinal_position',
+                        table)]
+
+                if model.trigger_level == 'statement':
+                    func_sql = statement_audit_func_sql(
+                        func=audit_table_func,
+                        table=table,
+                        primary_key=model.primary_key,
+                        audit_table=audit_table,
+                        audit_table_seq=audit_table_seq,
+                        last_updated_by_field=last_updated_by_field,
+                        audit=model.audit,
+                    )
+                    triggers_sql = statement_triggers_sql(
+                        audit_prefix_table, table, audit_table_func)
+                else:
+                    func_sql = audit_func_sql(
+                        func=audit_table_func,
+                        table=table,
+                        primary_key=model.primary_key,
+                        audit_table=audit_table,
+                        audit_table_seq=audit_table_seq,
+                        last_updated_by_field=last_updated_by_field,
+                        payload=model.notify_payload,
+                        columns=columns,
+                        audit=model.audit,
+                    )
+                    triggers_sql = [f"""
                    CREATE TRIGGER "{audit_table_trigger}"
                        AFTER INSERT OR UPDATE OR DELETE ON "{table}"
                        FOR EACH ROW EXECUTE PROCEDURE "{audit_table_func}"()
-                """)
+                """]
+
+                await conn.execute(func_sql)
+
+                for trigger in (audit_table_trigger,
+                                f'{audit_prefix_table}_insert_trigger',
+                                f'{audit_prefix_table}_update_trigger',
+                                f'{audit_prefix_table}_delete_trigger'):
+                    await conn.execute(f"""
+                        DROP TRIGGER IF EXISTS "{trigger}" ON "{table}"
+                    """)
+
+                for trigger_sql in triggers_sql:
+                    await conn.execute(trigger_sql)
 
     def _notify(self, conn, pid, channel, message):
-        obj_id = message
-        # print(conn, pid, channel, message)
-        self._notifications.put_nowait((pid, channel, obj_id))
+        visor = self._channel_visors.get(channel)
+        if visor is not None and visor.trigger_level == 'statement':
+            payload = json.loads(message)
+            for key in payload['ks']:
+                if self._rows is not None:
+                    self._rows.invalidate(channel, key)
+                self._notifications.put_nowait(
+                    GrozaChange(pid, channel, key, payload['op']))
+            return
+
+        if visor is None or visor.notify_payload == 'key':
+            change = GrozaChange(pid, channel, message)
+        else:
+            payload = json.loads(message)
+            row = payload.get('r')
+            changed = payload.get('c')
+            change = GrozaChange(
+                pid, channel, str(payload['k']), payload['op'],
+                row=self._from_db_row(row) if row is not None else None,
+                changed=(self._from_db_row(changed)
+                         if changed is not None else None),
+            )
+
+        # Before anyone hears of the change and re-queries
+        if self._rows is not None:
+            self._rows.invalidate(channel, change.obj_id)
+        self._notifications.put_nowait(change)
+
+    def _from_db_row(self, row):
+        return self._codec.decode_row(row)
 
     @classmethod
     def _get_visors(cls) -> Iterable[GrozaVisor]:
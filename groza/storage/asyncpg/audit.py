@@ -0,0 +1,94 @@
+import asyncio
+from datetime import datetime
+from typing import List, Optional
+
+import asyncpg
+
+from groza.utils import build_logger
+
+
+def _hstore(values: Optional[dict]):
+    if not values:
+        return {}
+
+    return {key: None if value is None else str(value)
+            for key, value in values.items()}
+
+
+class AsyncpgAuditWriter:
+    """
+    Writes audit records of visors with 'async' audit mode. Records queued
+    by sessions are written with COPY in batches of `batch` records or
+    every `interval` seconds.
+    """
+
+    COLUMNS = ('audit_id', 'updatedBy', 'int_key', 'time', 'operation',
+               'table', 'var_key', 'o', 'n')
+
+    def __init__(self, dsn, audit_table='groza_audit', interval=1.0,
+                 batch=5000):
+        self._dsn = dsn
+        self._audit_table = audit_table
+        self._audit_table_seq = f'{audit_table}_id_seq'
+        self._interval = interval
+        self._batch = batch
+        self._log = build_logger('AUDIT')
+
+        self._records: List[tuple] = []
+        self._conn: Optional[asyncpg.Connection] = None
+        self._task: Optional[asyncio.Task] = None
+        self._lock = asyncio.Lock()
+
+    async def connect(self):
+        # Own connection: pooled ones shouldn't get the hstore codec
+        self._conn = await asyncpg.connect(self._dsn)
+        await self._conn.set_builtin_type_codec(
+            'hstore', codec_name='pg_contrib.hstore')
+        self._task = asyncio.ensure_future(self._flush_loop())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+        await self.flush()
+        await self._conn.close()
+
+    def add(self, records):
+        """
+        Queues (user id, operation, table, key, old values, new values)
+        records. Values are dicts with column names.
+        """
+        self._records.extend(records)
+        if len(self._records) >= self._batch:
+            asyncio.ensure_future(self.flush())
+
+    async def flush(self):
+        async with self._lock:
+            records, self._records = self._records, []
+            if not records:
+                return
+
+            try:
+                audit_ids = await self._conn.fetch(
+                    f"SELECT nextval('{self._audit_table_seq}') "
+                    f"FROM generate_series(1, $1)", len(records))
+
+                now = datetime.now()
+                rows = [
+                    (audit_id[0], user_id, None, now, operation, table,
+                     str(key), _hstore(old), _hstore(new))
+                    for audit_id, (user_id, operation, table, key, old, new)
+                    in zip(audit_ids, records)
+                ]
+
+                await self._conn.copy_records_to_table(
+                    self._audit_table, records=rows, columns=self.COLUMNS)
+            except:
+                self._log.exception('Error writing %d audit records'
+                                    % len(records))
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self._interval)
+            await self.flush()
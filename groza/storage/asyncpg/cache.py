@@ -0,0 +1,182 @@
+import json
+import sys
+from collections import OrderedDict
+from typing import Dict, Iterable, Optional, Set, Tuple
+
+
+def _sizeof(rows: dict) -> int:
+    """
+    Rough memory taken by rows: containers and their values, strings and
+    numbers shared between rows are counted for every row.
+    """
+    size = sys.getsizeof(rows)
+    for row in rows.values():
+        size += sys.getsizeof(row)
+        for value in row.values():
+            size += sys.getsizeof(value)
+    return size
+
+
+def query_key(sql, args) -> Tuple[str, str]:
+    """
+    Normalized query: same SQL text and arguments of same types.
+    """
+    return sql, json.dumps(args, default=repr)
+
+
+class AsyncpgRowCache:
+    """
+    LRU cache of query results and rows by primary key, bounded by
+    `max_bytes` of estimated row size.
+
+    Rows are dropped by change notifications and by writes of sessions:
+    the row with the changed key and results of every query reading the
+    changed table, as a changed row can join results it was not in.
+    Results read while a table changed are not stored.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        # Cache is off while changes may be missed
+        self.enabled = True
+
+        # key -> (rows, tables, size); query keys are (sql, args), row
+        # keys are (table, text primary key)
+        self._entries: OrderedDict = OrderedDict()
+        self._table_queries: Dict[str, Set[tuple]] = {}
+        self._generations: Dict[str, int] = {}
+        self._epoch = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.flushes = 0
+
+    def generation(self, tables: Iterable[str]) -> tuple:
+        """
+        Version of `tables`, taken before a query to `put` its results.
+        """
+        return (self._epoch,) + tuple(self._generations.get(table, 0)
+                                      for table in tables)
+
+    def get(self, sql, args) -> Optional[dict]:
+        return self._get(query_key(sql, args))
+
+    def get_row(self, table, key) -> Optional[dict]:
+        """
+        Row `key` of `table` as query results: its key -> the row.
+        """
+        return self._get((table, str(key)))
+
+    def put(self, sql, args, tables: Tuple[str, ...], generation,
+            rows: dict, keyed=False):
+        """
+        Stores query results of rows by primary key and, when `keyed`,
+        each row of them. Nothing is stored if `tables` changed since
+        `generation`.
+        """
+        if not self.enabled or self.generation(tables) != generation:
+            return
+
+        key = query_key(sql, args)
+        self._store(key, dict(rows), tables)
+        for table in tables:
+            self._table_queries.setdefault(table, set()).add(key)
+
+        if keyed:
+            for row_key, row in rows.items():
+                self._store((tables[0], str(row_key)), {row_key: row},
+                            tables[:1])
+        self._shrink()
+
+    def put_rows(self, table, generation, rows: dict):
+        """
+        Stores rows of `table` by primary key, unless it changed since
+        `generation`.
+        """
+        if not self.enabled or self.generation((table,)) != generation:
+            return
+
+        for row_key, row in rows.items():
+            self._store((table, str(row_key)), {row_key: row}, (table,))
+        self._shrink()
+
+    def invalidate(self, table, key):
+        """
+        Row `key` of `table` changed, as told by a notification or a
+        write.
+        """
+        self._generations[table] = self._generations.get(table, 0) + 1
+        self.invalidations += 1
+
+        self._drop((table, str(key)))
+        for query in self._table_queries.pop(table, ()):
+            self._drop(query)
+
+    def flush(self):
+        """
+        Drops everything, for when notifications may have been missed.
+        """
+        self._epoch += 1
+        self._entries.clear()
+        self._table_queries.clear()
+        self.size = 0
+        self.flushes += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'bytes': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hitRate': self.hits / lookups if lookups else 0.0,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+            'flushes': self.flushes,
+        }
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _get(self, key) -> Optional[dict]:
+        entry = self._entries.get(key) if self.enabled else None
+        if entry is None:
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        # Callers add results to their own maps
+        return dict(entry[0])
+
+    def _store(self, key, rows, tables):
+        self._drop(key)
+        size = _sizeof(rows)
+        self._entries[key] = (rows, tables, size)
+        self.size += size
+
+    def _drop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[2]
+            self._unlink(key, entry[1])
+        return entry
+
+    def _unlink(self, key, tables):
+        # Dropped query leaves every table it reads
+        for table in tables:
+            queries = self._table_queries.get(table)
+            if queries is not None:
+                queries.discard(key)
+                if not queries:
+                    del self._table_queries[table]
+
+    def _shrink(self):
+        while self.size > self.max_bytes and self._entries:
+            key, (_, tables, size) = self._entries.popitem(last=False)
+            self.size -= size
+            self.evictions += 1
+            self._unlink(key, tables)
@@ -71,6 +71,24 @@ class _PostgresConn:
                                   % (query, args))
             raise
 
+    async def cursor(self, query, *args):
+        try:
+            query, args = _prepare(query, args)
+            return await self.conn.cursor(query, *args)
+        except:
+            self.logger.exception('Error in db cursor: %s; %s'
+                                  % (query, args))
+            raise
+
+    async def copy_records_to_table(self, table, *, records, columns):
+        try:
+            return await self.conn.copy_records_to_table(
+                table, records=records, columns=columns)
+        except:
+            self.logger.exception('Error in db copy_records_to_table: %s; %s'
+                                  % (table, columns))
+            raise
+
     async def executebatch(self, buildQuery, args, pagesize=5000, conn=None):
         if conn is None:
             conn = self.conn
@@ -109,16 +127,18 @@ class _PostgresPoolProxy:
 
 
 class _PostgresBackend:
-    def __init__(self, dsn: str):
+    def __init__(self, dsn: str, statement_cache_size=100):
         self.log = build_logger('DB')
         self.pool: asyncpg.Pool = None
         self.dsn: str = dsn
+        self.statement_cache_size = statement_cache_size
 
     async def connect(self):
         if self.pool:
             return
 
-        self.pool = await asyncpg.create_pool(dsn=self.dsn)
+        self.pool = await asyncpg.create_pool(
+            dsn=self.dsn, statement_cache_size=self.statement_cache_size)
 
     async def execute(self, query, *args):
         if isinstance(query, Q):
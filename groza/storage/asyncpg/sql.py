@@ -0,0 +1,298 @@
+"""
+SELECT builder for subscription queries. Unlike `Q`, selects nest: linked
+subscriptions are filtered by a subquery of their link source.
+"""
+import json
+from typing import List, Optional, Sequence, Tuple, Union
+
+
+def _quoted(name):
+    return f'"{name}"'
+
+
+class _Default:
+    def __repr__(self):
+        return 'DEFAULT'
+
+
+# Value of a row left to the column default
+DEFAULT = _Default()
+
+
+def _overriding(overriding) -> str:
+    return 'OVERRIDING SYSTEM VALUE ' if overriding else ''
+
+
+def insert_values(table, columns: Sequence[str],
+                  rows: Sequence[Sequence],
+                  overriding=False) -> Tuple[str, tuple]:
+    """
+    Multi-row INSERT of `rows` with values of `columns`, `DEFAULT` values
+    are left to the column defaults. `overriding` writes values into a
+    `GENERATED ALWAYS` identity column.
+    """
+    args = []
+    rows_sql = []
+    for row in rows:
+        values = []
+        for value in row:
+            if value is DEFAULT:
+                values.append('DEFAULT')
+                continue
+            args.append(value)
+            values.append(f'${len(args)}')
+        rows_sql.append('(' + ', '.join(values) + ')')
+
+    columns_sql = ', '.join(_quoted(column) for column in columns)
+    return (f'INSERT INTO {_quoted(table)} ({columns_sql}) '
+            f'{_overriding(overriding)}'
+            f'VALUES {", ".join(rows_sql)}', tuple(args))
+
+
+def key_default(table, key) -> Tuple[str, tuple]:
+    """
+    Expression of the default of `key` column: its declared default or
+    the sequence of an identity column, and whether the column is
+    `GENERATED ALWAYS`. `attidentity` is read through `row_to_json` as
+    Postgres before 10 has no such column.
+    """
+    return (
+        'SELECT coalesce('
+        '(SELECT pg_get_expr(d.adbin, d.adrelid) FROM pg_attrdef d '
+        'JOIN pg_attribute a ON a.attrelid = d.adrelid '
+        'AND a.attnum = d.adnum '
+        'WHERE d.adrelid = $1::regclass AND a.attname = $2), '
+        '\'nextval(\' || quote_literal(pg_get_serial_sequence($1, $2)) '
+        '|| \')\'), '
+        '(SELECT coalesce((row_to_json(a) ->> \'attidentity\') = \'a\', '
+        'FALSE) '
+        'FROM pg_attribute a '
+        'WHERE a.attrelid = $1::regclass AND a.attname = $2)',
+        (_quoted(table), key))
+
+
+def reserve_keys(default) -> str:
+    """
+    Takes `$1` values of a key `default` expression, in order.
+    """
+    return (f'SELECT {default} AS "_groza_key" '
+            f'FROM generate_series(1, $1) ORDER BY 1')
+
+
+def copy_staging(staging, table, columns: Sequence[str]) -> List[str]:
+    """
+    Statements creating an empty temporary `staging` table for COPY of
+    `columns` of `table`. Only a temporary table of that name is dropped.
+    """
+    columns_sql = ', '.join(_quoted(column) for column in columns)
+    return [
+        f'DROP TABLE IF EXISTS pg_temp.{_quoted(staging)}',
+        f'CREATE TEMP TABLE {_quoted(staging)} ON COMMIT DROP AS '
+        f'SELECT {columns_sql} FROM {_quoted(table)} WITH NO DATA',
+    ]
+
+
+def insert_from(table, source, columns: Sequence[str],
+                overriding=False) -> str:
+    columns_sql = ', '.join(_quoted(column) for column in columns)
+    return (f'INSERT INTO {_quoted(table)} ({columns_sql}) '
+            f'{_overriding(overriding)}'
+            f'SELECT {columns_sql} FROM pg_temp.{_quoted(source)}')
+
+
+class SqlSelect:
+    def __init__(self, table, fields: Optional[Sequence[str]] = None):
+        self.table = table
+        self.fields = fields
+        self._where: List[tuple] = []
+        self._order: List[Tuple[str, int]] = []
+        self._recursive: Optional[tuple] = None
+        self._after: Optional[list] = None
+        self._limit: Optional[int] = None
+
+    def where(self, field, value) -> 'SqlSelect':
+        self._where.append(('eq', field, value))
+        return self
+
+    def where_any(self, field, values) -> 'SqlSelect':
+        self._where.append(('any', field, list(values)))
+        return self
+
+    def where_in(self, field,
+                 source: Union['SqlSelect', Sequence]) -> 'SqlSelect':
+        """
+        `field` is among values selected by `source` subquery, or among
+        `source` values.
+        """
+        if not isinstance(source, SqlSelect):
+            return self.where_any(field, source)
+
+        self._where.append(('in', field, source))
+        return self
+
+    def where_text(self, field, values) -> 'SqlSelect':
+        """
+        `field` is among `values` given as text, like notifications carry
+        keys. Text is converted to the column type by Postgres.
+        """
+        self._where.append(('text', field, list(values)))
+        return self
+
+    def recursive(self, parent_field, key_field,
+                  depth: Optional[int] = None) -> 'SqlSelect':
+        """
+        Selects rows matching conditions and their descendants by
+        `parent_field` referencing `key_field`, `depth` levels at most.
+        Rows come ordered by depth.
+        """
+        self._recursive = (parent_field, key_field, depth)
+        return self
+
+    def order(self, field, order=1) -> 'SqlSelect':
+        self._order.append((field, order))
+        return self
+
+    def after(self, values) -> 'SqlSelect':
+        """
+        Keyset cursor: rows following the row with `values` of order
+        fields. Order fields must be unique together and not null.
+        """
+        self._after = list(values)
+        return self
+
+    def limit(self, limit) -> 'SqlSelect':
+        self._limit = limit
+        return self
+
+    def tables(self) -> Tuple[str, ...]:
+        """
+        Tables the query reads, its own first.
+        """
+        tables = [self.table]
+        for kind, _, value in self._where:
+            if kind == 'in':
+                tables.extend(table for table in value.tables()
+                              if table not in tables)
+        return tuple(tables)
+
+    def count(self, idx=1) -> Tuple[str, tuple]:
+        """
+        SQL counting rows matching conditions.
+        """
+        condition, args = self._conditions(idx)
+        sql = f'SELECT count(*) FROM {_quoted(self.table)}'
+        if condition:
+            sql += ' WHERE ' + condition
+        return sql, args
+
+    def end(self, idx=1) -> Tuple[str, tuple]:
+        """
+        SQL with arguments numbered from `idx` and the arguments.
+        """
+        condition, args = self._conditions(idx)
+
+        # Without conditions every row is a root: the table holds whole
+        # trees, walking down from each row would repeat its descendants
+        if self._recursive is not None and condition:
+            return self._end_recursive(condition, args, idx)
+
+        if self._after is not None:
+            after, after_args = self._after_condition(idx + len(args))
+            condition = f'{condition} AND {after}' if condition else after
+            args += after_args
+
+        fields = ('*' if not self.fields
+                  else ', '.join(_quoted(field) for field in self.fields))
+        sql = f'SELECT {fields} FROM {_quoted(self.table)}'
+
+        if condition:
+            sql += ' WHERE ' + condition
+
+        order = self._order_sql()
+        if order:
+            sql += ' ORDER BY ' + order
+
+        if self._limit is not None:
+            sql += f' LIMIT ${idx + len(args)}'
+            args += (self._limit,)
+
+        return sql, args
+
+    def _conditions(self, idx) -> Tuple[str, tuple]:
+        args = ()
+        conditions = []
+        for kind, field, value in self._where:
+            if kind == 'in':
+                sub_sql, sub_args = value.end(idx + len(args))
+                conditions.append(f'{_quoted(field)} IN ({sub_sql})')
+                args += sub_args
+            elif kind == 'text':
+                column = _quoted(field)
+                conditions.append(
+                    f'{column} IN (SELECT "_groza_k".{column} '
+                    f'FROM json_populate_recordset(NULL::{_quoted(self.table)}'
+                    f', ${idx + len(args)}::json) "_groza_k")')
+                args += (json.dumps([{field: key} for key in value]),)
+            else:
+                arg = f'${idx + len(args)}'
+                conditions.append(f'{_quoted(field)} = ' +
+                                  (f'ANY({arg})' if kind == 'any' else arg))
+                args += (value,)
+
+        return ' AND '.join(conditions), args
+
+    def _after_condition(self, idx) -> Tuple[str, tuple]:
+        if len(self._after) != len(self._order):
+            raise RuntimeError(f'Cursor {self._after} doesn\'t match order '
+                               f'of "{self.table}"')
+
+        terms = []
+        for cnt, (field, order) in enumerate(self._order):
+            parts = [f'{_quoted(prev)} = ${idx + prev_cnt}'
+                     for prev_cnt, (prev, _) in enumerate(self._order[:cnt])]
+            parts.append(f'{_quoted(field)} {"<" if order == -1 else ">"} '
+                         f'${idx + cnt}')
+            terms.append('(' + ' AND '.join(parts) + ')')
+
+        return '(' + ' OR '.join(terms) + ')', tuple(self._after)
+
+    def _order_sql(self, record=None):
+        if not self._order:
+            return ''
+
+        prefix = f'({_quoted(record)}).' if record else ''
+        return ', '.join(
+            prefix + _quoted(field) + (' DESC' if order == -1 else '')
+            for field, order in self._order)
+
+    def _end_recursive(self, condition, args, idx):
+        parent_field, key_field, depth = self._recursive
+        table = _quoted(self.table)
+        key = _quoted(key_field)
+
+        # Rows are carried as records: the result has exactly the table
+        # columns. Descendants matching the conditions are roots already
+        sql = (
+            f'WITH RECURSIVE "_groza_tree" AS ('
+            f'SELECT "_groza_t" AS "_groza_row", 0 AS "_groza_depth", '
+            f'ARRAY["_groza_t".{key}] AS "_groza_path" '
+            f'FROM {table} "_groza_t"'
+            + (f' WHERE {condition}' if condition else '') +
+            f' UNION ALL '
+            f'SELECT "_groza_c", "tr"."_groza_depth" + 1, '
+            f'"tr"."_groza_path" || "_groza_c".{key} '
+            f'FROM {table} "_groza_c" JOIN "_groza_tree" "tr" '
+            f'ON "_groza_c".{_quoted(parent_field)} = '
+            f'("tr"."_groza_row").{key} '
+            f'WHERE NOT "_groza_c".{key} = ANY("tr"."_groza_path")'
+        )
+        if condition:
+            sql += f' AND NOT coalesce({condition}, false)'
+        if depth is not None:
+            sql += f' AND "tr"."_groza_depth" < ${idx + len(args)}'
+            args += (depth,)
+
+        order = self._order_sql('_groza_row')
+        sql += (f') SELECT ("_groza_row").* FROM "_groza_tree" '
+                f'ORDER BY "_groza_depth"' + (', ' + order if order else ''))
+        return sql, args
@@ -0,0 +1,75 @@
+from collections import OrderedDict
+from typing import Callable, NamedTuple, Optional, Tuple
+
+
+class AsyncpgStatement(NamedTuple):
+    """
+    Generated SQL with client `fields` in the order of its arguments and
+    their column names `db_fields`. Keys taken by a statement with
+    `overriding` go into a `GENERATED ALWAYS` identity column.
+    """
+    sql: str
+    fields: Tuple[str, ...]
+    db_fields: Tuple[str, ...]
+    overriding: bool = False
+
+
+class AsyncpgStatementCache:
+    """
+    LRU cache of generated statements keyed by operation, visor settings
+    the SQL depends on and fields.
+
+    Same SQL text for same shape of writes also lets asyncpg reuse
+    statements it prepared on each pooled connection, skipping parse and
+    plan in Postgres.
+    """
+
+    def __init__(self, size=1024):
+        self._size = size
+        self._statements: OrderedDict = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(op, visor, fields: Tuple[str, ...] = ()) -> tuple:
+        # Visors of one table may differ in primary key or audit
+        return op, visor.table, visor.primary_key, visor.audit, fields
+
+    def get(self, key, build: Callable[[], AsyncpgStatement]) \
+            -> AsyncpgStatement:
+        statement = self._statements.get(key)
+        if statement is not None:
+            self._statements.move_to_end(key)
+            self.hits += 1
+            return statement
+
+        self.misses += 1
+        statement = build()
+        self._statements[key] = statement
+        if len(self._statements) > self._size:
+            self._statements.popitem(last=False)
+            self.evictions += 1
+
+        return statement
+
+    def find(self, key) -> Optional[AsyncpgStatement]:
+        """
+        Statement built before, for builds needing a query.
+        """
+        statement = self._statements.get(key)
+        if statement is not None:
+            self._statements.move_to_end(key)
+        return statement
+
+    def stats(self):
+        return {
+            'size': len(self._statements),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+    def __len__(self):
+        return len(self._statements)
@@ -0,0 +1,259 @@
+"""
+SQL of triggers auditing visor tables and notifying about their changes.
+"""
+from typing import List, Tuple
+
+# pg_notify payload must be shorter
+NOTIFY_PAYLOAD_LIMIT = 8000
+
+
+def _json_value_expr(record, column, data_type):
+    """
+    Column value encoded the same way as `json_serial` does.
+    """
+    value = f'{record}."{column}"'
+    if data_type.startswith('timestamp'):
+        return f'trunc(extract(epoch from {value}))::int8'
+
+    if data_type == 'date':
+        return f"(({value}) - date '1970-01-01') * 86400"
+
+    return value
+
+
+def json_row_expr(record, columns: List[Tuple[str, str]]):
+    """
+    jsonb of trigger `record` (NEW or OLD) with (name, data type) `columns`.
+    """
+    parts = []
+    # jsonb_build_object takes no more than 100 arguments
+    for start in range(0, len(columns), 50):
+        args = ', '.join(f"'{name}', {_json_value_expr(record, name, type_)}"
+                         for name, type_ in columns[start:start + 50])
+        parts.append(f'jsonb_build_object({args})')
+
+    return ' || '.join(parts) if parts else "'{}'::jsonb"
+
+
+def notify_sql(table, primary_key, payload, op, columns=None):
+    """
+    Statements sending the notification about one row from trigger
+    function on `op` ('I', 'U' or 'D').
+
+    With `payload` other than 'key' notification is a json object: 'op',
+    primary key 'k', new row 'r' or its changed fields 'c'. Data is left
+    out if it doesn't fit the notification.
+    """
+    record = 'OLD' if op == 'D' else 'NEW'
+    key = f'{record}."{primary_key}"'
+
+    if payload == 'key':
+        return f"PERFORM pg_notify('{table}', {key}::text);"
+
+    if op == 'D':
+        data = ''
+    elif op == 'U' and payload == 'diff':
+        new_row = json_row_expr('NEW', columns)
+        old_row = json_row_expr('OLD', columns)
+        data = (f", 'c', (SELECT coalesce(jsonb_object_agg(ch.key, ch.value), "
+                f"'{{}}'::jsonb) FROM jsonb_each({new_row}) ch "
+                f"WHERE ({old_row}) -> ch.key IS DISTINCT FROM ch.value)")
+    else:
+        data = f", 'r', {json_row_expr(record, columns)}"
+
+    indent = '\n' + ' ' * 23
+    return indent.join([
+        f"payload = jsonb_build_object('op', '{op}', 'k', {key}{data})::text;",
+        f"IF octet_length(payload) >= {NOTIFY_PAYLOAD_LIMIT} THEN",
+        f"  payload = jsonb_build_object('op', '{op}', 'k', {key})::text;",
+        "END IF;",
+        f"PERFORM pg_notify('{table}', payload);",
+    ])
+
+
+# Audit modes: 'full' - trigger compares updated rows key by key,
+# 'full-diff' - trigger compares them with hstore subtraction, 'async' -
+# application writes audit, 'notify-only' - no audit
+AUDIT_MODES = ('full', 'full-diff', 'async', 'notify-only')
+
+
+def audit_func_sql(func, table, primary_key, audit_table, audit_table_seq,
+                   last_updated_by_field, payload='key', columns=None,
+                   audit='full'):
+    """
+    Row level trigger function writing changes to `audit_table` and
+    notifying about them.
+    """
+    if audit not in AUDIT_MODES:
+        raise RuntimeError(f'Unknown audit mode "{audit}" of "{table}"')
+
+    use_int_key = f'OLD."{primary_key}"' if False else 'NULL'
+    use_var_key = f'OLD."{primary_key}"' if True else 'NULL'
+
+    use_int_key_new = f'NEW."{primary_key}"' if False else 'NULL'
+    use_var_key_new = f'NEW."{primary_key}"' if True else 'NULL'
+
+    def notify(op):
+        return notify_sql(table, primary_key, payload, op, columns)
+
+    def insert_audit(last_updated_by, int_key, var_key, op, o, n):
+        return (f"INSERT INTO \"{audit_table}\" SELECT "
+                f"nextval('{audit_table_seq}'), {last_updated_by}, {int_key}, "
+                f"now(), '{op}', '{table}', {var_key}, {o}, {n};")
+
+    if audit in ('full', 'full-diff'):
+        audit_delete = insert_audit(
+            f'OLD."{last_updated_by_field}"', use_int_key, use_var_key,
+            'D', 'hstore(OLD)', "hstore('')")
+        audit_insert = insert_audit(
+            f'NEW."{last_updated_by_field}"', use_int_key_new,
+            use_var_key_new, 'A', "hstore('')", 'hstore(NEW)')
+    else:
+        audit_delete = audit_insert = ''
+
+    if audit == 'full':
+        audit_update = """oldh = hstore(OLD);
+                       FOR r IN SELECT * FROM EACH(hstore(NEW))
+                       LOOP
+                         IF (oldh->r.key != r.value) THEN
+                           o = o || ('"' || r.key || '" => "' || (oldh->r.key) || '"')::hstore;
+                           n = n || ('"' || r.key || '" => "' || r.value || '"')::hstore;
+                         END IF;
+                       END LOOP;
+                       """ + insert_audit(
+            f'NEW."{last_updated_by_field}"', use_int_key, use_var_key,
+            'U', 'o', 'n')
+    elif audit == 'full-diff':
+        audit_update = insert_audit(
+            f'NEW."{last_updated_by_field}"', use_int_key, use_var_key,
+            'U', 'hstore(OLD) - hstore(NEW)', 'hstore(NEW) - hstore(OLD)')
+    else:
+        audit_update = ''
+
+    return f"""
+                    CREATE OR REPLACE FUNCTION "{func}"() RETURNS TRIGGER AS
+                    $$
+                    DECLARE
+                     r record;
+                     oldh hstore;
+                     o hstore := hstore('');
+                     n hstore := hstore('');
+                     payload text;
+                    BEGIN
+                     IF (TG_OP = 'DELETE') THEN
+                       {audit_delete}
+                       {notify('D')}
+                       RETURN OLD;
+                     ELSIF (TG_OP = 'UPDATE') THEN
+                       {audit_update}
+                       {notify('U')}
+                       RETURN NEW;
+                     ELSIF (TG_OP = 'INSERT') THEN
+                       {audit_insert}
+                       {notify('I')}
+                       RETURN NEW;
+                     END IF;
+                     RETURN NULL;
+                    END;
+                    $$ language plpgsql;
+                """
+
+
+# Room left in a notification for the json around the keys
+_KEYS_CHUNK_BYTES = 6000
+
+
+def statement_notify_sql(table, primary_key, op, rows):
+    """
+    Statements sending keys of all `rows` (transition table) changed by
+    the statement as json objects: 'op' and list of keys 'ks', split into
+    several notifications when needed.
+    """
+    indent = '\n' + ' ' * 23
+    return indent.join([
+        "FOR payload IN",
+        f"  SELECT jsonb_build_object('op', '{op}', 'ks', jsonb_agg(k))::text",
+        f"  FROM (SELECT k, sum(octet_length(k) + 4) OVER "
+        f"(ROWS UNBOUNDED PRECEDING) / {_KEYS_CHUNK_BYTES} AS chunk",
+        f"        FROM (SELECT \"{primary_key}\"::text AS k FROM {rows}) keys",
+        "       ) chunks",
+        "  GROUP BY chunk",
+        "LOOP",
+        f"  PERFORM pg_notify('{table}', payload);",
+        "END LOOP;",
+    ])
+
+
+def statement_audit_func_sql(func, table, primary_key, audit_table,
+                             audit_table_seq, last_updated_by_field,
+                             audit='full'):
+    """
+    Statement level trigger function writing all changes to `audit_table`
+    with one query and notifying about them in chunks of keys. Triggers
+    must name transition tables `old_rows` and `new_rows`. Both 'full'
+    audit modes compare rows with hstore subtraction here.
+    """
+    if audit not in AUDIT_MODES:
+        raise RuntimeError(f'Unknown audit mode "{audit}" of "{table}"')
+
+    def notify(op, rows):
+        return statement_notify_sql(table, primary_key, op, rows)
+
+    def insert_audit(row, op, o, n, rows):
+        return (f"INSERT INTO \"{audit_table}\" SELECT "
+                f"nextval('{audit_table_seq}'), "
+                f"{row}.\"{last_updated_by_field}\", NULL, now(), '{op}', "
+                f"'{table}', {row}.\"{primary_key}\", {o}, {n} "
+                f"FROM {rows};")
+
+    audit_delete = audit_update = audit_insert = ''
+    if audit in ('full', 'full-diff'):
+        audit_delete = insert_audit('o', 'D', 'hstore(o)', "hstore('')",
+                                    'old_rows o')
+        audit_update = insert_audit(
+            'n', 'U', 'hstore(o) - hstore(n)', 'hstore(n) - hstore(o)',
+            f'old_rows o JOIN new_rows n '
+            f'ON o."{primary_key}" = n."{primary_key}"')
+        audit_insert = insert_audit('n', 'A', "hstore('')", 'hstore(n)',
+                                    'new_rows n')
+
+    return f"""
+                    CREATE OR REPLACE FUNCTION "{func}"() RETURNS TRIGGER AS
+                    $$
+                    DECLARE
+                     payload text;
+                    BEGIN
+                     IF (TG_OP = 'DELETE') THEN
+                       {audit_delete}
+                       {notify('D', 'old_rows')}
+                     ELSIF (TG_OP = 'UPDATE') THEN
+                       {audit_update}
+                       {notify('U', 'new_rows')}
+                     ELSIF (TG_OP = 'INSERT') THEN
+                       {audit_insert}
+                       {notify('I', 'new_rows')}
+                     END IF;
+                     RETURN NULL;
+                    END;
+                    $$ language plpgsql;
+                """
+
+
+def statement_triggers_sql(trigger_prefix, table, func):
+    """
+    Statement level triggers with transition tables: one per operation,
+    as Postgres doesn't allow transition tables for several events.
+    """
+    return [
+        f"""
+                   CREATE TRIGGER "{trigger_prefix}_{event.lower()}_trigger"
+                       AFTER {event} ON "{table}"
+                       REFERENCING {transition}
+                       FOR EACH STATEMENT EXECUTE PROCEDURE "{func}"()
+                """
+        for event, transition in (
+            ('INSERT', 'NEW TABLE AS new_rows'),
+            ('UPDATE', 'OLD TABLE AS old_rows NEW TABLE AS new_rows'),
+            ('DELETE', 'OLD TABLE AS old_rows'),
+        )
+    ]
@@ -0,0 +1,677 @@
+"""
+In-process storage: rows of visor tables kept in memory, for edge caches
+and for load tests without Postgres.
+
+Rows are stored with field names as written and found through hash
+indexes on primary keys and `indexes` of visors, ordered through
+`sorted_indexes`. Every commit makes a new version: rows keep versions
+written since the oldest running session started, and sessions read the
+version they started with. Writes of a transaction are kept aside by
+row, applied at once on commit and only then notified. A transaction
+writing a row committed by another one since its version fails.
+"""
+import bisect
+from decimal import Decimal
+from typing import Any, Dict, Iterable, List, Optional
+from uuid import UUID
+
+from groza import GrozaUser, GrozaChange
+from groza.queue import BaseQueue
+from groza.storage import GrozaStorage, GrozaSession, GrozaVisor, \
+    GrozaInput, groza_visors
+
+
+def _make_key(key):
+    if isinstance(key, UUID):
+        key = str(key)
+    return key
+
+
+def _sort_value(value):
+    """
+    Sort key of `value`: nulls go last in ascending order, like in
+    Postgres, values of types not comparable to each other go by type.
+    """
+    if value is None:
+        return 1, '', 0
+    if isinstance(value, (bool, int, float, Decimal)):
+        return 0, '', value
+    return 0, type(value).__name__, value
+
+
+def _hashable(value):
+    try:
+        hash(value)
+    except TypeError:
+        return False
+    return True
+
+
+def _matches(row, where):
+    for field, value in where.items():
+        if field not in row or row[field] != value:
+            return False
+    return True
+
+
+def _follows(values, after, directions):
+    """
+    Row with order `values` comes after the row with `after` values.
+    """
+    for value, cursor, direction in zip(values, after, directions):
+        value, cursor = _sort_value(value), _sort_value(cursor)
+        if value == cursor:
+            continue
+        return value > cursor if direction != -1 else value < cursor
+    return False
+
+
+class _MemoryTable:
+    """
+    Rows of one table by primary key, each as a list of its versions, and
+    indexes over every kept version.
+    """
+
+    def __init__(self, primary_key, indexes: Iterable[str] = (),
+                 sorted_indexes: Iterable[str] = ()):
+        self.primary_key = primary_key
+        # key -> [(version, row or None when deleted)], oldest first
+        self.versions: Dict[Any, List[tuple]] = {}
+        # Notifications and text lookups carry keys as text
+        self.text_keys: Dict[str, Any] = {}
+        # field -> value -> primary keys
+        self.indexes: Dict[str, Dict[Any, set]] = {
+            field: {} for field in indexes}
+        # field -> sorted (value, primary key)
+        self.sorted: Dict[str, List[tuple]] = {
+            field: [] for field in sorted_indexes}
+
+    def get(self, key, version) -> Optional[dict]:
+        """
+        Row `key` as of `version`, None if there was none.
+        """
+        for row_version, row in reversed(self.versions.get(key, ())):
+            if row_version <= version:
+                return row
+        return None
+
+    def put(self, key, row: Optional[dict], version):
+        """
+        Adds `version` of row `key`, None when it is deleted.
+        """
+        self.versions.setdefault(key, []).append((version, row))
+        if row is None:
+            return
+
+        self.text_keys[str(key)] = key
+        for field, index in self.indexes.items():
+            value = row.get(field)
+            if _hashable(value):
+                index.setdefault(value, set()).add(key)
+        for field, entries in self.sorted.items():
+            entry = (_sort_value(row.get(field)), key)
+            pos = bisect.bisect_left(entries, entry)
+            if pos == len(entries) or entries[pos] != entry:
+                entries.insert(pos, entry)
+
+    def apply(self, op, key, data, version) -> Optional[dict]:
+        """
+        Applies a logged write as `version`, returns the new row or None if
+        nothing was written.
+        """
+        if op == 'I':
+            self.put(key, data, version)
+            return data
+
+        old = self.get(key, version)
+        if old is None:
+            return None
+
+        if op == 'U':
+            row = {**old, **data}
+            if row[self.primary_key] != key:
+                self.put(key, None, version)
+            self.put(row[self.primary_key], row, version)
+            return row
+
+        self.put(key, None, version)
+        return old
+
+    def prune(self, key, oldest) -> int:
+        """
+        Drops versions of row `key` sessions reading `oldest` or later
+        versions can't see, returns how many.
+        """
+        versions = self.versions.get(key)
+        if not versions:
+            return 0
+
+        start = 0
+        for idx, (row_version, _) in enumerate(versions):
+            if row_version <= oldest:
+                start = idx
+        kept = versions[start:]
+        if kept[0][1] is None and kept[0][0] <= oldest:
+            kept = kept[1:]
+
+        dropped = versions[:len(versions) - len(kept)]
+        if not dropped:
+            return 0
+
+        if kept:
+            self.versions[key] = kept
+        else:
+            del self.versions[key]
+            self.text_keys.pop(str(key), None)
+
+        kept_rows = [row for _, row in kept if row is not None]
+        for _, row in dropped:
+            if row is not None:
+                self._unindex(key, row, kept_rows)
+        return len(dropped)
+
+    def _unindex(self, key, row, kept_rows):
+        for field, index in self.indexes.items():
+            value = row.get(field)
+            if not _hashable(value) or any(
+                    kept.get(field) == value for kept in kept_rows):
+                continue
+            keys = index.get(value)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del index[value]
+
+        for field, entries in self.sorted.items():
+            value = _sort_value(row.get(field))
+            if any(_sort_value(kept.get(field)) == value
+                   for kept in kept_rows):
+                continue
+            entry = (value, key)
+            pos = bisect.bisect_left(entries, entry)
+            if pos < len(entries) and entries[pos] == entry:
+                del entries[pos]
+
+
+class _MemoryView:
+    """
+    Table as a session sees it: as of its `version` with writes of its
+    transaction, `own`, on top.
+    """
+
+    def __init__(self, table: _MemoryTable, version,
+                 own: Optional[Dict[Any, Optional[dict]]] = None):
+        self.table = table
+        self.primary_key = table.primary_key
+        self.version = version
+        self.own = own or {}
+
+    def get(self, key) -> Optional[dict]:
+        if key in self.own:
+            return self.own[key]
+        return self.table.get(key, self.version)
+
+    def text_key(self, text):
+        for key in self.own:
+            if str(key) == text:
+                return key
+        return self.table.text_keys.get(text)
+
+    def select(self, where=None, keys=None, link_field=None,
+               link_ids=None) -> List[dict]:
+        """
+        Rows matching equality `where`, with `keys` and with `link_field`
+        among `link_ids`, looked up through the narrowest index.
+        """
+        table = self.table
+        where = where or {}
+        link_ids = set(link_ids) if link_field is not None else None
+
+        candidates = None
+        if keys is not None:
+            candidates = keys
+        else:
+            options = []
+            if self.primary_key in where:
+                options.append((where[self.primary_key],))
+            for field, value in where.items():
+                index = table.indexes.get(field)
+                if index is not None and _hashable(value):
+                    options.append(index.get(value, ()))
+            if link_field is not None and link_field in table.indexes:
+                index = table.indexes[link_field]
+                options.append([key for link_id in link_ids
+                                for key in index.get(link_id, ())])
+            if options:
+                candidates = list(min(options, key=len)) + list(self.own)
+
+        if candidates is None:
+            candidates = list(table.versions) + list(self.own)
+
+        # Indexes hold keys of every kept version: rows are checked again
+        rows = []
+        for key in dict.fromkeys(key for key in candidates
+                                 if _hashable(key)):
+            row = self.get(key)
+            if row is not None and _matches(row, where) \
+                    and (link_ids is None or row.get(link_field) in link_ids):
+                rows.append(row)
+        return rows
+
+    def order(self, rows: List[dict], order) -> List[dict]:
+        """
+        `rows` ordered by `order` fields and then by primary key.
+        """
+        fields = list(order.items())
+        if self.primary_key not in order:
+            fields.append((self.primary_key, 1))
+
+        # Index entries tie by ascending primary key. Walking an index
+        # beats sorting only for a large part of the table
+        field, direction = fields[0]
+        # Rows written by the transaction are not in the index
+        if direction == 1 and field in self.table.sorted and not self.own \
+                and fields[1:] in ([], [(self.primary_key, 1)]) \
+                and len(rows) * 4 >= len(self.table.versions):
+            chosen = {row[self.primary_key]: row for row in rows}
+            return [chosen[key] for value, key in self.table.sorted[field]
+                    if key in chosen
+                    and _sort_value(chosen[key].get(field)) == value]
+
+        rows = list(rows)
+        for field, direction in reversed(fields):
+            rows.sort(key=lambda row: _sort_value(row.get(field)),
+                      reverse=direction == -1)
+        return rows
+
+    def descendants(self, roots: List[dict], parent_field,
+                    depth=None) -> List[List[dict]]:
+        """
+        Levels of rows under `roots` by `parent_field`, at most `depth`
+        levels down. Rows already met, like roots, are not repeated.
+        """
+        index = self.table.indexes.get(parent_field)
+        if index is None or self.own:
+            index = {}
+            for row in self.select():
+                parent = row.get(parent_field)
+                if parent is not None and _hashable(parent):
+                    index.setdefault(parent, set()).add(
+                        row[self.primary_key])
+
+        seen = {row[self.primary_key] for row in roots}
+        levels = []
+        level = roots
+        while level and (depth is None or len(levels) < depth):
+            children = []
+            for parent in level:
+                parent_key = parent[self.primary_key]
+                for key in index.get(parent_key, ()):
+                    row = self.get(key) if key not in seen else None
+                    if row is not None and row.get(parent_field) == parent_key:
+                        seen.add(key)
+                        children.append(row)
+            if children:
+                levels.append(children)
+            level = children
+        return levels
+
+
+class _MemoryTransactionProxy:
+    def __init__(self, session: 'MemorySession'):
+        self._session = session
+        self._outer = False
+
+    async def __aenter__(self):
+        # Nested transactions are a part of the outer one
+        self._outer = self._session._log is None
+        if self._outer:
+            self._session._log = []
+            self._session._own = {}
+        return self._session
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        if not self._outer:
+            return
+
+        log = self._session._log
+        self._session._log = None
+        self._session._own = {}
+        if exc_type is None and log:
+            self._session._commit(log, self._session._version)
+
+
+class MemorySession(GrozaSession):
+    def __init__(self, storage: 'MemoryStorage'):
+        self._storage = storage
+        # Version of rows read, pinned against pruning
+        self._version: Optional[int] = storage._pin()
+        # Writes of the current transaction: the log and written rows by
+        # table and key, None for deleted ones
+        self._log: Optional[list] = None
+        self._own: Dict[str, Dict[Any, Optional[dict]]] = {}
+
+    def transaction(self):
+        return _MemoryTransactionProxy(self)
+
+    def raw_conn(self):
+        pass
+
+    async def insert(self, *, visor: GrozaVisor, insert: GrozaInput,
+                     user: GrozaUser):
+        row = dict(insert)
+        key = row.get(visor.primary_key)
+        row[visor.primary_key] = self._storage._next_key(visor, key)
+        self._write(visor, 'I', row[visor.primary_key], row)
+        return dict(row)
+
+    async def update(self, *, visor: GrozaVisor, update, user: GrozaUser):
+        query, upd = update
+        self._write(visor, 'U', query[visor.primary_key], dict(upd))
+
+    async def delete(self, *, visor: GrozaVisor, delete, user: GrozaUser):
+        self._write(visor, 'D', delete[visor.primary_key], None)
+
+    async def query(self, *, visor: GrozaVisor, from_sub, all_sub, sub_resp,
+                    where=None, order=None, keys=None, recursive=None,
+                    recursive_depth=None, limit=None, after=None):
+        table = self._view(visor)
+
+        link_field = link_ids = None
+        if from_sub is not None:
+            link_field, link_ids = self._link(visor, all_sub, sub_resp,
+                                              from_sub)
+
+        rows = table.select(where=where, keys=keys, link_field=link_field,
+                            link_ids=link_ids)
+
+        if recursive is not None:
+            # Descendants matching conditions are roots already
+            rows = table.order(rows, order or {})
+            for level in table.descendants(rows, recursive[0],
+                                           recursive_depth):
+                rows.extend(table.order(level, order or {}))
+            # Nested rows get attached to their parents
+            rows = [dict(row) for row in rows]
+        elif order or limit is not None or after is not None:
+            rows = table.order(rows, order or {})
+
+            if after is not None:
+                fields = list(order or {})
+                if visor.primary_key not in fields:
+                    fields.append(visor.primary_key)
+                if len(after) != len(fields):
+                    raise RuntimeError(f'Cursor {after} doesn\'t match '
+                                       f'order of "{visor.table}"')
+                directions = [(order or {}).get(field, 1) for field in fields]
+                rows = [row for row in rows
+                        if _follows([row.get(field) for field in fields],
+                                    after, directions)]
+
+            if limit is not None:
+                rows = rows[:limit]
+
+        return ({_make_key(row[visor.primary_key]): row for row in rows},
+                link_field)
+
+    async def query_keys(self, *, visor: GrozaVisor, keys):
+        table = self._view(visor)
+        rows = {}
+        for text in keys:
+            key = table.text_key(str(text))
+            row = table.get(key) if key is not None else None
+            if row is not None:
+                rows[_make_key(key)] = row
+        return rows
+
+    async def count(self, *, visor: GrozaVisor, from_sub, all_sub, sub_resp,
+                    where=None, estimate=False):
+        link_field = link_ids = None
+        if from_sub is not None:
+            link_field, link_ids = self._link(visor, all_sub, sub_resp,
+                                              from_sub)
+        return len(self._view(visor).select(
+            where=where, link_field=link_field, link_ids=link_ids))
+
+    def close(self):
+        if self._version is not None:
+            self._storage._unpin(self._version)
+            self._version = None
+
+    def _view(self, visor) -> _MemoryView:
+        return _MemoryView(self._storage._table(visor), self._version,
+                           self._own.get(visor.table))
+
+    @staticmethod
+    def _link(visor, all_sub, sub_resp, link_sub):
+        if link_sub not in all_sub:
+            raise RuntimeError(f'Link "{link_sub}" not found in '
+                               f'subscriptions. Check identifiers')
+        if link_sub not in sub_resp:
+            raise RuntimeError(f'Link "{link_sub}" not found in results')
+
+        link_visor = groza_visors.get().require_visor(
+            all_sub[link_sub]['visor'])
+        link_field = visor.link_field(link_visor)
+        if not link_field:
+            raise RuntimeError(f'Link "{visor.table}"=>"{link_visor.table}" '
+                               f'not found')
+        return link_field, sub_resp[link_sub]['ids']
+
+    def _write(self, visor, op, key, data):
+        entry = (visor, op, key, data)
+        if self._log is None:
+            self._commit([entry])
+            return
+
+        # Only written rows are kept aside, the table is left as it is
+        table = self._view(visor)
+        self._storage._check(visor, op, key, table.get(key) is not None)
+        own = self._own.setdefault(visor.table, {})
+        if op == 'I':
+            own[key] = data
+        elif op == 'D':
+            own[key] = None
+        else:
+            old = table.get(key)
+            if old is not None:
+                row = {**old, **data}
+                if row[visor.primary_key] != key:
+                    own[key] = None
+                own[row[visor.primary_key]] = row
+        self._log.append(entry)
+
+    def _commit(self, log, version=None):
+        # Own version must not keep rows the commit replaces
+        self._storage._unpin(self._version)
+        self._version = None
+        try:
+            self._storage._commit(log, version)
+        finally:
+            self._version = self._storage._pin()
+
+
+class _MemorySessionProxy:
+    def __init__(self, storage: 'MemoryStorage'):
+        self._storage = storage
+        self._session: Optional[MemorySession] = None
+
+    async def __aenter__(self):
+        self._session = MemorySession(self._storage)
+        return self._session
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self._session.close()
+
+
+class MemoryStorage(GrozaStorage):
+    def __init__(self):
+        self._tables: Dict[str, _MemoryTable] = {}
+        self._serials: Dict[str, int] = {}
+        self._notifications: Optional[BaseQueue] = None
+
+        # Version of the last commit and versions read by sessions
+        self._version = 0
+        self._readers: Dict[int, int] = {}
+        # table -> keys of rows with versions to prune
+        self._stale: Dict[str, set] = {}
+
+        # Row versions no session could read any more
+        self.pruned_count = 0
+
+    async def install(self, notifications: BaseQueue):
+        self._notifications = notifications
+
+    async def connect(self):
+        pass
+
+    async def close(self):
+        pass
+
+    def session(self):
+        return _MemorySessionProxy(self)
+
+    def release(self, session: MemorySession):
+        session.close()
+
+    def load(self, visor, rows: Iterable[dict]):
+        """
+        Puts `rows` into the table of `visor` without notifications, like
+        when filling a cache.
+        """
+        table = self._table(visor)
+        self._version += 1
+        for row in rows:
+            row = dict(row)
+            row[visor.primary_key] = self._next_key(
+                visor, row.get(visor.primary_key))
+            table.put(row[visor.primary_key], row, self._version)
+            self._mark_stale(visor.table, row[visor.primary_key])
+        self._prune()
+
+    def unload(self, visor, keys: Iterable):
+        """
+        Removes rows with `keys` from the table of `visor` without
+        notifications, like when evicting them from a cache.
+        """
+        table = self._table(visor)
+        self._version += 1
+        for key in keys:
+            if table.get(key, self._version) is not None:
+                table.put(key, None, self._version)
+                self._mark_stale(visor.table, key)
+        self._prune()
+
+    def stats(self):
+        tables = self._tables.values()
+        return {
+            'tables': len(self._tables),
+            'rows': sum(1 for table in tables for key in table.versions
+                        if table.get(key, self._version) is not None),
+            'versions': sum(len(versions) for table in tables
+                            for versions in table.versions.values()),
+            'readers': sum(self._readers.values()),
+            'pruned': self.pruned_count,
+        }
+
+    def _table(self, visor) -> _MemoryTable:
+        table = self._tables.get(visor.table)
+        if table is None:
+            table = _MemoryTable(visor.primary_key,
+                                 indexes=visor.indexes,
+                                 sorted_indexes=visor.sorted_indexes)
+            self._tables[visor.table] = table
+        return table
+
+    def _pin(self) -> int:
+        self._readers[self._version] = \
+            self._readers.get(self._version, 0) + 1
+        return self._version
+
+    def _unpin(self, version):
+        self._readers[version] -= 1
+        if not self._readers[version]:
+            del self._readers[version]
+            self._prune()
+
+    def _mark_stale(self, table_name, key):
+        if len(self._tables[table_name].versions.get(key, ())) > 1:
+            self._stale.setdefault(table_name, set()).add(key)
+
+    def _prune(self):
+        """
+        Drops row versions older than what the oldest session reads.
+        """
+        oldest = min(self._readers, default=self._version)
+        for table_name, keys in list(self._stale.items()):
+            table = self._tables[table_name]
+            for key in list(keys):
+                self.pruned_count += table.prune(key, oldest)
+                versions = table.versions.get(key)
+                if not versions or len(versions) == 1 \
+                        and versions[0][1] is not None:
+                    keys.discard(key)
+            if not keys:
+                del self._stale[table_name]
+
+    def _next_key(self, visor, key=None):
+        """
+        Keys like a serial column: generated ones are never reused, even if
+        their transaction fails.
+        """
+        serial = self._serials.get(visor.table, 0)
+        if key is None:
+            key = serial + 1
+        if isinstance(key, int):
+            self._serials[visor.table] = max(serial, key)
+        return key
+
+    @staticmethod
+    def _check(visor, op, key, exists):
+        if op == 'I' and exists:
+            raise RuntimeError(f'Duplicate key {key} of "{visor.table}"')
+        return exists if op == 'U' else op == 'I'
+
+    def _commit(self, log, version=None):
+        """
+        Applies logged writes at once as a new version: nothing is written
+        if any of them fails. Writes of a transaction reading `version`
+        fail on rows committed after it.
+        """
+        written = {}
+        for visor, op, key, data in log:
+            table = self._table(visor)
+            versions = table.versions.get(key)
+            if version is not None and versions \
+                    and versions[-1][0] > version:
+                raise RuntimeError(f'Row {key} of "{visor.table}" changed '
+                                   f'by another transaction')
+            keys = written.setdefault(visor.table, {})
+            exists = (keys[key] if key in keys
+                      else table.get(key, self._version) is not None)
+            keys[key] = self._check(visor, op, key, exists)
+            if op == 'U' and data.get(visor.primary_key, key) != key:
+                keys[data[visor.primary_key]] = keys.pop(key)
+
+        self._version += 1
+        changes = []
+        for visor, op, key, data in log:
+            row = self._table(visor).apply(op, key, data, self._version)
+            if row is not None:
+                changes.append(self._change(visor, op, key, row, data))
+                self._mark_stale(visor.table, key)
+                self._mark_stale(visor.table, row[visor.primary_key])
+        self._prune()
+
+        if self._notifications is not None:
+            for change in changes:
+                self._notifications.put_nowait(change)
+
+    @staticmethod
+    def _change(visor, op, key, row, data) -> GrozaChange:
+        obj_id = str(row[visor.primary_key])
+        if op == 'D' or visor.notify_payload == 'key':
+            return GrozaChange(0, visor.table, obj_id, op)
+        if op == 'U' and visor.notify_payload == 'diff':
+            return GrozaChange(0, visor.table, obj_id, op, changed=data)
+        return GrozaChange(0, visor.table, obj_id, op, row=row)
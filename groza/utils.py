@@ -1,10 +1,18 @@
+import json
 import logging
 import logging.handlers
 from abc import abstractmethod
+from functools import lru_cache
+from typing import Callable, Sequence
 
 from datetime import datetime, date, timezone
 from uuid import UUID
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 
 def json_serial(obj):
     if isinstance(obj, datetime):
@@ -23,6 +31,59 @@ def json_serial(obj):
     raise TypeError('Type %s not serializable' % type(obj))
 
 
+def json_value(obj):
+    """
+    `obj` as clients get it in JSON, to compare values of rows to values
+    sent by clients.
+    """
+    if isinstance(obj, (datetime, date, UUID)):
+        return json_serial(obj)
+    return obj
+
+
+class JsonCodec:
+    """
+    Encodes responses and decodes requests with the standard library.
+    """
+    name = 'json'
+
+    def dumps(self, obj) -> str:
+        return json.dumps(obj, default=json_serial)
+
+    def loads(self, data):
+        return json.loads(data)
+
+
+class OrjsonCodec(JsonCodec):
+    """
+    orjson codec. UUIDs are encoded natively, dates still go through
+    `json_serial` to keep timestamps the same as with the standard library.
+    """
+    name = 'orjson'
+
+    OPTIONS = (orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+               if orjson is not None else 0)
+
+    def dumps(self, obj) -> str:
+        return orjson.dumps(obj, default=json_serial,
+                            option=self.OPTIONS).decode('utf-8')
+
+    def loads(self, data):
+        return orjson.loads(data)
+
+
+def default_json_codec() -> JsonCodec:
+    """
+    orjson codec when orjson is installed, standard library one otherwise.
+    """
+    if orjson is not None:
+        return OrjsonCodec()
+    return JsonCodec()
+
+
+json_codec: JsonCodec = default_json_codec()
+
+
 def init_file_loggers(filename, names):
     for name in names:
         logger = logging.getLogger(name)
@@ -106,3 +167,38 @@ class CamelCaseFieldTransformer(FieldTransformer):
                 state = ST_NORMAL
 
         return build
+
+
+class FieldCodec:
+    """
+    Field names of a `FieldTransformer` converted once and remembered, and
+    row converters compiled per result shape. Clients send field names
+    too: no more than `names` names and `shapes` shapes are remembered,
+    least recently used are forgotten.
+    """
+
+    def __init__(self, transformer: FieldTransformer, names=4096,
+                 shapes=256):
+        self.transformer = transformer
+        self.to_db: Callable[[str], str] = \
+            lru_cache(maxsize=names)(transformer.to_db)
+        self.from_db: Callable[[str], str] = \
+            lru_cache(maxsize=names)(transformer.from_db)
+        self._decoder = lru_cache(maxsize=shapes)(self._build_decoder)
+
+    def row_decoder(self, columns: Sequence[str]) -> Callable:
+        """
+        Function converting a row with `columns` (values by position) to a
+        dict with client field names.
+        """
+        return self._decoder(tuple(columns))
+
+    def _build_decoder(self, columns: tuple) -> Callable:
+        items = ', '.join(f'{self.from_db(column)!r}: row[{idx}]'
+                          for idx, column in enumerate(columns))
+        namespace = {}
+        exec(f'def decode(row):\n    return {{{items}}}', namespace)
+        return namespace['decode']
+
+    def decode_row(self, row: dict) -> dict:
+        return {self.from_db(key): value for key, value in row.items()}
@@ -28,14 +28,26 @@ class PytestMemoryStorage:
     def destroy(self):
         pass
 
-    @property
-    def _schema(self) -> TSchema:
-        db = groza_db.get()
-        return db.schema
+    def put(self, table_name, row):
+        """
+        Writes `row` to the storage without notifying of it.
+        """
+        groza_db.get().put(table_name, row)
+
+    def remove(self, table_name, key):
+        groza_db.get().remove(table_name, key)
 
     def query(self, table_name, order_field):
-        schema = self._schema
-        return sorted(schema.tables[table_name].data, key=itemgetter(order_field))
+        visor = groza_visors.get().table_visor(table_name)
+
+        async def rows():
+            async with groza_db.get().session() as session:
+                data, _ = await session.query(visor=visor, from_sub=None,
+                                              all_sub={}, sub_resp={})
+                return list(data.values())
+
+        return sorted(asyncio.get_event_loop().run_until_complete(rows()),
+                      key=itemgetter(order_field))
 
 
 class PytestAsyncpgStorage:
@@ -71,6 +83,14 @@ class PytestAsyncpgStorage:
     def destroy(self):
         asyncio.get_event_loop().run_until_complete(self._schema_exec.destroy())
 
+    def put(self, table_name, row):
+        asyncio.get_event_loop().run_until_complete(
+            self._schema_exec.put(table_name, row))
+
+    def remove(self, table_name, key):
+        asyncio.get_event_loop().run_until_complete(
+            self._schema_exec.remove(table_name, key))
+
     def query(self, table_name, order_field):
         return asyncio.get_event_loop().run_until_complete(
             self._schema_exec.query(table_name, order_field))
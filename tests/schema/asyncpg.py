@@ -28,6 +28,24 @@ class AsyncpgSchemaExecutor:
                                  from_(table.name).order(order_field, 1)))
                 return [dict(res) for res in result]
 
+    async def put(self, table_name, row):
+        columns = ', '.join(f'"{column}"' for column in row)
+        values = ', '.join(f'${idx}' for idx in range(1, len(row) + 1))
+        async with self._storage.session() as session:
+            async with session.transaction():
+                await self.remove(table_name, row['id'], session)
+                await session.raw_conn().execute(
+                    f'INSERT INTO {table_name} ({columns}) VALUES ({values})',
+                    *row.values())
+
+    async def remove(self, table_name, key, session=None):
+        if session is None:
+            async with self._storage.session() as session:
+                return await self.remove(table_name, key, session)
+
+        await session.raw_conn().execute(
+            f'DELETE FROM {table_name} WHERE id = $1', key)
+
     @classmethod
     def _format_type(cls, type_):
         if type_ == TType.INT8:
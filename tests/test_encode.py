@@ -0,0 +1,61 @@
+import asyncio
+import json
+import time
+
+import pytest
+
+from groza.server.encode import estimate_values, GrozaEncoder, \
+    LoopLagMonitor
+
+
+def test_estimate_values():
+    rows = {1: {'id': 1, 'name': 'a'}, 2: {'id': 2, 'name': 'b'}}
+    assert estimate_values({'data': {'accounts': rows}}) == 4
+    assert estimate_values({'data': {'accounts': {
+        'columns': ['id', 'name'], 'rows': [[1, 'a'], [2, 'b']]}}}) == 4
+    assert estimate_values({'data': {'accounts': {
+        'columns': ['id', 'name'], 'values': [[1, 2], ['a', 'b']]}}}) == 4
+    assert estimate_values({'status': 'ok'}) == 0
+
+
+def test_encoder_chunks_large():
+    encoder = GrozaEncoder(chunk_values=4)
+    run = asyncio.get_event_loop().run_until_complete
+
+    small = {'data': {'accounts': {1: {'id': 1}}}}
+    assert json.loads(run(encoder.encode(small))) == {
+        'data': {'accounts': {'1': {'id': 1}}}}
+
+    rows = {i: {'id': i, 'name': str(i)} for i in range(10)}
+    large = {'type': 'data', 'data': {'accounts': rows, 'empty': {}},
+             'sub': {'all': {'ids': list(rows)}}}
+    assert json.loads(run(encoder.encode(large))) == json.loads(
+        encoder.codec.dumps(large))
+
+    for table in ({'columns': ['id', 'name'],
+                   'rows': [[i, str(i)] for i in range(10)]},
+                  {'columns': ['id', 'name'],
+                   'values': [list(range(10)), [str(i) for i in range(10)]]}):
+        resp = {'data': {'accounts': table}}
+        assert json.loads(run(encoder.encode(resp))) == resp
+
+    assert encoder.inline_count == 1
+    assert encoder.chunked_count == 3
+
+
+def test_loop_lag_monitor():
+    monitor = LoopLagMonitor(interval=0.01, warn_lag=1)
+
+    async def block():
+        monitor.start()
+        await asyncio.sleep(0.02)
+        time.sleep(0.1)
+        await asyncio.sleep(0.02)
+        monitor.stop()
+
+    asyncio.get_event_loop().run_until_complete(block())
+    assert monitor.max_lag >= 0.05
+
+
+if __name__ == '__main__':
+    pytest.main(['-s', '-x', __file__])
@@ -0,0 +1,69 @@
+import asyncio
+
+import pytest
+
+from groza.instance import Groza
+from groza.server import GrozaServer
+
+
+class RecordGrozaServer(GrozaServer):
+    def __init__(self, name):
+        super().__init__(name)
+        self.changes = []
+        self.ops = []
+
+    async def notify_connection_start(self, conn):
+        pass
+
+    async def notify_connection_close(self, conn):
+        pass
+
+    async def notify_change(self, pid, channel, obj_id,
+                            op=None, row=None, changed=None):
+        self.changes.append((channel, obj_id))
+        self.ops.append(op)
+
+
+def test_loop_dispatches_batch():
+    groza = Groza()
+    server = RecordGrozaServer('main')
+
+    async def run():
+        await groza.add_servers(server)
+        loop_task = asyncio.ensure_future(groza.loop())
+
+        groza._notifications.put_nowait((1, 'accounts', '1'))
+        groza._notifications.put_nowait((1, 'accounts', '2'))
+        groza._notifications.put_nowait((2, 'accounts', '1'))
+        groza.stop()
+
+        await asyncio.wait_for(loop_task, timeout=1)
+
+    asyncio.get_event_loop().run_until_complete(run())
+
+    assert server.changes == [('accounts', '1'), ('accounts', '2')]
+
+
+def test_loop_keeps_key_changes_after_inline():
+    groza = Groza()
+    server = RecordGrozaServer('main')
+
+    async def run():
+        await groza.add_servers(server)
+        loop_task = asyncio.ensure_future(groza.loop())
+
+        groza._notifications.put_nowait((1, 'accounts', '1', 'U'))
+        groza._notifications.put_nowait((1, 'accounts', '1', 'U'))
+        groza._notifications.put_nowait((1, 'accounts', '1', 'D'))
+        groza._notifications.put_nowait((1, 'accounts', '1', 'I'))
+        groza.stop()
+
+        await asyncio.wait_for(loop_task, timeout=1)
+
+    asyncio.get_event_loop().run_until_complete(run())
+
+    assert server.ops == ['U', 'D', 'I']
+
+
+if __name__ == '__main__':
+    pytest.main(['-s', '-x', __file__])
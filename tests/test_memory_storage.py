@@ -0,0 +1,326 @@
+import asyncio
+import json
+from datetime import datetime, timezone
+
+import pytest
+
+from groza import GrozaUser
+from groza.queue.asyncio_queue import AsyncioQueue
+from groza.state import GrozaHandler
+from groza.storage import groza_db, groza_visors, GrozaVisors, GrozaVisor, \
+    GrozaForeignKey
+from groza.storage.memory import MemoryStorage, MemorySession
+
+
+def run(coro):
+    return asyncio.get_event_loop().run_until_complete(coro)
+
+
+@pytest.fixture(scope='function')
+def memory_storage():
+    storage = MemoryStorage()
+    groza_db.set(storage)
+    groza_visors.set(GrozaVisors())
+
+    class Account(GrozaVisor):
+        table = 'accounts'
+        primary_key = 'id'
+        notify_payload = 'row'
+
+        indexes = ('org',)
+        sorted_indexes = ('name',)
+
+    class Post(GrozaVisor):
+        table = 'posts'
+        primary_key = 'id'
+
+        indexes = ('account_id',)
+
+        account = GrozaForeignKey('Account', 'account_id')
+
+    class Category(GrozaVisor):
+        table = 'categories'
+        primary_key = 'id'
+
+    storage.load(Account, [
+        {'id': 1, 'name': 'ccc', 'org': 1},
+        {'id': 2, 'name': 'aaa', 'org': 1},
+        {'id': 3, 'name': 'bbb', 'org': 2},
+    ])
+    storage.load(Post, [
+        {'id': 10, 'account_id': 1},
+        {'id': 20, 'account_id': 2},
+        {'id': 30, 'account_id': 3},
+    ])
+    storage.load(Category, [
+        {'id': 1, 'parent_id': None},
+        {'id': 2, 'parent_id': 1},
+        {'id': 3, 'parent_id': 2},
+        {'id': 4, 'parent_id': None},
+    ])
+    return storage
+
+
+def test_memory_query(memory_storage):
+    groza = GrozaHandler()
+    resp = run(groza.fetch_sub(GrozaUser(user_id=1), {
+        'org': {'visor': 'Account', 'where': {'org': 1},
+                'order': {'name': 1}},
+        'posts': {'visor': 'Post', 'fromSub': 'org'},
+        'tree': {'visor': 'Category', 'where': {'id': 1},
+                 'recursive': ['parent_id', 'children'],
+                 'recursiveDepth': 1},
+    }))
+
+    sub = resp.data['sub']
+    assert sub['org']['ids'] == [2, 1]
+    assert sorted(sub['posts']['ids']) == [10, 20]
+    assert sub['posts']['fromSub'] == {1: [10], 2: [20]}
+    assert sub['tree']['ids'] == [1]
+    assert resp.data['data']['categories'][1]['children'] == [2]
+    assert 3 not in resp.data['data']['categories']
+
+    # Keyset pages by a sorted index
+    resp = run(groza.fetch_sub(GrozaUser(user_id=1), {
+        'page': {'visor': 'Account', 'order': {'name': 1}, 'limit': 2,
+                 'after': ['aaa', 2], 'total': 'exact'},
+    }))
+    page = resp.data['sub']['page']
+    assert page['ids'] == [3, 1]
+    assert page['hasMore'] is False
+    assert page['total'] == 3
+
+
+def test_memory_shared_rows_keep_injected(memory_storage):
+    groza = GrozaHandler()
+    tree = {'visor': 'Category', 'where': {'id': 1},
+            'recursive': ['parent_id', 'children']}
+    flat = {'visor': 'Category'}
+
+    for all_sub in ({'tree': tree, 'flat': flat},
+                    {'flat': flat, 'tree': tree}):
+        resp = run(groza.fetch_sub(GrozaUser(user_id=1), all_sub))
+        categories = resp.data['data']['categories']
+        assert categories[1]['children'] == [2]
+        assert categories[2]['children'] == [3]
+        assert sorted(categories) == [1, 2, 3, 4]
+
+
+def test_memory_deep_tree_rows_once(memory_storage):
+    class Node(GrozaVisor):
+        table = 'nodes'
+        primary_key = 'id'
+
+    memory_storage.load(Node, [
+        {'id': idx, 'parent_id': idx - 1 if idx > 1 else None}
+        for idx in range(1, 201)])
+
+    groza = GrozaHandler()
+    resp = run(groza.fetch_sub(GrozaUser(user_id=1), {
+        'tree': {'visor': 'Node', 'recursive': ['parent_id', 'children']},
+    }))
+
+    nodes = resp.data['data']['nodes']
+    assert len(nodes) == 200
+    assert resp.data['sub']['tree']['ids'] == [1]
+    assert all(nodes[idx]['children'] == [idx + 1] for idx in range(1, 200))
+
+
+def test_memory_typed_cursor(memory_storage):
+    class Event(GrozaVisor):
+        table = 'events'
+        primary_key = 'id'
+
+    memory_storage.load(Event, [
+        {'id': idx, 'created': datetime(2020, 1, 4 - idx,
+                                        tzinfo=timezone.utc)}
+        for idx in range(1, 4)])
+
+    groza = GrozaHandler()
+    user = GrozaUser(user_id=1)
+    all_sub = {'events': {'visor': 'Event', 'order': {'created': 1},
+                          'limit': 1}}
+    resp = run(groza.fetch_sub(user, all_sub))
+    page = resp.data['sub']['events']
+    assert page['ids'] == [3]
+    assert page['cursor'] == [
+        {'type': 'datetime', 'value': '2020-01-01T00:00:00+00:00'}, 3]
+
+    # Cursor survives the trip through JSON to the client and back
+    cursor = json.loads(json.dumps(page['cursor']))
+    resp = run(groza.fetch_sub(user, {
+        'events': {**all_sub['events'], 'after': cursor}}))
+    assert resp.data['sub']['events']['ids'] == [2]
+
+    resp = run(groza.fetch_more(user, all_sub, 'events',
+                                {'events': {**page, 'cursor': cursor}}))
+    assert resp.data['sub']['events']['addIds'] == [2]
+
+    with pytest.raises(RuntimeError):
+        run(groza.fetch_sub(user, {'events': {
+            **all_sub['events'], 'after': [{'type': 'datetime'}, 3]}}))
+
+
+def test_memory_stream_failed_send_closes_chunks(memory_storage,
+                                                 monkeypatch):
+    closed = []
+    query_chunks = MemorySession.query_chunks
+
+    async def tracked_chunks(self, **kwargs):
+        try:
+            async for chunk in query_chunks(self, **kwargs):
+                yield chunk
+        finally:
+            closed.append(kwargs['visor'].table)
+
+    monkeypatch.setattr(MemorySession, 'query_chunks', tracked_chunks)
+
+    async def send(frame):
+        raise ConnectionError('Closed')
+
+    groza = GrozaHandler()
+    with pytest.raises(ConnectionError):
+        run(groza.stream_sub(GrozaUser(user_id=1),
+                             {'all': {'visor': 'Account'}}, send,
+                             chunk_rows=1))
+    assert closed == ['accounts']
+
+
+def test_memory_order_mixed_types(memory_storage):
+    memory_storage.load(
+        groza_visors.get().require_visor('Account'),
+        [{'id': 5, 'name': 7, 'org': 3}, {'id': 6, 'name': None, 'org': 3}])
+
+    groza = GrozaHandler()
+    resp = run(groza.fetch_sub(GrozaUser(user_id=1), {
+        'page': {'visor': 'Account', 'order': {'name': 1}, 'limit': 10},
+    }))
+    # Numbers before strings, nulls last
+    assert resp.data['sub']['page']['ids'] == [5, 2, 3, 1, 6]
+
+    resp = run(groza.fetch_sub(GrozaUser(user_id=1), {
+        'page': {'visor': 'Account', 'order': {'name': 1}, 'limit': 10,
+                 'after': [3, 5]},
+    }))
+    assert resp.data['sub']['page']['ids'] == [5, 2, 3, 1, 6]
+
+    resp = run(groza.fetch_sub(GrozaUser(user_id=1), {
+        'page': {'visor': 'Account', 'order': {'name': 1}, 'limit': 10,
+                 'after': ['bbb', 3]},
+    }))
+    assert resp.data['sub']['page']['ids'] == [1, 6]
+
+
+def test_memory_writes_notify(memory_storage):
+    notifications = AsyncioQueue()
+    run(memory_storage.install(notifications))
+
+    groza = GrozaHandler()
+    user = GrozaUser(user_id=1)
+    resp = run(groza.query_insert(user, {'visor': 'Account'},
+                                  {'name': 'ddd', 'org': 2}))
+    assert resp.data == {'status': 'ok', 'id': 4}
+    run(groza.query_update(user, [({'visor': 'Account', 'id': 4},
+                                   {'org': 1})]))
+    run(groza.query_delete(user, [{'visor': 'Account', 'id': 3}]))
+
+    changes = []
+    while not notifications.empty():
+        changes.append(notifications.get_nowait())
+    assert [(c.op, c.obj_id) for c in changes] == [
+        ('I', '4'), ('U', '4'), ('D', '3')]
+    assert changes[1].row == {'id': 4, 'name': 'ddd', 'org': 1}
+
+    resp = run(groza.fetch_sub(user, {
+        'org': {'visor': 'Account', 'where': {'org': 1},
+                'order': {'name': 1}},
+    }))
+    assert resp.data['sub']['org']['ids'] == [2, 1, 4]
+
+
+def test_memory_transactions(memory_storage):
+    notifications = AsyncioQueue()
+    run(memory_storage.install(notifications))
+    account = groza_visors.get().require_visor('Account')
+    user = GrozaUser(user_id=1)
+
+    async def scenario():
+        async with memory_storage.session() as reader:
+            async with memory_storage.session() as writer:
+                async with writer.transaction():
+                    await writer.insert(visor=account, user=user,
+                                        insert={'name': 'eee', 'org': 3})
+                    rows, _ = await writer.query(
+                        visor=account, from_sub=None, all_sub={},
+                        sub_resp={}, where={'org': 3})
+                    assert list(rows) == [4]
+                    assert notifications.empty()
+
+            # Reader keeps its snapshot, new sessions see the commit
+            rows, _ = await reader.query(visor=account, from_sub=None,
+                                         all_sub={}, sub_resp={},
+                                         where={'org': 3})
+            assert rows == {}
+
+            # Only the written row gets a version kept for the reader
+            versions = memory_storage.stats()['versions']
+            async with memory_storage.session() as writer:
+                await writer.update(visor=account, user=user,
+                                    update=({'id': 1}, {'org': 3}))
+            assert memory_storage.stats()['versions'] == versions + 1
+            rows = await reader.query_keys(visor=account, keys=['1'])
+            assert rows[1]['org'] == 1
+
+        stats = memory_storage.stats()
+        assert stats['versions'] == stats['rows']
+        assert stats['readers'] == 0
+        assert stats['pruned'] == 1
+
+        async with memory_storage.session() as session:
+            rows = await session.query_keys(visor=account, keys=['4'])
+            assert rows == {4: {'id': 4, 'name': 'eee', 'org': 3}}
+
+            # Failed transaction writes nothing
+            with pytest.raises(RuntimeError):
+                async with session.transaction():
+                    await session.delete(visor=account, user=user,
+                                         delete={'id': 4})
+                    await session.insert(visor=account, user=user,
+                                         insert={'id': 1, 'name': 'x'})
+
+            rows = await session.query_keys(visor=account, keys=['4'])
+            assert list(rows) == [4]
+
+            # Ordered reads see rows the transaction wrote
+            async with session.transaction():
+                await session.insert(visor=account, user=user,
+                                     insert={'name': 'abc', 'org': 1})
+                await session.update(visor=account, user=user,
+                                     update=({'id': 1}, {'name': 'zzz'}))
+                rows, _ = await session.query(
+                    visor=account, from_sub=None, all_sub={}, sub_resp={},
+                    order={'name': 1})
+                assert [row['name'] for row in rows.values()] == [
+                    'aaa', 'abc', 'bbb', 'eee', 'zzz']
+
+        # Row written since a transaction's version fails its commit
+        async with memory_storage.session() as first:
+            async with memory_storage.session() as second:
+                await first.update(visor=account, user=user,
+                                   update=({'id': 2}, {'org': 3}))
+                with pytest.raises(RuntimeError):
+                    async with second.transaction():
+                        await second.update(visor=account, user=user,
+                                            update=({'id': 2}, {'org': 2}))
+                rows = await first.query_keys(visor=account, keys=['2'])
+                assert rows[2]['org'] == 3
+
+    run(scenario())
+
+    assert [notifications.get_nowait().obj_id for _ in range(5)] == [
+        '4', '1', '5', '1', '2']
+    assert notifications.empty()
+
+
+if __name__ == '__main__':
+    pytest.main(['-s', '-x', __file__])
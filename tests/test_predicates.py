@@ -0,0 +1,62 @@
+from datetime import datetime
+from uuid import UUID, uuid4
+
+import pytest
+
+from groza.server.predicates import GrozaPredicateIndex
+
+
+def test_predicate_index_matches_rows():
+    index = GrozaPredicateIndex()
+    index.update('first', [
+        ('mine', 'posts', {'account_id': 1}),
+        ('all', 'posts', None),
+    ])
+    index.update('second', [
+        ('drafts', 'posts', {'account_id': 2, 'is_draft': True}),
+        ('tagged', 'posts', {'tags': ['a']}),
+    ])
+
+    assert index.watches('posts')
+    assert not index.watches('accounts')
+    assert len(index) == 4
+
+    assert index.match('posts', {'account_id': 1, 'is_draft': True}) == {
+        'first': {'mine', 'all'}}
+    assert index.match('posts', {'account_id': 2, 'is_draft': True}) == {
+        'first': {'all'}, 'second': {'drafts'}}
+    assert index.match('posts', {'account_id': 2, 'is_draft': False,
+                                 'tags': ['a']}) == {
+        'first': {'all'}, 'second': {'tagged'}}
+
+    index.update('first', [('mine', 'posts', {'account_id': 3})])
+    assert index.match('posts', {'account_id': 1}) == {}
+    assert len(index) == 3
+
+    index.remove('first')
+    index.remove('second')
+    assert not index.watches('posts')
+    assert len(index) == 0
+
+
+def test_predicate_index_matches_typed_values():
+    index = GrozaPredicateIndex()
+    account_id = UUID('5b0b53b0-8a6e-4a3e-9d3c-1f5c7f3a2b10')
+    index.update('first', [
+        ('mine', 'posts', {'account_id': str(account_id)}),
+        ('new', 'posts', {'is_draft': False, 'created': 86400}),
+    ])
+
+    # Rows from storage have typed values, conditions have JSON ones
+    assert index.match('posts', {'account_id': account_id}) == {
+        'first': {'mine'}}
+    assert index.match('posts', {'account_id': uuid4()}) == {}
+    assert index.match('posts', {'is_draft': False,
+                                 'created': datetime(1970, 1, 2)}) == {
+        'first': {'new'}}
+    assert index.match('posts', {'is_draft': False,
+                                 'created': datetime(1970, 1, 3)}) == {}
+
+
+if __name__ == '__main__':
+    pytest.main(['-s', '-x', __file__])
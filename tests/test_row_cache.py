@@ -0,0 +1,101 @@
+import asyncio
+
+import pytest
+
+from groza import GrozaUser
+from groza.storage import GrozaVisor
+from groza.storage.asyncpg import AsyncpgSession
+from groza.storage.asyncpg.cache import AsyncpgRowCache
+
+
+def test_row_cache_invalidation():
+    cache = AsyncpgRowCache()
+    rows = {1: {'id': 1, 'name': 'aaa'}, 2: {'id': 2, 'name': 'bbb'}}
+
+    sql = 'SELECT * FROM "accounts" WHERE "name" = $1'
+    tables = ('accounts',)
+    cache.put(sql, ('aaa',), tables, cache.generation(tables), rows,
+              keyed=True)
+
+    assert cache.get(sql, ('aaa',)) == rows
+    assert cache.get(sql, ('bbb',)) is None
+    assert cache.get_row('accounts', '2') == {2: rows[2]}
+
+    # Changed row leaves results of every query of its table
+    cache.invalidate('accounts', '1')
+    assert cache.get(sql, ('aaa',)) is None
+    assert cache.get_row('accounts', '1') is None
+    assert cache.get_row('accounts', '2') == {2: rows[2]}
+
+    # Dropped query leaves other tables it reads
+    joined = 'SELECT * FROM "posts" WHERE "account_id" IN ' \
+        '(SELECT "id" FROM "accounts")'
+    both = ('posts', 'accounts')
+    cache.put(joined, (), both, cache.generation(both), {})
+    cache.invalidate('posts', '10')
+    assert cache._table_queries == {}
+
+    # Results read across a change are not stored
+    generation = cache.generation(tables)
+    cache.invalidate('accounts', '3')
+    cache.put(sql, ('aaa',), tables, generation, rows)
+    assert cache.get(sql, ('aaa',)) is None
+
+    cache.flush()
+    assert len(cache) == 0
+    assert cache.size == 0
+
+    stats = cache.stats()
+    assert stats['hits'] == 3
+    assert stats['misses'] == 4
+    assert stats['invalidations'] == 3
+    assert stats['flushes'] == 1
+
+
+def test_row_cache_evicts_by_size():
+    cache = AsyncpgRowCache(max_bytes=2000)
+    tables = ('accounts',)
+    for cnt in range(20):
+        cache.put('SELECT * FROM "accounts" WHERE "id" = $1', (cnt,), tables,
+                  cache.generation(tables), {cnt: {'id': cnt, 'name': 'a'}})
+
+    assert cache.size <= 2000
+    assert cache.stats()['evictions'] > 0
+    assert cache.get('SELECT * FROM "accounts" WHERE "id" = $1', (19,)) \
+        is not None
+    assert cache.get('SELECT * FROM "accounts" WHERE "id" = $1', (0,)) \
+        is None
+    assert len(cache._table_queries['accounts']) == len(cache)
+
+
+def test_row_cache_dropped_by_session_writes():
+    class Conn:
+        async def execute(self, *args):
+            pass
+
+    class Account(GrozaVisor):
+        table = 'accounts'
+        primary_key = 'id'
+
+    cache = AsyncpgRowCache()
+    tables = ('accounts',)
+    cache.put_rows('accounts', cache.generation(tables),
+                   {1: {'id': 1, 'name': 'aaa'}, 2: {'id': 2, 'name': 'bbb'}})
+
+    # Rows are dropped before the notification of the write comes
+    session = AsyncpgSession(conn=Conn(), log=None, rows=cache)
+    asyncio.get_event_loop().run_until_complete(session.update(
+        visor=Account, update=({'id': 1}, {'name': 'ccc'}),
+        user=GrozaUser(user_id=1)))
+    assert cache.get_row('accounts', 1) is None
+    assert cache.get_row('accounts', 2) is not None
+
+    # Rows read again before the commit are dropped once more after it
+    cache.put_rows('accounts', cache.generation(tables),
+                   {1: {'id': 1, 'name': 'aaa'}})
+    session.invalidate_written()
+    assert cache.get_row('accounts', 1) is None
+
+
+if __name__ == '__main__':
+    pytest.main(['-s', '-x', __file__])
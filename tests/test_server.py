@@ -0,0 +1,647 @@
+import asyncio
+import json
+
+import pytest
+
+from groza import GrozaChange, GrozaResponse
+from groza.server import GrozaServerConnection, SimpleGrozaServer
+from groza.state import GrozaHandler
+from groza.storage import GrozaVisor, GrozaForeignKey
+from groza.transport import GrozaServerTransport
+
+from tests.schema import TTable, TSchema, TColumn, TType, TRow
+
+
+class RecordTransport(GrozaServerTransport):
+    async def install(self, server):
+        pass
+
+
+class RecordResponse:
+    def __init__(self):
+        self.sent = []
+
+    async def get_messages(self):
+        return []
+
+    async def send(self, js):
+        self.sent.append(json.loads(js))
+
+
+def _setup_accounts(groza_storage):
+    schema = TSchema(
+        tables=[
+            TTable('accounts', [
+                TColumn('id', TType.BIGSERIAL),
+                TColumn('name', TType.STR),
+                TColumn('last_updated_by', TType.INT8),
+            ], data=[
+                TRow({'id': 1, 'name': 'aaa', 'last_updated_by': 1}),
+                TRow({'id': 2, 'name': 'bbb', 'last_updated_by': 1}),
+            ]),
+        ]
+    )
+    groza_storage.setup(schema)
+
+    class Account(GrozaVisor):
+        table = 'accounts'
+        primary_key = 'id'
+
+
+def _connect(server):
+    conn = GrozaServerConnection(GrozaHandler(), RecordResponse())
+    asyncio.get_event_loop().run_until_complete(
+        server.notify_connection_start(conn))
+    return conn
+
+
+def _request(conn, request):
+    return asyncio.get_event_loop().run_until_complete(
+        conn.handle_request(request))
+
+
+def test_notify_change_routes_by_index(groza_storage):
+    _setup_accounts(groza_storage)
+
+    server = SimpleGrozaServer('main', RecordTransport())
+    watching = _connect(server)
+    idle = _connect(server)
+
+    _request(watching, {'queryId': 1, 'type': 'sub',
+                        'sub': {'allAccounts': {'visor': 'Account'}}})
+
+    run = asyncio.get_event_loop().run_until_complete
+    run(server.notify_change(1, 'accounts', '3'))
+    assert watching.ws.sent == []
+
+    run(server.notify_change(1, 'accounts', '2'))
+    run(watching.group.flush())
+    assert len(watching.ws.sent) == 1
+    assert idle.ws.sent == []
+
+    run(server.notify_connection_close(watching))
+    run(server.notify_change(1, 'accounts', '2'))
+    assert len(watching.ws.sent) == 1
+    assert len(server._index) == 0
+
+
+def test_notify_change_sends_patch(groza_storage):
+    _setup_accounts(groza_storage)
+
+    server = SimpleGrozaServer('main', RecordTransport())
+    conn = _connect(server)
+
+    _request(conn, {'queryId': 1, 'type': 'sub',
+                    'sub': {'allAccounts': {'visor': 'Account'}}})
+
+    run = asyncio.get_event_loop().run_until_complete
+
+    groza_storage.put('accounts',
+                      {'id': 1, 'name': 'aaa1', 'last_updated_by': 1})
+    run(server.notify_change(1, 'accounts', '1'))
+    run(conn.group.flush())
+    patch = conn.ws.sent[-1]
+    assert patch['type'] == 'patch'
+    assert patch['data'] == {'accounts': {
+        '1': {'id': 1, 'name': 'aaa1', 'last_updated_by': 1}}}
+    assert patch['sub']['allAccounts']['removeIds'] == []
+
+    groza_storage.remove('accounts', 2)
+    run(server.notify_change(1, 'accounts', '2'))
+    run(conn.group.flush())
+    patch = conn.ws.sent[-1]
+    assert patch['data'] == {'accounts': {}}
+    assert patch['sub']['allAccounts']['removeIds'] == [2]
+    assert conn.last_sub['allAccounts']['ids'] == [1]
+    assert server._index.lookup('accounts', '2') == {}
+
+
+def test_notify_change_coalesces(groza_storage):
+    _setup_accounts(groza_storage)
+
+    server = SimpleGrozaServer('main', RecordTransport(),
+                               coalesce_delay=0.01, coalesce_batch=3)
+    conn = _connect(server)
+
+    _request(conn, {'queryId': 1, 'type': 'sub',
+                    'sub': {'allAccounts': {'visor': 'Account'}}})
+
+    run = asyncio.get_event_loop().run_until_complete
+
+    run(server.notify_change(1, 'accounts', '1'))
+    run(server.notify_change(1, 'accounts', '2'))
+    assert conn.ws.sent == []
+    run(asyncio.sleep(0.05))
+    assert len(conn.ws.sent) == 1
+    assert set(conn.ws.sent[0]['data']['accounts'].keys()) == {'1', '2'}
+    assert conn.group.last_absorbed == 2
+
+    for obj_id in ('1', '2', '1'):
+        run(server.notify_change(1, 'accounts', obj_id))
+    assert len(conn.ws.sent) == 2
+    assert conn.group.last_absorbed == 3
+    assert conn.group.push_count == 2
+    assert conn.group.absorbed_count == 5
+
+
+def test_same_sub_shares_group(groza_storage):
+    _setup_accounts(groza_storage)
+
+    server = SimpleGrozaServer('main', RecordTransport())
+    first = _connect(server)
+    second = _connect(server)
+    other = _connect(server)
+
+    sub = {'allAccounts': {'visor': 'Account'}}
+    _request(first, {'queryId': 1, 'type': 'sub', 'sub': sub})
+    _request(second, {'queryId': 1, 'type': 'sub', 'sub': sub})
+    _request(other, {'queryId': 1, 'type': 'sub',
+                     'sub': {'allAccounts': {'visor': 'Account',
+                                             'where': {'id': 1}}}})
+
+    assert first.group is second.group
+    assert first.group is not other.group
+    assert len(server._groups) == 2
+
+    run = asyncio.get_event_loop().run_until_complete
+    run(server.notify_change(1, 'accounts', '2'))
+    run(first.group.flush())
+
+    assert first.group.push_count == 1
+    assert first.ws.sent == second.ws.sent
+    assert len(first.ws.sent) == 1
+
+    run(server.notify_connection_close(first))
+    run(server.notify_connection_close(second))
+    assert len(server._groups) == 1
+
+
+def test_notify_change_applies_inline_rows(groza_storage):
+    _setup_accounts(groza_storage)
+
+    server = SimpleGrozaServer('main', RecordTransport())
+    conn = _connect(server)
+
+    _request(conn, {'queryId': 1, 'type': 'sub',
+                    'sub': {'allAccounts': {'visor': 'Account'}}})
+
+    run = asyncio.get_event_loop().run_until_complete
+
+    # Storage is left untouched: patch is built from notifications only
+    run(server.notify_change(1, 'accounts', '1', op='U',
+                             row={'id': 1, 'name': 'aaa1'}))
+    run(server.notify_change(1, 'accounts', '1', op='U',
+                             changed={'name': 'aaa2'}))
+    run(server.notify_change(1, 'accounts', '2', op='D'))
+    run(conn.group.flush())
+
+    patch = conn.ws.sent[-1]
+    assert patch['data'] == {'accounts': {'1': {'id': 1, 'name': 'aaa2'}}}
+    assert patch['sub']['allAccounts']['removeIds'] == [2]
+
+    run(server.notify_change(1, 'accounts', '1', op='U',
+                             changed={'name': 'aaa3'}))
+    run(conn.group.flush())
+    assert conn.ws.sent[-1]['changed'] == {
+        'accounts': {'1': {'name': 'aaa3'}}}
+
+
+def test_auth_refetches_for_new_user(groza_storage):
+    _setup_accounts(groza_storage)
+
+    class AuthHandler(GrozaHandler):
+        def __init__(self):
+            super().__init__()
+            self.users = []
+
+        async def auth(self, request):
+            return GrozaResponse({'status': 'ok', 'userId': 2})
+
+        async def fetch_sub(self, user, all_sub, data_format='object'):
+            self.users.append(user.user_id)
+            return await super().fetch_sub(user, all_sub, data_format)
+
+    server = SimpleGrozaServer('main', RecordTransport())
+    conn = GrozaServerConnection(AuthHandler(), RecordResponse())
+    run = asyncio.get_event_loop().run_until_complete
+    run(server.notify_connection_start(conn))
+
+    _request(conn, {'queryId': 1, 'type': 'sub',
+                    'sub': {'allAccounts': {'visor': 'Account'}}})
+    group = conn.group
+    resp = _request(conn, {'queryId': 2, 'type': 'auth', 'token': 't'})
+    assert resp['status'] == 'ok'
+
+    # State of the new user is fetched and pushed, not taken over
+    assert conn.handler.users == [1, 2]
+    assert conn.ws.sent[-1]['type'] == 'data'
+    assert conn.group is not group
+    assert conn.group.user.user_id == 2
+
+    # Same user again keeps the state
+    _request(conn, {'queryId': 3, 'type': 'auth', 'token': 't'})
+    assert conn.handler.users == [1, 2]
+
+
+def test_sub_columnar_format(groza_storage):
+    _setup_accounts(groza_storage)
+
+    server = SimpleGrozaServer('main', RecordTransport())
+    rows = _connect(server)
+    columns = _connect(server)
+    objects = _connect(server)
+
+    sub = {'allAccounts': {'visor': 'Account'}}
+    resp = _request(rows, {'queryId': 1, 'type': 'sub', 'sub': sub,
+                           'format': 'rows'})
+    assert resp['format'] == 'rows'
+    table = resp['data']['accounts']
+    assert sorted(table['columns']) == ['id', 'last_updated_by', 'name']
+    assert sorted(dict(zip(table['columns'], row))['name']
+                  for row in table['rows']) == ['aaa', 'bbb']
+
+    resp = _request(columns, {'queryId': 1, 'type': 'sub', 'sub': sub,
+                              'format': 'columns'})
+    table = resp['data']['accounts']
+    names = table['values'][table['columns'].index('name')]
+    assert sorted(names) == ['aaa', 'bbb']
+
+    _request(objects, {'queryId': 1, 'type': 'sub', 'sub': sub})
+    assert len({rows.group, columns.group, objects.group}) == 3
+
+    # Changed fields follow the format, blocks by fields left out
+    run = asyncio.get_event_loop().run_until_complete
+    run(server.notify_change(1, 'accounts', '1', op='U',
+                             changed={'name': 'aaa2'}))
+    run(server.notify_change(1, 'accounts', '2', op='U',
+                             changed={'name': 'bbb2', 'last_updated_by': 2}))
+    run(columns.group.flush())
+    assert columns.ws.sent[-1]['format'] == 'columns'
+    assert columns.ws.sent[-1]['changed'] == {'accounts': [
+        {'columns': ['id', 'name'], 'values': [[1], ['aaa2']]},
+        {'columns': ['id', 'name', 'last_updated_by'],
+         'values': [[2], ['bbb2'], [2]]},
+    ]}
+
+    resp = _request(objects, {'queryId': 2, 'type': 'sub', 'sub': sub,
+                              'format': 'xml'})
+    assert resp == {'responseQueryId': 2, 'status': 'error',
+                    'message': 'Invalid format: xml'}
+
+    resp = _request(objects, {'queryId': 3, 'type': 'sub', 'sub': []})
+    assert resp['responseQueryId'] == 3
+    assert resp['status'] == 'error'
+
+
+def test_slow_sub_does_not_block_update(groza_storage):
+    _setup_accounts(groza_storage)
+
+    server = SimpleGrozaServer('main', RecordTransport())
+    conn = _connect(server)
+
+    fetch_sub = conn.handler.fetch_sub
+
+    async def slow_fetch_sub(*args, **kwargs):
+        await asyncio.sleep(0.05)
+        return await fetch_sub(*args, **kwargs)
+
+    conn.handler.fetch_sub = slow_fetch_sub
+
+    async def run_requests():
+        sub = {'allAccounts': {'visor': 'Account'}}
+        await conn.scheduler.submit({'queryId': 1, 'type': 'sub', 'sub': sub})
+        await conn.scheduler.submit({'queryId': 2, 'type': 'sub', 'sub': sub})
+        await conn.scheduler.submit({
+            'queryId': 3, 'type': 'update',
+            'update': [({'visor': 'Account', 'id': 1}, {'name': 'aaa1'})]})
+        await conn.scheduler.drain()
+
+    asyncio.get_event_loop().run_until_complete(run_requests())
+
+    # Update overtakes subscriptions, subscriptions keep their order
+    assert [resp['responseQueryId'] for resp in conn.ws.sent] == [3, 1, 2]
+
+
+def test_sub_waits_for_earlier_write(groza_storage):
+    _setup_accounts(groza_storage)
+
+    server = SimpleGrozaServer('main', RecordTransport())
+    conn = _connect(server)
+
+    query_update = conn.handler.query_update
+
+    async def slow_query_update(*args, **kwargs):
+        await asyncio.sleep(0.05)
+        return await query_update(*args, **kwargs)
+
+    conn.handler.query_update = slow_query_update
+
+    async def run_requests():
+        await conn.scheduler.submit({
+            'queryId': 1, 'type': 'update',
+            'update': [({'visor': 'Account', 'id': 1}, {'name': 'aaa1'})]})
+        await conn.scheduler.submit({
+            'queryId': 2, 'type': 'sub',
+            'sub': {'allAccounts': {'visor': 'Account'}}})
+        await conn.scheduler.drain()
+
+    asyncio.get_event_loop().run_until_complete(run_requests())
+
+    assert [resp['responseQueryId'] for resp in conn.ws.sent] == [1, 2]
+    names = {row['name']
+             for row in conn.ws.sent[1]['data']['accounts'].values()}
+    assert names == {'aaa1', 'bbb'}
+
+
+def test_sub_pages(groza_storage):
+    _setup_accounts(groza_storage)
+
+    server = SimpleGrozaServer('main', RecordTransport())
+    conn = _connect(server)
+
+    resp = _request(conn, {'queryId': 1, 'type': 'sub', 'sub': {
+        'allAccounts': {'visor': 'Account', 'order': {'id': 1}, 'limit': 1,
+                        'total': 'exact'}}})
+    sub = resp['sub']['allAccounts']
+    assert sub['ids'] == [1]
+    assert sub['hasMore']
+    assert sub['cursor'] == [1]
+    assert sub['total'] == 2
+    first_group = conn.group
+
+    resp = _request(conn, {'queryId': 2, 'type': 'more',
+                           'sub': 'allAccounts'})
+    assert resp['type'] == 'more'
+    assert list(resp['data']['accounts']) == [2]
+    assert resp['sub']['allAccounts']['addIds'] == [2]
+    assert not resp['sub']['allAccounts']['hasMore']
+
+    # Loaded pages are part of the group: changes of them are routed
+    assert conn.group is not first_group
+    assert conn.all_sub['allAccounts']['pages'] == 2
+    assert conn.last_sub['allAccounts']['ids'] == [1, 2]
+
+    run = asyncio.get_event_loop().run_until_complete
+    run(server.notify_change(1, 'accounts', '2'))
+    run(conn.group.flush())
+    assert list(conn.ws.sent[-1]['data']['accounts']) == ['2']
+
+    # Refresh queries all loaded pages
+    run(conn.group.send_sub())
+    assert conn.ws.sent[-1]['sub']['allAccounts']['ids'] == [1, 2]
+
+
+def test_sub_stream(groza_storage):
+    _setup_accounts(groza_storage)
+
+    server = SimpleGrozaServer('main', RecordTransport())
+    conn = _connect(server)
+
+    resp = _request(conn, {'queryId': 1, 'type': 'sub', 'stream': True,
+                           'chunkRows': 1,
+                           'sub': {'allAccounts': {'visor': 'Account'}}})
+
+    chunks = conn.ws.sent
+    assert [chunk['type'] for chunk in chunks] == ['data-chunk'] * 2
+    assert [chunk['chunk'] for chunk in chunks] == [0, 1]
+    assert all(chunk['responseQueryId'] == 1 for chunk in chunks)
+    assert [list(chunk['data']['accounts']) for chunk in chunks] == [
+        ['1'], ['2']]
+
+    assert resp['type'] == 'data'
+    assert resp['data'] == {}
+    assert resp['chunks'] == 2
+    assert resp['sub']['allAccounts']['ids'] == [1, 2]
+    assert conn.last_sub['allAccounts']['ids'] == [1, 2]
+
+    # Errors answer the request like any other response
+    resp = _request(conn, {'queryId': 2, 'type': 'sub', 'stream': True,
+                           'sub': {'page': {'visor': 'Account',
+                                            'limit': 1}}})
+    assert resp['responseQueryId'] == 2
+    assert resp['status'] == 'error'
+
+
+def test_inserted_row_routed_by_where(groza_storage):
+    _setup_accounts(groza_storage)
+
+    server = SimpleGrozaServer('main', RecordTransport())
+    conn = _connect(server)
+    other = _connect(server)
+
+    _request(conn, {'queryId': 1, 'type': 'sub',
+                    'sub': {'byOne': {'visor': 'Account',
+                                      'where': {'last_updated_by': 1}}}})
+    _request(other, {'queryId': 1, 'type': 'sub',
+                     'sub': {'byTwo': {'visor': 'Account',
+                                       'where': {'last_updated_by': 2}}}})
+
+    run = asyncio.get_event_loop().run_until_complete
+
+    # Key-only notification: the row is looked up to be matched
+    groza_storage.put('accounts',
+                      {'id': 3, 'name': 'ccc', 'last_updated_by': 1})
+    run(server.notify_change(1, 'accounts', '3', op='I'))
+    run(conn.group.flush())
+    run(other.group.flush())
+
+    patch = conn.ws.sent[-1]
+    assert patch['type'] == 'patch'
+    assert patch['data'] == {'accounts': {
+        '3': {'id': 3, 'name': 'ccc', 'last_updated_by': 1}}}
+    assert patch['sub']['byOne']['addIds'] == [3]
+    assert patch['sub']['byOne']['removeIds'] == []
+    assert conn.last_sub['byOne']['ids'] == [1, 2, 3]
+    assert other.ws.sent == []
+
+    # Inline row, not in storage: applied as is
+    run(server.notify_change(1, 'accounts', '4', op='I',
+                             row={'id': 4, 'name': 'ddd',
+                                  'last_updated_by': 2}))
+    run(other.group.flush())
+    patch = other.ws.sent[-1]
+    assert patch['sub']['byTwo']['addIds'] == [4]
+    assert other.last_sub['byTwo']['ids'] == [4]
+    assert len(conn.ws.sent) == 1
+
+    run(server.notify_connection_close(conn))
+    run(server.notify_connection_close(other))
+    assert len(server._predicates) == 0
+
+
+def test_inserted_rows_looked_up_per_batch(groza_storage):
+    _setup_accounts(groza_storage)
+
+    server = SimpleGrozaServer('main', RecordTransport())
+    conn = _connect(server)
+    _request(conn, {'queryId': 1, 'type': 'sub',
+                    'sub': {'byOne': {'visor': 'Account',
+                                      'where': {'last_updated_by': 1}}}})
+
+    run = asyncio.get_event_loop().run_until_complete
+    groza_storage.put('accounts',
+                      {'id': 3, 'name': 'ccc', 'last_updated_by': 1})
+    groza_storage.put('accounts',
+                      {'id': 4, 'name': 'ddd', 'last_updated_by': 2})
+
+    lookups = []
+    run(server.notify_change(1, 'accounts', '1', op='U'))
+    fetch_rows = server._handler.fetch_rows
+
+    async def counted_fetch_rows(table, keys):
+        lookups.append((table, sorted(keys)))
+        return await fetch_rows(table, keys)
+
+    server._handler.fetch_rows = counted_fetch_rows
+    run(server.notify_changes([
+        GrozaChange(1, 'accounts', '3', 'I'),
+        GrozaChange(1, 'accounts', '4', 'I'),
+    ]))
+    run(conn.group.flush())
+
+    assert lookups == [('accounts', ['3', '4'])]
+    assert conn.last_sub['byOne']['ids'] == [1, 2, 3]
+
+
+def test_linked_change_requeries_chain(groza_storage):
+    schema = TSchema(
+        tables=[
+            TTable('accounts', [
+                TColumn('id', TType.BIGSERIAL),
+                TColumn('name', TType.STR),
+                TColumn('last_updated_by', TType.INT8),
+            ], data=[
+                TRow({'id': 1, 'name': 'aaa', 'last_updated_by': 1}),
+                TRow({'id': 2, 'name': 'bbb', 'last_updated_by': 1}),
+            ]),
+            TTable('posts', [
+                TColumn('id', TType.BIGSERIAL),
+                TColumn('account_id', TType.INT8),
+            ], data=[
+                TRow({'id': 10, 'account_id': 1}),
+                TRow({'id': 20, 'account_id': 2}),
+            ]),
+        ]
+    )
+    groza_storage.setup(schema)
+
+    class Account(GrozaVisor):
+        table = 'accounts'
+        primary_key = 'id'
+
+    class Post(GrozaVisor):
+        table = 'posts'
+        primary_key = 'id'
+
+        account = GrozaForeignKey('Account', 'account_id')
+
+    server = SimpleGrozaServer('main', RecordTransport())
+    conn = _connect(server)
+    _request(conn, {'queryId': 1, 'type': 'sub', 'sub': {
+        'others': {'visor': 'Account', 'where': {'last_updated_by': 2}},
+        'mine': {'visor': 'Account', 'where': {'last_updated_by': 1}},
+        'posts': {'visor': 'Post', 'fromSub': 'mine'},
+    }})
+    assert conn.group.graph.downstream(['mine']) == ['mine', 'posts']
+    assert conn.group.graph.downstream(['posts']) == ['posts']
+
+    run = asyncio.get_event_loop().run_until_complete
+
+    # Account leaving the link source takes its posts along
+    sent = len(conn.ws.sent)
+    groza_storage.put('accounts',
+                      {'id': 2, 'name': 'bbb', 'last_updated_by': 2})
+    run(server.notify_change(1, 'accounts', '2'))
+    run(conn.group.flush())
+
+    # Patch of the plain subscription goes in the same message
+    assert len(conn.ws.sent) == sent + 1
+    patch = conn.ws.sent[-1]
+    assert patch['type'] == 'patch'
+    assert patch['sub'].keys() == {'others', 'mine', 'posts'}
+    assert patch['sub']['others']['addIds'] == [2]
+    assert patch['sub']['mine']['removeIds'] == [2]
+    assert patch['sub']['posts']['removeIds'] == [20]
+    assert patch['sub']['posts']['fromSub'] == {'1': [10]}
+    assert patch['data'] == {
+        'accounts': {'2': {'id': 2, 'name': 'bbb', 'last_updated_by': 2}},
+        'posts': {}}
+    assert conn.last_sub['posts']['ids'] == [10]
+
+    # Linked row is re-queried alone, its source is left untouched
+    groza_storage.put('posts', {'id': 30, 'account_id': 1})
+    run(server.notify_change(1, 'posts', '30', op='I'))
+    run(conn.group.flush())
+
+    patch = conn.ws.sent[-1]
+    assert patch['sub'].keys() == {'posts'}
+    assert patch['sub']['posts']['addIds'] == [30]
+    assert patch['data'] == {'posts': {'30': {'id': 30, 'account_id': 1}}}
+    assert conn.last_sub['posts']['ids'] == [10, 30]
+
+    # Row linked outside of the link source is not re-queried
+    fetch_chain = conn.group.handler.fetch_chain
+    chains = []
+
+    async def counted_fetch_chain(*args, **kwargs):
+        chains.append(args[2])
+        return await fetch_chain(*args, **kwargs)
+
+    conn.group.handler.fetch_chain = counted_fetch_chain
+    sent = len(conn.ws.sent)
+    groza_storage.put('posts', {'id': 40, 'account_id': 2})
+    run(server.notify_change(1, 'posts', '40', op='I'))
+    run(conn.group.flush())
+    assert chains == []
+    assert len(conn.ws.sent) == sent
+
+
+def test_join_with_fresher_state_refreshes_group(groza_storage):
+    _setup_accounts(groza_storage)
+
+    server = SimpleGrozaServer('main', RecordTransport())
+    first = _connect(server)
+    second = _connect(server)
+
+    sub = {'allAccounts': {'visor': 'Account'}}
+    _request(first, {'queryId': 1, 'type': 'sub', 'sub': sub})
+
+    # Row is deleted before its notification arrives
+    groza_storage.remove('accounts', 2)
+    _request(second, {'queryId': 1, 'type': 'sub', 'sub': sub})
+    assert first.group is second.group
+    assert first.last_sub['allAccounts']['ids'] == [1, 2]
+
+    run = asyncio.get_event_loop().run_until_complete
+    run(server.notify_change(1, 'accounts', '2'))
+    run(first.group.flush())
+
+    assert first.ws.sent == second.ws.sent
+    assert first.ws.sent[-1]['type'] == 'data'
+    assert first.ws.sent[-1]['sub']['allAccounts']['ids'] == [1]
+    assert first.last_sub['allAccounts']['ids'] == [1]
+
+
+def test_loop_lag_monitor_opt_in(groza_storage):
+    async def scenario():
+        server = SimpleGrozaServer('main', RecordTransport())
+        await server.install(None)
+        assert server.loop_lag is None
+        await server.close()
+
+        server = SimpleGrozaServer('main', RecordTransport(),
+                                   monitor_lag=True)
+        await server.install(None)
+        task = server.loop_lag._task
+        assert task is not None and not task.done()
+
+        await server.close()
+        await asyncio.sleep(0)
+        assert task.cancelled()
+        assert server.loop_lag._task is None
+
+    asyncio.get_event_loop().run_until_complete(scenario())
+
+
+if __name__ == '__main__':
+    pytest.main(['-s', '-x', __file__])
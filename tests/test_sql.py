@@ -0,0 +1,131 @@
+import pytest
+
+from groza.storage import GrozaVisor, GrozaForeignKey, link_ids_source
+from groza.storage.asyncpg.sql import SqlSelect, DEFAULT, insert_values, \
+    reserve_keys, copy_staging, insert_from
+
+
+def test_select_nests_link_sources():
+    accounts = SqlSelect('accounts', ['id']).where('org_id', 5)
+    q = (
+        SqlSelect('posts')
+        .where_in('account_id', accounts)
+        .where('is_draft', False)
+        .order('created', -1)
+    )
+
+    assert q.end() == (
+        'SELECT * FROM "posts" WHERE "account_id" IN '
+        '(SELECT "id" FROM "accounts" WHERE "org_id" = $1) '
+        'AND "is_draft" = $2 ORDER BY "created" DESC',
+        (5, False))
+    assert q.tables() == ('posts', 'accounts')
+
+    q = SqlSelect('posts').where_in('account_id', [1, 2]).where('id', 3)
+    assert q.end() == (
+        'SELECT * FROM "posts" WHERE "account_id" = ANY($1) AND "id" = $2',
+        ([1, 2], 3))
+
+
+def test_link_ids_source():
+    all_sub = {
+        'orgs': {'visor': 'Org'},
+        'accounts': {'visor': 'Account', 'fromSub': 'orgs'},
+        'posts': {'visor': 'Post', 'fromSub': 'accounts'},
+        'comments': {'visor': 'Comment', 'fromSub': 'posts'},
+    }
+
+    # Deep chains repeat one link source and read ids of the next one
+    assert link_ids_source(all_sub, 'posts', 2) == 'accounts'
+    assert link_ids_source(all_sub, 'accounts', 2) == 'orgs'
+    assert link_ids_source(all_sub, 'orgs', 2) is None
+    assert link_ids_source(all_sub, 'posts', 1) == 'posts'
+    assert link_ids_source(all_sub, 'posts', 10) is None
+
+    all_sub['accounts']['limit'] = 10
+    assert link_ids_source(all_sub, 'posts', 10) == 'accounts'
+
+
+def test_select_recursive():
+    q = (
+        SqlSelect('categories')
+        .where('id', 42)
+        .recursive('parent_id', 'id', depth=3)
+        .order('name')
+    )
+    sql, args = q.end()
+
+    assert sql.startswith('WITH RECURSIVE "_groza_tree" AS (')
+    assert 'FROM "categories" "_groza_t" WHERE "id" = $1 UNION ALL' in sql
+    assert '"_groza_c"."parent_id" = ("tr"."_groza_row")."id"' in sql
+    assert 'NOT coalesce("id" = $1, false)' in sql
+    assert '"tr"."_groza_depth" < $2' in sql
+    assert sql.endswith('ORDER BY "_groza_depth", ("_groza_row")."name"')
+    assert args == (42, 3)
+
+    # Every row is a root already: no walk repeating descendants
+    q = SqlSelect('categories').recursive('parent_id', 'id').order('name')
+    assert q.end() == ('SELECT * FROM "categories" ORDER BY "name"', ())
+
+
+def test_link_field(groza_storage):
+    class LinkAccount(GrozaVisor):
+        table = 'accounts'
+        primary_key = 'id'
+
+    class LinkPost(GrozaVisor):
+        table = 'posts'
+        primary_key = 'id'
+
+        account = GrozaForeignKey('LinkAccount', 'account_id')
+
+    assert LinkPost.link_field(LinkAccount) == 'account_id'
+    assert LinkAccount.link_field(LinkPost) is None
+
+
+def test_select_text_keys():
+    assert SqlSelect('posts').where_text('id', ['1', '2']).end() == (
+        'SELECT * FROM "posts" WHERE "id" IN (SELECT "_groza_k"."id" '
+        'FROM json_populate_recordset(NULL::"posts", $1::json) "_groza_k")',
+        ('[{"id": "1"}, {"id": "2"}]',))
+
+
+def test_insert_sql():
+    assert insert_values('accounts', ['id', 'name', 'last_updated_by'], [
+        [1, 'aaa', 5],
+        [2, DEFAULT, 5],
+    ]) == (
+        'INSERT INTO "accounts" ("id", "name", "last_updated_by") '
+        'VALUES ($1, $2, $3), ($4, DEFAULT, $5)',
+        (1, 'aaa', 5, 2, 5))
+
+    # Taken keys are written into a GENERATED ALWAYS identity column
+    assert insert_values('accounts', ['id', 'name'], [[1, 'aaa']],
+                         overriding=True) == (
+        'INSERT INTO "accounts" ("id", "name") OVERRIDING SYSTEM VALUE '
+        'VALUES ($1, $2)',
+        (1, 'aaa'))
+
+    assert reserve_keys("nextval('accounts_id_seq'::regclass)") == (
+        'SELECT nextval(\'accounts_id_seq\'::regclass) AS "_groza_key" '
+        'FROM generate_series(1, $1) ORDER BY 1')
+
+    # User tables of the staging name are left alone
+    assert copy_staging('_groza_insert_accounts', 'accounts',
+                        ['id', 'name']) == [
+        'DROP TABLE IF EXISTS pg_temp."_groza_insert_accounts"',
+        'CREATE TEMP TABLE "_groza_insert_accounts" ON COMMIT DROP AS '
+        'SELECT "id", "name" FROM "accounts" WITH NO DATA',
+    ]
+    assert insert_from('accounts', '_groza_insert_accounts',
+                       ['id', 'name']) == (
+        'INSERT INTO "accounts" ("id", "name") SELECT "id", "name" '
+        'FROM pg_temp."_groza_insert_accounts"')
+    assert insert_from('accounts', '_groza_insert_accounts', ['id'],
+                       overriding=True) == (
+        'INSERT INTO "accounts" ("id") OVERRIDING SYSTEM VALUE '
+        'SELECT "id" FROM pg_temp."_groza_insert_accounts"')
+
+
+if __name__ == '__main__':
+    pytest.main(['-s', '-x', __file__])
@@ -0,0 +1,56 @@
+import pytest
+
+from groza.storage import GrozaVisor
+from groza.storage.asyncpg.statements import AsyncpgStatement, \
+    AsyncpgStatementCache
+
+
+def _statement(sql):
+    return AsyncpgStatement(sql, ('name',), ('name',))
+
+
+def test_statement_cache():
+    class Account(GrozaVisor):
+        table = 'accounts'
+        primary_key = 'id'
+
+    class AccountByName(GrozaVisor):
+        table = 'accounts'
+        primary_key = 'name'
+        audit = 'async'
+
+    cache = AsyncpgStatementCache(size=2)
+    built = []
+
+    def build(sql):
+        def build_sql():
+            built.append(sql)
+            return _statement(sql)
+        return build_sql
+
+    first = cache.key('update', Account, ('name',))
+    second = cache.key('update', AccountByName, ('name',))
+    assert first != second
+
+    assert cache.get(first, build('by id')).sql == 'by id'
+    assert cache.get(first, build('again')).sql == 'by id'
+    assert cache.get(second, build('by name')).sql == 'by name'
+    assert built == ['by id', 'by name']
+
+    # Least recently used statement goes first
+    assert cache.get(first, build('again')).sql == 'by id'
+    third = cache.key('insert', Account, ('name',))
+    cache.get(third, build('insert'))
+    assert cache.find(second) is None
+    assert cache.find(first).sql == 'by id'
+
+    assert cache.stats() == {
+        'size': 2,
+        'hits': 2,
+        'misses': 3,
+        'evictions': 1,
+    }
+
+
+if __name__ == '__main__':
+    pytest.main(['-s', '-x', __file__])
@@ -1,6 +1,11 @@
+import json
+from datetime import datetime, date
+from uuid import UUID
+
 import pytest
 
-from groza.utils import CamelCaseFieldTransformer
+from groza.utils import CamelCaseFieldTransformer, FieldCodec, JsonCodec, \
+    OrjsonCodec, orjson
 
 
 def test_word():
@@ -13,5 +18,48 @@ def test_word():
     assert cc.to_db('suiteId') == 'suite_id'
 
 
+def test_codec():
+    codec = FieldCodec(CamelCaseFieldTransformer())
+
+    assert codec.to_db('suiteId') == 'suite_id'
+    assert codec.from_db('suite_id') == 'suiteId'
+
+    decode = codec.row_decoder(('id', 'suite_id', 'last_updated_by'))
+    assert codec.row_decoder(['id', 'suite_id', 'last_updated_by']) is decode
+    assert decode((1, 2, 3)) == {'id': 1, 'suiteId': 2, 'lastUpdatedBy': 3}
+
+    assert codec.decode_row({'suite_id': 2}) == {'suiteId': 2}
+
+
+def test_codec_bounded():
+    codec = FieldCodec(CamelCaseFieldTransformer(), names=2, shapes=1)
+
+    for name in ('fieldA', 'fieldB', 'fieldC'):
+        codec.to_db(name)
+    assert codec.to_db.cache_info().currsize == 2
+
+    decode = codec.row_decoder(('id',))
+    codec.row_decoder(('id', 'name'))
+    assert codec.row_decoder(('id',)) is not decode
+
+
+@pytest.mark.skipif(orjson is None, reason='orjson is not installed')
+def test_json_codecs_agree():
+    resp = {
+        'data': {'items': {1: {
+            'created': datetime(2020, 1, 2, 3, 4, 5),
+            'day': date(2020, 1, 2),
+            'uuid': UUID('12345678-1234-5678-1234-567812345678'),
+            'name': 'имя',
+        }}},
+    }
+
+    std = JsonCodec().dumps(resp)
+    fast = OrjsonCodec().dumps(resp)
+    assert json.loads(std) == json.loads(fast)
+    assert OrjsonCodec().loads(fast)['data']['items']['1']['created'] == \
+        1577934245
+
+
 if __name__ == '__main__':
     pytest.main(['-s', '-x', __file__])
@@ -44,6 +44,56 @@ def test_fetch_sub(groza_storage):
     assert set(sub['allAccounts']['ids']) == {1, 2}
 
 
+def test_fetch_sub_recursive(groza_storage):
+    schema = TSchema(
+        tables=[
+            TTable('categories', [
+                TColumn('id', TType.BIGSERIAL),
+                TColumn('parent_id', TType.INT8),
+                TColumn('last_updated_by', TType.INT8),
+            ], data=[
+                TRow({'id': 1, 'parent_id': None, 'last_updated_by': 1}),
+                TRow({'id': 2, 'parent_id': 1, 'last_updated_by': 1}),
+                TRow({'id': 3, 'parent_id': 2, 'last_updated_by': 1}),
+                TRow({'id': 4, 'parent_id': None, 'last_updated_by': 1}),
+            ]),
+        ]
+    )
+
+    groza_storage.setup(schema)
+
+    class Category(GrozaVisor):
+        table = 'categories'
+        primary_key = 'id'
+
+    groza = GrozaHandler()
+    subscription = {
+        'tree': {'visor': 'Category', 'recursive': ['parent_id', 'children'],
+                 'recursiveDepth': 5},
+    }
+    resp = asyncio.get_event_loop().run_until_complete(groza.fetch_sub(
+        GrozaUser(user_id=1), subscription))
+    data = resp.data['data']['categories']
+
+    assert resp.data['sub']['tree']['ids'] == [1, 4]
+    assert data[1]['children'] == [2]
+    assert data[2]['children'] == [3]
+    assert data[3]['children'] == []
+
+
+def test_fetch_sub_link_cycle(groza_storage):
+    groza_storage.setup(TSchema(tables=[]))
+
+    groza = GrozaHandler()
+    subscription = {
+        'first': {'visor': 'Account', 'fromSub': 'second'},
+        'second': {'visor': 'Account', 'fromSub': 'first'},
+    }
+    with pytest.raises(RuntimeError):
+        asyncio.get_event_loop().run_until_complete(groza.fetch_sub(
+            GrozaUser(user_id=1), subscription))
+
+
 def test_insert(groza_storage):
     schema = TSchema(
         tables=[
@@ -76,6 +126,41 @@ def test_insert(groza_storage):
     assert resp.data['id'] == 3
 
 
+def test_insert_many(groza_storage):
+    schema = TSchema(
+        tables=[
+            TTable('accounts', [
+                TColumn('id', TType.BIGSERIAL),
+                TColumn('name', TType.STR),
+                TColumn('last_updated_by', TType.INT8),
+            ], data=[
+                TRow({'id': 1, 'name': 'aaa', 'last_updated_by': 1}),
+            ]),
+        ]
+    )
+
+    groza_storage.setup(schema)
+
+    class Account(GrozaVisor):
+        table = 'accounts'
+        primary_key = 'id'
+
+    groza = GrozaHandler()
+    query = {
+        'visor': 'Account',
+    }
+    insert = [
+        {'name': 'bbb'},
+        {'name': 'ccc'},
+    ]
+    resp = asyncio.get_event_loop().run_until_complete(groza.query_insert(
+        user=GrozaUser(user_id=1), query=query, insert=insert))
+    assert resp.data['id'] == [2, 3]
+
+    data = groza_storage.query('accounts', order_field='id')
+    assert [d['name'] for d in data] == ['aaa', 'bbb', 'ccc']
+
+
 def test_update(groza_storage):
     schema = TSchema(
         tables=[
@@ -109,5 +194,102 @@ def test_update(groza_storage):
     assert data[0]['name'] == 'aaa1'
 
 
+def test_update_many(groza_storage):
+    schema = TSchema(
+        tables=[
+            TTable('accounts', [
+                TColumn('id', TType.BIGSERIAL),
+                TColumn('name', TType.STR),
+                TColumn('last_updated_by', TType.INT8),
+            ], data=[
+                TRow({'id': 1, 'name': 'aaa', 'last_updated_by': 1}),
+                TRow({'id': 2, 'name': 'bbb', 'last_updated_by': 1}),
+            ]),
+        ]
+    )
+    groza_storage.setup(schema)
+
+    class Account(GrozaVisor):
+        table = 'accounts'
+        primary_key = 'id'
+
+    groza = GrozaHandler()
+    update = [
+        [{'visor': 'Account', 'id': 1}, {'name': 'aaa1'}],
+        [{'visor': 'Account', 'id': 2}, {'name': 'bbb1'}],
+        [{'visor': 'Account', 'id': 1}, {'name': 'aaa2'}],
+    ]
+    resp = asyncio.get_event_loop().run_until_complete(groza.query_update(
+        user=GrozaUser(user_id=1), update=update))
+    assert resp.data['status'] == 'ok'
+
+    data = groza_storage.query('accounts', order_field='id')
+    assert [d['name'] for d in data] == ['aaa2', 'bbb1']
+
+
+def test_overridden_write_hooks_run(groza_storage):
+    schema = TSchema(
+        tables=[
+            TTable('accounts', [
+                TColumn('id', TType.BIGSERIAL),
+                TColumn('name', TType.STR),
+                TColumn('last_updated_by', TType.INT8),
+            ], data=[
+                TRow({'id': 1, 'name': 'aaa', 'last_updated_by': 1}),
+                TRow({'id': 2, 'name': 'bbb', 'last_updated_by': 1}),
+            ]),
+        ]
+    )
+    groza_storage.setup(schema)
+
+    calls = []
+
+    class Account(GrozaVisor):
+        table = 'accounts'
+        primary_key = 'id'
+
+        async def update(self, update, user, session):
+            calls.append(('update', update[0]['id']))
+            raise PermissionError('Read only')
+
+        async def delete(self, delete, user, session):
+            calls.append(('delete', delete['id']))
+            raise PermissionError('Read only')
+
+    groza = GrozaHandler()
+    run = asyncio.get_event_loop().run_until_complete
+    user = GrozaUser(user_id=1)
+
+    for update in ([[{'visor': 'Account', 'id': 1}, {'name': 'x'}]],
+                   [[{'visor': 'Account', 'id': 1}, {'name': 'x'}],
+                    [{'visor': 'Account', 'id': 2}, {'name': 'y'}]]):
+        with pytest.raises(PermissionError):
+            run(groza.query_update(user=user, update=update))
+
+    for delete in ([{'visor': 'Account', 'id': 1}],
+                   [{'visor': 'Account', 'id': 1},
+                    {'visor': 'Account', 'id': 2}]):
+        with pytest.raises(PermissionError):
+            run(groza.query_delete(user=user, delete=delete))
+
+    assert calls == [('update', 1), ('update', 1), ('delete', 1),
+                     ('delete', 1)]
+
+    class Post(GrozaVisor):
+        table = 'accounts'
+        primary_key = 'id'
+
+        async def insert(self, insert, user, session):
+            calls.append(('insert', insert['name']))
+            raise PermissionError('Read only')
+
+    for insert in ({'name': 'ccc'}, [{'name': 'ccc'}, {'name': 'ddd'}]):
+        with pytest.raises(PermissionError):
+            run(groza.query_insert(user, {'visor': 'Post'}, insert))
+    assert calls[4:] == [('insert', 'ccc'), ('insert', 'ccc')]
+    data = groza_storage.query('accounts', order_field='id')
+    assert [d['name'] for d in data] == ['aaa', 'bbb']
+
+
 if __name__ == '__main__':
     pytest.main(['-s', '-x', __file__])